@@ -0,0 +1,421 @@
+import hashlib
+import os
+import pickle
+import time
+
+
+def table_fingerprint(engine, table):
+    """
+    Returns a cheap fingerprint of a table's contents based on the
+    PostgreSQL statistics collector: the table's oid along with its insert,
+    update and delete counters.  Any write to the table, or dropping and
+    recreating it, changes the fingerprint without scanning the table.
+    On a LocalDatabase the fingerprint hashes the table's rows instead.
+
+    engine (sql alchemy engine object or LocalDatabase): Used to establish a
+    connection to the db
+
+    table (str): name of the table, optionally schema qualified
+    """
+
+    from sqlalchemy import text
+    from sql_query_helper_funcs import LocalDatabase
+
+    if isinstance(engine, LocalDatabase):
+        return engine.table_fingerprint(table)
+
+    # Resolved through the search_path like the queries' table names, so a
+    # same-named table in another schema is never fingerprinted instead
+    sql_query = text("""
+SELECT relid, n_tup_ins, n_tup_upd, n_tup_del
+  FROM pg_stat_user_tables
+ WHERE relid = to_regclass(:table);
+""")
+
+    with engine.connect() as conn:
+        rows = conn.execute(sql_query, {'table': table}).fetchall()
+
+    if len(rows) > 1:
+        raise RuntimeError(f"{len(rows)} tables match '{table}' in pg_stat_user_tables")
+
+    return tuple(rows[0]) if rows else None
+
+
+def file_fingerprint(path):
+    """
+    Returns a fingerprint of a file based on its size and modification time,
+    for nodes that read CSV or columnar files instead of tables.
+
+    path (str): location of the file
+    """
+
+    stat = os.stat(path)
+
+    return (path, stat.st_size, stat.st_mtime_ns)
+
+
+def _referenced_names(code):
+    """
+    Returns the global names a code object and the functions, lambdas and
+    comprehensions nested in it load, and the (module, name) pairs of its
+    from ... import statements.
+    """
+
+    import dis
+
+    names = set()
+    imports = set()
+    module = None
+
+    for instruction in dis.get_instructions(code):
+        if instruction.opname in ('LOAD_GLOBAL', 'LOAD_NAME'):
+            names.add(instruction.argval)
+        elif instruction.opname == 'IMPORT_NAME':
+            module = instruction.argval
+        elif instruction.opname == 'IMPORT_FROM' and module is not None:
+            imports.add((module, instruction.argval))
+
+    for const in code.co_consts:
+        if hasattr(const, 'co_code'):
+            nested_names, nested_imports = _referenced_names(const)
+            names |= nested_names
+            imports |= nested_imports
+
+    return names, imports
+
+
+def _is_local_module(module, directory):
+    import importlib.util
+
+    try:
+        spec = importlib.util.find_spec(module)
+    except (ImportError, ValueError):
+        return False
+
+    origin = getattr(spec, 'origin', None)
+    return origin is not None and os.path.dirname(os.path.abspath(origin)) == directory
+
+
+def _value_fingerprint(value, seen):
+    import inspect
+
+    if inspect.isfunction(value):
+        return _function_fingerprint(value, seen)
+    if isinstance(value, (str, bytes, int, float, bool, type(None))):
+        return repr(value)
+    if isinstance(value, (tuple, list, frozenset, set, dict)):
+        try:
+            return repr(sorted(value.items()) if isinstance(value, dict) else value)
+        except TypeError:
+            return None
+
+    # Modules, classes and objects such as the engine don't change results
+    # in ways their repr would capture
+    return None
+
+
+def _function_fingerprint(func, seen=None):
+    """
+    Returns a string that changes whenever func's behavior might: its source
+    along with the values of the constants (ie SQL query strings) and the
+    source of the functions it uses, whether they are module globals, values
+    of its closure or imported inside it from a module next to its own.
+    Functions are followed recursively, so a node calling a helper that
+    reads a query constant changes key when the query is edited.
+
+    func (function): function to fingerprint
+
+    seen (dict): fingerprints by qualified name, shared between the calls
+    computing one set of cache keys so helpers are only read once
+    """
+
+    import importlib
+    import inspect
+
+    seen = {} if seen is None else seen
+    qualified_name = f'{func.__module__}.{func.__qualname__}'
+    if qualified_name in seen:
+        # Already fingerprinted, or a recursive call still in progress
+        return seen[qualified_name]
+    seen[qualified_name] = qualified_name
+
+    try:
+        source = inspect.getsource(func)
+    except (OSError, TypeError):
+        source = func.__code__.co_code.hex()
+
+    parts = [f'{qualified_name}:{source}']
+    names, imports = _referenced_names(func.__code__)
+
+    for name in sorted(names):
+        if name in func.__globals__:
+            parts.append(f'{name}={_value_fingerprint(func.__globals__[name], seen)}')
+
+    for name, cell in zip(func.__code__.co_freevars, func.__closure__ or ()):
+        try:
+            value = cell.cell_contents
+        except ValueError:
+            continue
+        parts.append(f'{name}={_value_fingerprint(value, seen)}')
+
+    # Only modules of this project are imported to be fingerprinted, so
+    # computing keys never loads the heavy libraries the nodes use
+    module_file = getattr(inspect.getmodule(func), '__file__', None)
+    if module_file is not None:
+        directory = os.path.dirname(os.path.abspath(module_file))
+        for module, name in sorted(imports):
+            if _is_local_module(module, directory):
+                value = getattr(importlib.import_module(module), name, None)
+                parts.append(f'{module}.{name}={_value_fingerprint(value, seen)}')
+
+    fingerprint = hashlib.sha256('\n'.join(parts).encode()).hexdigest()
+    seen[qualified_name] = fingerprint
+
+    return fingerprint
+
+
+class AnalysisDAG:
+    """
+    Small dependency-aware runner for analysis products.  Each product is a
+    node with declared inputs: tables (or files) it reads, other nodes whose
+    results it receives as keyword arguments, and parameters.  Results are
+    pickled to cache_dir under a key hashed from the node's source code and
+    the constants and functions it uses (see _function_fingerprint),
+    parameters, table fingerprints and the keys of its inputs, so only nodes
+    whose inputs changed are re-executed.  Independent stale nodes run
+    concurrently in a thread pool.
+
+    cache_dir (str): directory the memoized results are written to
+
+    optimize_dtypes (bool): store DataFrame results with compact dtypes, see
+    dtype_funcs.optimize_dtypes, so they take less memory and disk
+    """
+
+    def __init__(self, cache_dir='.analysis_cache', optimize_dtypes=False):
+        self.cache_dir = cache_dir
+        self.optimize_dtypes = optimize_dtypes
+        self.nodes = {}
+        self.sources = {}
+        self.last_run = {}
+
+    def add_source(self, name, fingerprint):
+        """
+        Registers a table or file that nodes can depend on.
+
+        name (str): name used in a node's tables list
+
+        fingerprint (callable): returns a value that changes whenever the
+        source's contents change, ie lambda: table_fingerprint(engine, name)
+        """
+
+        self.sources[name] = fingerprint
+
+    def node(self, name=None, inputs=(), tables=(), params=None):
+        """
+        Decorator registering a function as a node.  The function is called
+        with the results of its input nodes and its parameters as keyword
+        arguments.
+
+        name (str): node name, defaults to the function name
+
+        inputs (list of str): names of nodes whose results are passed in
+
+        tables (list of str): names of sources registered with add_source
+        the node reads from
+
+        params (dict): parameters passed to the function and hashed into
+        its cache key
+        """
+
+        def register(func):
+            node_name = name or func.__name__
+            if node_name in self.nodes:
+                raise ValueError(f"Node '{node_name}' is already defined")
+
+            self.nodes[node_name] = {'func': func,
+                                     'inputs': tuple(inputs),
+                                     'tables': tuple(tables),
+                                     'params': dict(params or {})}
+            return func
+
+        return register
+
+    def set_params(self, name, **params):
+        """
+        Overrides parameters of an existing node.
+        """
+
+        self.nodes[name]['params'].update(params)
+
+    def _dependencies(self, targets):
+        order = []
+        visiting = set()
+        visited = set()
+
+        def visit(node_name):
+            if node_name in visited:
+                return
+            if node_name in visiting:
+                raise ValueError(f"Cycle detected at node '{node_name}'")
+            if node_name not in self.nodes:
+                raise KeyError(f"Unknown node '{node_name}'")
+
+            visiting.add(node_name)
+            for input_name in self.nodes[node_name]['inputs']:
+                visit(input_name)
+            visiting.discard(node_name)
+
+            visited.add(node_name)
+            order.append(node_name)
+
+        for target in targets:
+            visit(target)
+
+        return order
+
+    def _cache_keys(self, order):
+        table_versions = {}
+        function_fingerprints = {}
+        keys = {}
+
+        for node_name in order:
+            node = self.nodes[node_name]
+
+            for table in node['tables']:
+                if table not in table_versions:
+                    table_versions[table] = self.sources[table]()
+
+            key_parts = [_function_fingerprint(node['func'], function_fingerprints),
+                         repr(sorted(node['params'].items())),
+                         repr([(table, table_versions[table]) for table in node['tables']]),
+                         repr([keys[input_name] for input_name in node['inputs']]),
+                         repr(self.optimize_dtypes)]
+
+            keys[node_name] = hashlib.sha256('\n'.join(key_parts).encode()).hexdigest()
+
+        return keys
+
+    def _cache_path(self, node_name, key):
+        return os.path.join(self.cache_dir, f'{node_name}-{key[:16]}.pkl')
+
+    def _load(self, node_name, key):
+        with open(self._cache_path(node_name, key), 'rb') as f:
+            return pickle.load(f)
+
+    def _store(self, node_name, key, result):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        path = self._cache_path(node_name, key)
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(result, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+
+    def stale_nodes(self, targets=None):
+        """
+        Returns the names of the nodes needed for targets that have no
+        memoized result for their current inputs.
+
+        targets (list of str): node names, defaults to every node
+        """
+
+        order = self._dependencies(targets or list(self.nodes))
+        keys = self._cache_keys(order)
+
+        return [node_name for node_name in order
+                if not os.path.exists(self._cache_path(node_name, keys[node_name]))]
+
+    def run(self, targets=None, max_workers=4, force=False):
+        """
+        Computes the targets, executing only stale nodes and loading
+        everything else from the cache.  Returns a dict mapping each target
+        to its result.  Timing and whether each node was executed or loaded
+        is recorded in last_run.
+
+        targets (list of str): node names, defaults to every node
+
+        max_workers (int): number of stale nodes allowed to run concurrently
+
+        force (bool): re-execute every needed node, ignoring the cache
+        """
+
+        from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+        from metrics_funcs import ANALYSIS_CACHE, ANALYSIS_RUN_SECONDS
+
+        if self.optimize_dtypes:
+            import pandas as pd
+            from dtype_funcs import optimize_dtypes
+
+        run_start = time.perf_counter()
+        targets = list(targets or self.nodes)
+        order = self._dependencies(targets)
+        keys = self._cache_keys(order)
+
+        needed = set(targets)
+        to_execute = set()
+        for node_name in reversed(order):
+            if node_name in needed and (force or not os.path.exists(
+                    self._cache_path(node_name, keys[node_name]))):
+                to_execute.add(node_name)
+                needed.update(self.nodes[node_name]['inputs'])
+
+        results = {}
+        self.last_run = {}
+
+        for node_name in order:
+            if node_name in needed and node_name not in to_execute:
+                start = time.perf_counter()
+                results[node_name] = self._load(node_name, keys[node_name])
+                self.last_run[node_name] = {'status': 'cached',
+                                            'seconds': time.perf_counter() - start}
+
+        pending = [node_name for node_name in order if node_name in to_execute]
+
+        def execute(node_name):
+            node = self.nodes[node_name]
+            start = time.perf_counter()
+            kwargs = {input_name: results[input_name] for input_name in node['inputs']}
+            kwargs.update(node['params'])
+
+            result = node['func'](**kwargs)
+            if self.optimize_dtypes and isinstance(result, pd.DataFrame):
+                result = optimize_dtypes(result)
+            self._store(node_name, keys[node_name], result)
+
+            return result, time.perf_counter() - start
+
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            running = {}
+
+            while pending or running:
+                for node_name in list(pending):
+                    if all(input_name in results
+                           for input_name in self.nodes[node_name]['inputs']):
+                        pending.remove(node_name)
+                        running[pool.submit(execute, node_name)] = node_name
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    node_name = running.pop(future)
+                    results[node_name], seconds = future.result()
+                    self.last_run[node_name] = {'status': 'executed',
+                                                'seconds': seconds}
+
+        statuses = [record['status'] for record in self.last_run.values()]
+        ANALYSIS_CACHE.labels('hit').inc(statuses.count('cached'))
+        ANALYSIS_CACHE.labels('miss').inc(statuses.count('executed'))
+        ANALYSIS_RUN_SECONDS.observe(time.perf_counter() - run_start)
+
+        return {target: results[target] for target in targets}
+
+    def clear_cache(self):
+        """
+        Deletes every memoized result in cache_dir.
+        """
+
+        if not os.path.isdir(self.cache_dir):
+            return
+
+        for file_name in os.listdir(self.cache_dir):
+            if file_name.endswith('.pkl'):
+                os.remove(os.path.join(self.cache_dir, file_name))
@@ -0,0 +1,470 @@
+from analysis_dag_funcs import AnalysisDAG, table_fingerprint
+
+
+QUANTITATIVE_SUMMARY_STATS_QUERY = """
+WITH daily_points AS (
+  SELECT event_date
+       , SUM(points) AS points_per_event
+    FROM event_performance
+GROUP BY event_date
+),
+
+summary_stats AS (
+  SELECT ROUND(AVG(points_per_event)
+                ) AS avg_tot_pts_per_event
+       , ROUND(STDDEV(points_per_event)
+                ) AS std_dev_tot_pts_per_event
+       , MIN(points_per_event) AS min_event_pts
+       , PERCENTILE_CONT(0.25)
+           WITHIN GROUP (ORDER BY points_per_event) AS q1_event_pts
+       , PERCENTILE_CONT(0.5)
+           WITHIN GROUP (ORDER BY points_per_event) AS median_event_pts
+       , PERCENTILE_CONT(0.75)
+           WITHIN GROUP (ORDER BY points_per_event) AS q3_event_pts
+       , MAX(points_per_event) AS max_event_pts
+    FROM daily_points
+    ),
+
+row_summary_stats AS (
+
+  SELECT 1 AS num
+       , 'num_gaming_events' AS statistic
+       , COUNT(DISTINCT event_date) AS value
+    FROM event_performance
+   UNION
+  SELECT 2
+       , 'num_unique_users'
+       , COUNT(userid)
+    FROM users
+   UNION
+  SELECT 3
+       , 'participating_users_pct'
+       , ROUND((SELECT COUNT(DISTINCT userid) FROM event_performance)::NUMERIC /
+           (SELECT COUNT(userid) FROM users), 4) * 100
+   UNION
+  SELECT 4 AS num
+       , 'avg_tot_pts_per_event'
+       , avg_tot_pts_per_event
+    FROM summary_stats
+   UNION
+  SELECT 5
+       , 'std_dev_tot_pts_per_event'
+       , std_dev_tot_pts_per_event
+    FROM summary_stats
+   UNION
+  SELECT 6
+       , 'min_event_pts'
+       , min_event_pts
+    FROM summary_stats
+   UNION
+  SELECT 7
+       , 'q1_event_pts'
+       , q1_event_pts
+    FROM summary_stats
+   UNION
+  SELECT 8
+       , 'median_event_pts'
+       , median_event_pts
+    FROM summary_stats
+   UNION
+  SELECT 9
+       , 'q3_event_pts'
+       , q3_event_pts
+    FROM summary_stats
+   UNION
+  SELECT 10
+       , 'max_event_pts'
+       , max_event_pts
+    FROM summary_stats
+   UNION
+  SELECT 11
+       , 'range'
+       , max_event_pts - min_event_pts
+    FROM summary_stats
+  )
+
+  SELECT statistic
+       , value
+    FROM row_summary_stats
+ORDER BY num;
+"""
+
+ATTRIBUTE_FREQUENCIES_QUERY = """
+  SELECT subscriber::text AS attribute
+       , COUNT(userid) AS num_users
+       , ROUND(COUNT(userid):: NUMERIC /
+            SUM(COUNT(userid)) OVER (), 4) AS rel_freq
+    FROM users
+GROUP BY subscriber
+UNION
+  SELECT category AS attribute
+       , COUNT(userid) AS num_users
+       , ROUND(COUNT(userid)::NUMERIC /
+            SUM(COUNT(userid)) OVER (), 4) AS rel_freq
+    FROM users
+GROUP BY category
+ORDER BY 1;
+"""
+
+USER_PROFILE_FREQUENCIES_QUERY = """
+  SELECT subscriber
+       , category
+       , COUNT(userid) AS num_users
+       , ROUND(COUNT(userid):: NUMERIC /
+            SUM(COUNT(userid)) OVER (), 4) AS rel_freq
+    FROM users
+GROUP BY subscriber, category
+ORDER BY subscriber, category;
+"""
+
+USER_TYPE_FREQUENCIES_QUERY = """
+WITH user_types AS (
+  SELECT userid, 'total_points_positive' AS user_type
+    FROM event_performance
+GROUP BY userid
+  HAVING SUM(points) > 0
+   UNION
+  SELECT userid, 'total_points_negative'
+    FROM event_performance
+GROUP BY userid
+  HAVING SUM(points) < 0
+   UNION
+  SELECT userid, 'total_points_zero'
+    FROM event_performance
+GROUP BY userid
+  HAVING SUM(points) = 0
+  )
+
+  SELECT user_type
+       , COUNT(user_type) AS num_users
+       , ROUND(COUNT(user_type)::NUMERIC /
+           SUM(COUNT(user_type)) OVER (), 4) AS rel_freq
+    FROM user_types
+GROUP BY user_type
+ORDER BY num_users DESC;
+"""
+
+TOTAL_POINTS_PER_MONTH_QUERY = """
+  SELECT DATE_TRUNC('month', event_date)::date AS month
+       , SUM(points) AS total_points
+    FROM event_performance
+GROUP BY DATE_TRUNC('month', event_date)::date
+ORDER BY 1;
+"""
+
+TOTAL_USERS_PER_MONTH_QUERY = """
+  SELECT DATE_TRUNC('month', event_date)::date AS month
+       , COUNT(DISTINCT userid) AS total_users
+    FROM event_performance
+GROUP BY DATE_TRUNC('month', event_date)::date
+ORDER BY 1;
+"""
+
+USER_TYPE_POINTS_PER_MONTH_QUERY = """
+WITH user_totals AS (
+  SELECT userid
+       , SUM(points) AS total_points
+    FROM event_performance
+GROUP BY userid
+  )
+
+  SELECT DATE_TRUNC('month', ep.event_date)::date AS month
+       , SUM(ep.points) FILTER (WHERE ut.total_points > 0) AS total_positive_points
+       , SUM(ep.points) FILTER (WHERE ut.total_points < 0) AS total_negative_points
+    FROM event_performance AS ep
+    JOIN user_totals AS ut
+      ON ep.userid = ut.userid
+GROUP BY DATE_TRUNC('month', ep.event_date)::date
+ORDER BY 1;
+"""
+
+HOURLY_POINTS_BY_SEASON_QUERY = """
+  SELECT CASE
+            WHEN EXTRACT(MONTH FROM event_date) IN (3, 4, 5) THEN 'spring'
+            WHEN EXTRACT(MONTH FROM event_date) IN (6, 7, 8) THEN 'summer'
+            WHEN EXTRACT(MONTH FROM event_date) IN (9, 10, 11) THEN 'fall'
+            ELSE 'winter'
+        END AS season
+       , hour
+       , SUM(points) AS points
+    FROM event_performance
+GROUP BY 1, 2
+ORDER BY 1, 2;
+"""
+
+USERS_ATTRIBUTES_AND_TOT_POINTS_QUERY = """
+WITH total_points_per_user AS (
+   SELECT userid
+        , SUM(points) AS total_points
+     FROM event_performance
+ GROUP BY userid
+  )
+
+   SELECT u.userid
+        , u.subscriber
+        , u.category
+        , COALESCE(tp.total_points, 0) AS total_points
+     FROM users AS u
+LEFT JOIN total_points_per_user AS tp
+       ON u.userid = tp.userid;
+"""
+
+
+SEGMENT_COLUMNS = ('subscriber', 'category')
+
+
+def parse_segment(segment):
+    """
+    Parses a segment filter of the form 'column=value', ie 'subscriber=1' or
+    'category=US', into a (column, value) tuple.  Only user attribute
+    columns are accepted and values are limited to letters, digits and
+    underscores, since they get inlined into SQL.  check_segment checks the
+    value against the users table.
+
+    segment (str): segment filter, or None for every user
+    """
+
+    import re
+
+    if segment is None:
+        return None
+
+    column, _, value = segment.partition('=')
+    column = column.strip()
+    value = value.strip()
+
+    if column not in SEGMENT_COLUMNS:
+        raise ValueError(f"Segment column must be one of {SEGMENT_COLUMNS}, got '{column}'")
+    if column == 'subscriber' and value not in ('0', '1'):
+        raise ValueError("subscriber segment must be 0 or 1")
+    if column == 'category' and not re.fullmatch(r'\w+', value):
+        raise ValueError(f"category segment must be a category name, got '{value}'")
+
+    return (column, int(value) if column == 'subscriber' else value)
+
+
+def check_segment(engine, segment):
+    """
+    Raises a ValueError naming the values present when a segment matches no
+    users, since every product of an empty segment would be empty and the
+    models can't be fitted.
+
+    engine (sql alchemy engine object or LocalDatabase): Used to establish a
+    connection to the db
+
+    segment (tuple): (column, value) as returned by parse_segment
+    """
+
+    from sql_query_helper_funcs import sql_query_to_pandas_df
+
+    if segment is None:
+        return
+
+    column, value = segment
+    values = sql_query_to_pandas_df(f"SELECT DISTINCT {column} AS value FROM users ORDER BY 1;",
+                                    engine)['value'].tolist()
+
+    if value not in values:
+        raise ValueError(f"No users have {column}={value}, "
+                         f"the values present are {', '.join(map(str, values))}")
+
+
+def scope_query(sql_query, start_date=None, end_date=None, segment=None):
+    """
+    Restricts a query over event_performance and users to a date range and
+    user segment without rewriting it.  Filtered CTEs named event_performance
+    and users are prepended, shadowing the tables for the rest of the query.
+    Returns the query unchanged when no filters are given.
+
+    sql_query (string): a string containing a query in SQL syntax
+
+    start_date, end_date (str or date): inclusive bounds on event_date
+
+    segment (tuple): (column, value) as returned by parse_segment
+    """
+
+    import datetime
+
+    conditions = []
+    if start_date is not None:
+        start_date = datetime.date.fromisoformat(str(start_date))
+        conditions.append(f"ep.event_date >= DATE '{start_date}'")
+    if end_date is not None:
+        end_date = datetime.date.fromisoformat(str(end_date))
+        conditions.append(f"ep.event_date <= DATE '{end_date}'")
+
+    ctes = []
+    if segment is not None:
+        column, value = segment
+        literal = value if column == 'subscriber' else f"'{value}'"
+        ctes.append(f"""users AS (
+  SELECT *
+    FROM public.users
+   WHERE {column} = {literal}
+  )""")
+        conditions.append("ep.userid IN (SELECT userid FROM users)")
+
+    if not conditions:
+        return sql_query
+
+    ctes.append(f"""event_performance AS (
+  SELECT ep.*
+    FROM public.event_performance AS ep
+   WHERE {' AND '.join(conditions)}
+  )""")
+
+    stripped = sql_query.lstrip('\n')
+    if stripped.lstrip()[:4].upper() == 'WITH':
+        return 'WITH ' + ',\n\n'.join(ctes) + ',\n\n' + stripped.lstrip()[4:].lstrip()
+
+    return 'WITH ' + ',\n\n'.join(ctes) + '\n\n' + stripped
+
+
+def build_analysis_dag(engine,
+                       cache_dir='.analysis_cache',
+                       start_date=None,
+                       end_date=None,
+                       segment=None,
+                       optimize_dtypes=False):
+    """
+    Defines the part 2 and part 3 analysis products as nodes of an
+    AnalysisDAG.  Tables are fingerprinted through the statistics collector,
+    so products are only re-pulled from the database after the tables they
+    read have changed.  Returns the AnalysisDAG.
+
+    engine (sql alchemy engine object): Used to establish a connection to the db
+
+    cache_dir (str): directory the memoized results are written to
+
+    start_date, end_date (str or date): optional inclusive bounds on
+    event_date applied to every product
+
+    segment (str): optional 'column=value' user segment applied to every
+    product, see parse_segment.  Segments matching no users raise a
+    ValueError.
+
+    optimize_dtypes (bool): store products with compact dtypes
+    """
+
+    from sql_query_helper_funcs import sql_query_to_pandas_df
+
+    dag = AnalysisDAG(cache_dir, optimize_dtypes=optimize_dtypes)
+
+    # Part of every SQL node's parameters so differently scoped runs are
+    # cached separately
+    scope = {'start_date': start_date,
+             'end_date': end_date,
+             'segment': parse_segment(segment)}
+    check_segment(engine, scope['segment'])
+
+    def query(sql_query, scope, **kwargs):
+        return sql_query_to_pandas_df(scope_query(sql_query, **scope),
+                                      engine,
+                                      **kwargs)
+
+    for table in ['users', 'event_performance']:
+        dag.add_source(table, lambda table=table: table_fingerprint(engine, table))
+
+    @dag.node(tables=['users', 'event_performance'], params={'scope': scope})
+    def quantitative_summary_stats(scope):
+        return query(QUANTITATIVE_SUMMARY_STATS_QUERY,
+                     scope,
+                     index_column='statistic')
+
+    @dag.node(tables=['users'], params={'scope': scope})
+    def attribute_frequencies(scope):
+        return query(ATTRIBUTE_FREQUENCIES_QUERY,
+                     scope,
+                     index_column='attribute')
+
+    @dag.node(tables=['users'], params={'scope': scope})
+    def user_profile_frequencies(scope):
+        return query(USER_PROFILE_FREQUENCIES_QUERY,
+                     scope,
+                     index_column=['subscriber', 'category'])
+
+    @dag.node(tables=['event_performance'], params={'scope': scope})
+    def user_type_frequencies(scope):
+        return query(USER_TYPE_FREQUENCIES_QUERY,
+                     scope,
+                     index_column='user_type')
+
+    @dag.node(tables=['event_performance'], params={'scope': scope})
+    def total_points_per_month(scope):
+        return query(TOTAL_POINTS_PER_MONTH_QUERY,
+                     scope,
+                     index_column='month',
+                     dates_column='month')
+
+    @dag.node(tables=['event_performance'], params={'scope': scope})
+    def total_users_per_month(scope):
+        return query(TOTAL_USERS_PER_MONTH_QUERY,
+                     scope,
+                     index_column='month',
+                     dates_column='month')
+
+    @dag.node(tables=['event_performance'], params={'scope': scope})
+    def user_type_points_per_month(scope):
+        return query(USER_TYPE_POINTS_PER_MONTH_QUERY,
+                     scope,
+                     index_column='month',
+                     dates_column='month')
+
+    @dag.node(inputs=['user_type_points_per_month'])
+    def users_total_positive_points_per_month(user_type_points_per_month):
+        return user_type_points_per_month[['total_positive_points']]
+
+    @dag.node(inputs=['user_type_points_per_month'])
+    def users_total_negative_points_per_month(user_type_points_per_month):
+        return user_type_points_per_month[['total_negative_points']]
+
+    @dag.node(tables=['event_performance'], params={'scope': scope})
+    def hourly_point_totals_by_season(scope):
+        return query(HOURLY_POINTS_BY_SEASON_QUERY,
+                     scope,
+                     index_column=['season', 'hour'])
+
+    @dag.node(tables=['event_performance'], params={'scope': scope, 'window': 7})
+    def event_day_stats(scope, window):
+        from time_series_funcs import event_day_stats_query
+
+        return query(event_day_stats_query(window),
+                     scope,
+                     index_column='day',
+                     dates_column='day')
+
+    @dag.node(tables=['users', 'event_performance'], params={'scope': scope})
+    def users_attributes_and_tot_points(scope):
+        return query(USERS_ATTRIBUTES_AND_TOT_POINTS_QUERY,
+                     scope)
+
+    @dag.node(inputs=['users_attributes_and_tot_points'])
+    def linear_model_subscriber(users_attributes_and_tot_points):
+        import statsmodels.api as sm
+
+        X = sm.add_constant(users_attributes_and_tot_points.loc[:, ['subscriber']])
+        y = users_attributes_and_tot_points.loc[:, ['total_points']]
+
+        return sm.OLS(y, X).fit()
+
+    @dag.node(inputs=['users_attributes_and_tot_points'])
+    def linear_model_all(users_attributes_and_tot_points):
+        import pandas as pd
+        import statsmodels.api as sm
+
+        # One dummy per category present except the first, the baseline
+        # level.  A run segmented on category has no category dummies.
+        dummy_df = pd.get_dummies(users_attributes_and_tot_points,
+                                  columns=['category'],
+                                  drop_first=True,
+                                  dtype=float)
+
+        predictors = ['subscriber'] + [column for column in dummy_df.columns
+                                       if column.startswith('category_')]
+
+        X = sm.add_constant(dummy_df.loc[:, predictors])
+        y = dummy_df.loc[:, ['total_points']]
+
+        return sm.OLS(y, X).fit()
+
+    return dag
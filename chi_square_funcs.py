@@ -0,0 +1,159 @@
+def total_points_per_user(event_performance):
+    """
+    Aggregates event level rows down to one yearly point total per userid.
+    This is the only pass made over the event level data, everything else in
+    the chi-square pipeline works off of the per-user totals.
+
+    event_performance (Pandas DataFrame): event level rows containing at least
+    the userid and points columns
+    """
+
+    return event_performance.groupby('userid', sort=False)['points'].sum()
+
+
+def build_contingency_table(event_performance,
+                            users,
+                            attribute,
+                            user_totals=None):
+    """
+    Builds the users x outcome sign x attribute contingency table used in the
+    chi-square test for independence.  Rows are 'positive_users' and
+    'negative_users', columns are the levels of the attribute and each cell
+    holds the number of users with that combination.
+
+    Users whose yearly point total is exactly 0 and users that never
+    participated in a gaming event have no outcome sign and are excluded, as
+    are ghost userids that only show up in event_performance.
+
+    event_performance (Pandas DataFrame): event level rows containing at least
+    the userid and points columns
+
+    users (Pandas DataFrame): one row per userid along with its attributes
+
+    attribute (str): name of the column in users to cross against the sign of
+    each user's yearly point total, ie 'subscriber' or 'category'
+
+    user_totals (Pandas Series): optional, precomputed output of
+    total_points_per_user.  Pass it in when testing several attributes so the
+    event level rows only get aggregated once.
+    """
+
+    import numpy as np
+    import pandas as pd
+
+    if attribute not in users.columns:
+        raise KeyError(f"'{attribute}' is not a column in users. "
+                       f"Available columns: {list(users.columns)}")
+
+    if user_totals is None:
+        user_totals = total_points_per_user(event_performance)
+
+    attribute_by_userid = users.set_index('userid')[attribute]
+
+    user_totals, attribute_by_userid = user_totals.align(attribute_by_userid,
+                                                         join='inner')
+
+    outcome_sign = pd.Series(np.sign(user_totals.to_numpy()),
+                             index=user_totals.index)
+    has_sign = outcome_sign != 0
+
+    outcome = outcome_sign[has_sign].map({1: 'positive_users',
+                                          -1: 'negative_users'})
+
+    contingency_table = pd.crosstab(outcome.rename('user_type'),
+                                    attribute_by_userid[has_sign])
+
+    return contingency_table.reindex(['positive_users', 'negative_users'],
+                                     fill_value=0)
+
+
+def chi_square_test(event_performance,
+                    users,
+                    attribute,
+                    user_totals=None):
+    """
+    Runs a chi-square test for independence to check whether an attribute
+    and the sign of a user's yearly point total are dependent (correlated).
+    Returns a tuple of the scipy chi2_contingency result and the contingency
+    table that was tested.
+
+    event_performance (Pandas DataFrame): event level rows containing at least
+    the userid and points columns
+
+    users (Pandas DataFrame): one row per userid along with its attributes
+
+    attribute (str): name of the column in users to test
+
+    user_totals (Pandas Series): optional, precomputed output of
+    total_points_per_user
+    """
+
+    from scipy import stats
+
+    contingency_table = build_contingency_table(event_performance,
+                                                users,
+                                                attribute,
+                                                user_totals=user_totals)
+
+    return stats.chi2_contingency(contingency_table), contingency_table
+
+
+def chi_square_tests(event_performance,
+                     users,
+                     attributes):
+    """
+    Runs chi_square_test for several attributes, aggregating the event level
+    rows only once.  Returns a Pandas DataFrame indexed by attribute with the
+    chi-square statistic, p-value and degrees of freedom of each test.
+
+    event_performance (Pandas DataFrame): event level rows containing at least
+    the userid and points columns
+
+    users (Pandas DataFrame): one row per userid along with its attributes
+
+    attributes (list of str): names of the columns in users to test
+    """
+
+    import pandas as pd
+
+    user_totals = total_points_per_user(event_performance)
+
+    results = []
+    for attribute in attributes:
+        result, _ = chi_square_test(event_performance,
+                                    users,
+                                    attribute,
+                                    user_totals=user_totals)
+        results.append({'attribute': attribute,
+                        'chi2': result[0],
+                        'pvalue': result[1],
+                        'dof': result[2]})
+
+    return pd.DataFrame(results).set_index('attribute')
+
+
+def read_event_performance_csv(path='./data/clean/event_performance_clean.csv'):
+    """
+    Reads the cleaned event_performance backup CSV exported at the end of
+    part 1, parsing event_date as a date.
+
+    path (str): location of the CSV file
+    """
+
+    import pandas as pd
+
+    return pd.read_csv(path,
+                       parse_dates=['event_date'],
+                       dtype={'userid': str, 'hour': 'int64', 'points': 'int64'})
+
+
+def read_users_csv(path='./data/users.csv'):
+    """
+    Reads the users CSV file.
+
+    path (str): location of the CSV file
+    """
+
+    import pandas as pd
+
+    return pd.read_csv(path, dtype={'userid': str})
@@ -0,0 +1,187 @@
+import itertools
+
+
+SEGMENT_COLUMNS = ('subscriber', 'category')
+
+# Label used for a segment column that has been rolled up, like ALL in a
+# CUBE result
+ALL = 'All'
+
+
+def cohort_metrics_query(segments=SEGMENT_COLUMNS):
+    """
+    Returns a SQL query computing the monthly metric set for every
+    combination of the segment columns in a single CUBE pass: total points,
+    active users, and the points and user counts split by the sign of each
+    user's yearly point total.  Rolled-up segment columns come back as 'All'.
+
+    segments (tuple of str): user attribute columns to segment by
+    """
+
+    unknown = set(segments) - set(SEGMENT_COLUMNS)
+    if unknown:
+        raise ValueError(f"Unknown segment columns {sorted(unknown)}, "
+                         f"use any of {SEGMENT_COLUMNS}")
+
+    segment_selects = ''.join(
+        f"\n       , CASE WHEN GROUPING(u.{column}) = 1 THEN '{ALL}' "
+        f"ELSE u.{column}::text END AS {column}"
+        for column in segments)
+    segment_columns = ', '.join(f'u.{column}' for column in segments)
+
+    return f"""
+WITH user_totals AS (
+  SELECT userid
+       , SUM(points) AS total_points
+    FROM event_performance
+GROUP BY userid
+  )
+
+  SELECT DATE_TRUNC('month', ep.event_date)::date AS month{segment_selects}
+       , SUM(ep.points) AS total_points
+       , COUNT(DISTINCT ep.userid) AS active_users
+       , COALESCE(SUM(ep.points) FILTER (WHERE ut.total_points > 0), 0) AS positive_users_points
+       , COALESCE(SUM(ep.points) FILTER (WHERE ut.total_points < 0), 0) AS negative_users_points
+       , COUNT(DISTINCT ep.userid) FILTER (WHERE ut.total_points > 0) AS positive_users
+       , COUNT(DISTINCT ep.userid) FILTER (WHERE ut.total_points < 0) AS negative_users
+    FROM event_performance AS ep
+    JOIN users AS u
+      ON ep.userid = u.userid
+    JOIN user_totals AS ut
+      ON ep.userid = ut.userid
+GROUP BY DATE_TRUNC('month', ep.event_date), CUBE ({segment_columns})
+ORDER BY 1{''.join(f', {i + 2}' for i in range(len(segments)))};
+"""
+
+
+def _user_months(event_performance, users, segments, freq):
+    """
+    Reduces event level rows to one row per (period, userid) with the user's
+    segment attributes, points in the period and the sign of the user's
+    yearly total.  Every metric is computed from this frame, which is small
+    next to the event rows and additive across segments since a user's
+    attributes don't change.
+    """
+
+    import numpy as np
+    import pandas as pd
+
+    events = event_performance[['userid', 'event_date', 'points']]
+    period = pd.to_datetime(events['event_date']).dt.to_period(freq).dt.start_time
+
+    user_months = (events.assign(period=period)
+                         .groupby(['period', 'userid'], sort=False, observed=True)['points']
+                         .sum()
+                         .reset_index())
+
+    yearly_sign = np.sign(events.groupby('userid', sort=False)['points'].sum())
+    user_months['total_points_sign'] = user_months['userid'].map(yearly_sign)
+
+    attributes = users.set_index('userid')[list(segments)]
+    user_months = user_months.join(attributes, on='userid', how='inner')
+
+    for column in segments:
+        user_months[column] = user_months[column].astype(str)
+
+    return user_months
+
+
+def _grouping_set_metrics(user_months, keys, segments, top_n):
+    """
+    Computes the metric set for one grouping set of the CUBE, labelling the
+    segment columns that aren't in keys as rolled up.
+    """
+
+    group_by = ['period'] + list(keys)
+
+    is_positive = user_months['total_points_sign'] > 0
+    is_negative = user_months['total_points_sign'] < 0
+
+    split = user_months.assign(positive_users_points=user_months['points'].where(is_positive, 0),
+                               negative_users_points=user_months['points'].where(is_negative, 0),
+                               positive_users=is_positive,
+                               negative_users=is_negative)
+
+    metrics = split.groupby(group_by, sort=False, observed=True).agg(
+        total_points=('points', 'sum'),
+        active_users=('userid', 'size'),
+        positive_users_points=('positive_users_points', 'sum'),
+        negative_users_points=('negative_users_points', 'sum'),
+        positive_users=('positive_users', 'sum'),
+        negative_users=('negative_users', 'sum'))
+
+    if top_n:
+        top = (user_months.sort_values('points', ascending=False, kind='stable')
+                          .groupby(group_by, sort=False, observed=True)
+                          .head(top_n)
+                          .groupby(group_by, sort=False, observed=True))
+        metrics['top_userids'] = top['userid'].agg(tuple)
+        metrics['top_points'] = top['points'].agg(tuple)
+
+    metrics = metrics.reset_index()
+    for column in segments:
+        if column not in keys:
+            metrics[column] = ALL
+
+    return metrics
+
+
+def _grouping_set_metrics_star(args):
+    return _grouping_set_metrics(*args)
+
+
+def cohort_metrics(event_performance,
+                   users,
+                   segments=SEGMENT_COLUMNS,
+                   freq='M',
+                   top_n=3,
+                   workers=None):
+    """
+    Computes the monthly metric set for every combination of the segment
+    columns, the Python counterpart of cohort_metrics_query.  Event rows are
+    aggregated once to per-user-per-period rows, then every grouping set
+    (the CUBE of the segment columns) is computed from that.  With many
+    segment columns the grouping sets can be spread over a process pool.
+
+    Returns one tidy Pandas DataFrame indexed by (period, *segments), where
+    rolled-up segment columns are labelled 'All', with the columns
+    total_points, active_users, positive_users_points,
+    negative_users_points, positive_users, negative_users and, when top_n
+    is set, top_userids and top_points holding the top_n users of each
+    group.
+
+    event_performance (Pandas DataFrame): event level rows with userid,
+    event_date and points columns
+
+    users (Pandas DataFrame): one row per userid with the segment columns
+
+    segments (tuple of str): columns of users to segment by
+
+    freq (str): Pandas period frequency, ie 'M' for months or 'D' for days
+
+    top_n (int): number of top users to keep per group, 0 to skip
+
+    workers (int): spread grouping sets over this many processes, None or 1
+    computes them in this process
+    """
+
+    import pandas as pd
+
+    segments = tuple(segments)
+    user_months = _user_months(event_performance, users, segments, freq)
+
+    grouping_sets = [keys for size in range(len(segments), -1, -1)
+                     for keys in itertools.combinations(segments, size)]
+    tasks = [(user_months, keys, segments, top_n) for keys in grouping_sets]
+
+    if workers and workers > 1 and len(tasks) > 1:
+        from concurrent.futures import ProcessPoolExecutor
+
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            frames = list(pool.map(_grouping_set_metrics_star, tasks))
+    else:
+        frames = [_grouping_set_metrics_star(task) for task in tasks]
+
+    metrics = pd.concat(frames, ignore_index=True)
+
+    return metrics.set_index(['period'] + list(segments)).sort_index()
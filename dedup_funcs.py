@@ -0,0 +1,373 @@
+import os
+import shutil
+import tempfile
+
+
+# Rows with equal values in these columns describe the same user in the same
+# hour of the same gaming event
+DEDUP_KEY_COLUMNS = ['userid', 'event_date', 'hour']
+
+DEDUP_ROW_COLUMNS = ['userid', 'event_date', 'hour', 'points']
+
+# How rows sharing a key but differing elsewhere are resolved: keep the
+# first or last to arrive, keep the one with the most or fewest points, or
+# reject the key by dropping all of its rows.  Exact duplicates are always
+# collapsed to one row.
+DEDUP_POLICIES = ('first', 'last', 'max_points', 'min_points', 'reject')
+
+REPORT_COLUMNS = ['rows', 'exact_duplicates', 'key_duplicates', 'rows_kept']
+
+
+def _normalized(frame, columns):
+    """
+    Text columns with the quotes, question marks and spaces the part 1
+    cleaning strips removed, so raw and cleaned spellings of a row hash
+    alike.
+    """
+
+    import pandas as pd
+
+    normalized = {}
+    for column in columns:
+        series = frame[column]
+        if pd.api.types.is_object_dtype(series) or pd.api.types.is_string_dtype(series):
+            series = series.astype(str).str.replace(r'["? ]', '', regex=True)
+        normalized[column] = series
+
+    return pd.DataFrame(normalized)
+
+
+def _hash_columns(frame, columns):
+    import pandas as pd
+
+    return pd.util.hash_pandas_object(_normalized(frame, columns), index=False).to_numpy()
+
+
+class EventDeduplicator:
+    """
+    Streaming removal of duplicate events.  Batches are passed to add() as
+    they arrive and finish() yields whatever add() held back, so a load never
+    needs the full-table GROUP BY to find duplicates.  Keys and whole rows
+    are identified by 64-bit hashes of their normalized values.
+
+    With the 'first' policy rows are released by add() as soon as their key
+    is known to be new, and only the hashes of the keys seen so far are
+    kept, 16 bytes per key.  The other policies can only decide once every
+    row of a key has arrived, so rows are held until finish().
+
+    Memory is bounded by max_rows: once more keys or rows than that are
+    held, they are hash partitioned into Parquet files under spill_dir and
+    later batches are appended to the partitions, which finish() resolves
+    one at a time.  Rows released after spilling come out grouped by
+    partition rather than in arrival order.
+
+    policy (str): one of DEDUP_POLICIES
+
+    key_columns (list of str): columns identifying an event
+
+    row_columns (list of str): columns compared for exact duplicates
+
+    max_rows (int): keys or rows held in memory before spilling to disk
+
+    spill_dir (str): directory for the partitions, a temporary directory
+    when None
+
+    num_partitions (int): number of partitions when spilling
+    """
+
+    def __init__(self,
+                 policy='first',
+                 key_columns=DEDUP_KEY_COLUMNS,
+                 row_columns=DEDUP_ROW_COLUMNS,
+                 max_rows=5_000_000,
+                 spill_dir=None,
+                 num_partitions=32):
+        import numpy as np
+
+        if policy not in DEDUP_POLICIES:
+            raise ValueError(f"Unknown policy {policy!r}, use one of {DEDUP_POLICIES}")
+
+        self.policy = policy
+        self.key_columns = list(key_columns)
+        self.row_columns = list(row_columns)
+        self.max_rows = max_rows
+        self.spill_dir = spill_dir
+        self.num_partitions = num_partitions
+
+        self.counts = {}
+        self.num_batches = 0
+        self.num_rows = 0
+
+        # Sorted key hashes already released, with the row hash of each,
+        # for the 'first' policy
+        self._seen_keys = np.zeros(0, dtype=np.uint64)
+        self._seen_rows = np.zeros(0, dtype=np.uint64)
+
+        # Rows held back, in memory until they are spilled
+        self._held = []
+        self._held_rows = 0
+
+        self._spill_path = None
+        self._spill_files = 0
+        self._columns = None
+
+    @property
+    def spilled(self):
+        return self._spill_path is not None
+
+    def _count(self, batches, kind):
+        import numpy as np
+
+        for batch, count in zip(*np.unique(batches, return_counts=True)):
+            self.counts[int(batch)][kind] += int(count)
+
+    def _with_hashes(self, batch):
+        import numpy as np
+        import pandas as pd
+
+        batch = batch.reset_index(drop=True)
+        hashed = batch.assign(_key=_hash_columns(batch, self.key_columns),
+                              _row=_hash_columns(batch, self.row_columns),
+                              _seq=np.arange(self.num_rows, self.num_rows + len(batch)),
+                              _batch=self.num_batches)
+
+        if self.policy in ('max_points', 'min_points'):
+            hashed['_points'] = pd.to_numeric(_normalized(batch, ['points'])['points'],
+                                              errors='coerce')
+
+        return hashed
+
+    def add(self, batch):
+        """
+        Adds a batch of rows.  Returns the rows that can be released now, a
+        possibly empty Pandas DataFrame with batch's columns.
+
+        batch (Pandas DataFrame): rows holding the key and row columns
+        """
+
+        if self._columns is None:
+            self._columns = list(batch.columns)
+
+        hashed = self._with_hashes(batch)
+        self.counts[self.num_batches] = {'rows': len(batch), 'exact_duplicates': 0,
+                                         'key_duplicates': 0}
+        self.num_batches += 1
+        self.num_rows += len(batch)
+
+        if self.policy == 'first' and not self.spilled:
+            released = self._release_first(hashed)
+            if len(self._seen_keys) > self.max_rows:
+                self._spill()
+            return released
+
+        if self.spilled:
+            self._write_partitions(hashed)
+        else:
+            self._held.append(hashed)
+            self._held_rows += len(hashed)
+            if self._held_rows > self.max_rows:
+                self._spill()
+
+        return batch.iloc[:0]
+
+    def _lookup_seen(self, seen_keys, keys):
+        """
+        Returns the position of each key in the sorted seen_keys and whether
+        it's there.
+        """
+
+        import numpy as np
+
+        if len(seen_keys) == 0:
+            return np.zeros(len(keys), dtype=np.int64), np.zeros(len(keys), dtype=bool)
+
+        positions = np.minimum(np.searchsorted(seen_keys, keys), len(seen_keys) - 1)
+
+        return positions, seen_keys[positions] == keys
+
+    def _release_first(self, hashed):
+        import numpy as np
+
+        keys, rows = hashed['_key'].to_numpy(), hashed['_row'].to_numpy()
+        positions, seen = self._lookup_seen(self._seen_keys, keys)
+
+        # Each row is compared with the row its key resolves to: the one
+        # released earlier, or else the key's first row in this batch
+        first_rows = hashed.groupby('_key', sort=False)['_row'].transform('first').to_numpy()
+        winner_rows = np.where(seen, self._seen_rows[positions] if len(self._seen_rows) else 0,
+                               first_rows)
+
+        keep = ~hashed.duplicated('_key').to_numpy() & ~seen
+        exact = ~keep & (rows == winner_rows)
+        self._count(hashed['_batch'].to_numpy()[exact], 'exact_duplicates')
+        self._count(hashed['_batch'].to_numpy()[~keep & ~exact], 'key_duplicates')
+
+        new_keys = np.concatenate([self._seen_keys, keys[keep]])
+        order = np.argsort(new_keys, kind='stable')
+        self._seen_keys = new_keys[order]
+        self._seen_rows = np.concatenate([self._seen_rows, rows[keep]])[order]
+
+        return hashed.loc[keep, self._columns]
+
+    def _spill(self):
+        import numpy as np
+        import pandas as pd
+
+        if self.spill_dir is None:
+            self._spill_path = tempfile.mkdtemp(prefix='dedup-')
+        else:
+            self._spill_path = self.spill_dir
+            os.makedirs(self._spill_path, exist_ok=True)
+
+        if len(self._seen_keys):
+            partitions = self._seen_keys % self.num_partitions
+            for partition in range(self.num_partitions):
+                in_partition = partitions == partition
+                np.save(os.path.join(self._spill_path, f'seen-{partition:03d}.npy'),
+                        np.stack([self._seen_keys[in_partition], self._seen_rows[in_partition]]))
+            self._seen_keys = self._seen_keys[:0]
+            self._seen_rows = self._seen_rows[:0]
+
+        if self._held:
+            self._write_partitions(pd.concat(self._held, ignore_index=True))
+            self._held = []
+            self._held_rows = 0
+
+    def _write_partitions(self, hashed):
+        partitions = hashed['_key'].to_numpy() % self.num_partitions
+        for partition, rows in hashed.groupby(partitions):
+            rows.to_parquet(os.path.join(self._spill_path,
+                                         f'part-{partition:03d}-{self._spill_files:06d}.parquet'),
+                            index=False)
+        self._spill_files += 1
+
+    def _resolve(self, rows, seen=None):
+        """
+        Applies the policy to rows holding every not yet released row of
+        their keys.  seen is a (2, n) array of key and row hashes already
+        released under the 'first' policy.  Returns the rows to keep.
+        """
+
+        import numpy as np
+
+        rows = rows.sort_values('_seq', kind='stable')
+
+        if seen is None:
+            seen = np.zeros((2, 0), dtype=np.uint64)
+        positions, released = self._lookup_seen(seen[0], rows['_key'].to_numpy())
+
+        exact = rows.duplicated(['_key', '_row']).to_numpy()
+        if seen.shape[1]:
+            exact = exact | (released & (seen[1][positions] == rows['_row'].to_numpy()))
+        self._count(rows['_batch'].to_numpy()[exact], 'exact_duplicates')
+        rows, released = rows[~exact], released[~exact]
+
+        if self.policy == 'first':
+            keep = ~rows.duplicated('_key').to_numpy() & ~released
+        elif self.policy == 'last':
+            keep = ~rows.duplicated('_key', keep='last').to_numpy()
+        elif self.policy == 'reject':
+            keep = ~rows.duplicated('_key', keep=False).to_numpy()
+        else:
+            ascending = self.policy == 'min_points'
+            ranked = rows.sort_values(['_points', '_seq'], ascending=[ascending, True],
+                                      na_position='last', kind='stable')
+            winners = ranked.index[~ranked.duplicated('_key').to_numpy()]
+            keep = rows.index.isin(winners)
+
+        self._count(rows['_batch'].to_numpy()[~keep], 'key_duplicates')
+
+        return rows[keep]
+
+    def finish(self):
+        """
+        Resolves the rows held back and yields them as Pandas DataFrames
+        with the columns of the added batches.  Spill files are removed
+        afterwards.
+        """
+
+        import glob
+
+        import numpy as np
+        import pandas as pd
+
+        if not self.spilled:
+            if self._held:
+                kept = self._resolve(pd.concat(self._held, ignore_index=True))
+                self._held = []
+                self._held_rows = 0
+                if len(kept):
+                    yield kept[self._columns].reset_index(drop=True)
+            return
+
+        try:
+            for partition in range(self.num_partitions):
+                files = sorted(glob.glob(os.path.join(self._spill_path,
+                                                      f'part-{partition:03d}-*.parquet')))
+                seen_path = os.path.join(self._spill_path, f'seen-{partition:03d}.npy')
+                seen = np.load(seen_path) if os.path.exists(seen_path) else None
+
+                if not files:
+                    continue
+
+                kept = self._resolve(pd.concat([pd.read_parquet(file) for file in files],
+                                               ignore_index=True),
+                                     seen)
+                if len(kept):
+                    yield kept[self._columns].reset_index(drop=True)
+        finally:
+            if self.spill_dir is None:
+                shutil.rmtree(self._spill_path, ignore_errors=True)
+            else:
+                for file in (glob.glob(os.path.join(self._spill_path, 'part-*.parquet'))
+                             + glob.glob(os.path.join(self._spill_path, 'seen-*.npy'))):
+                    os.remove(file)
+            self._spill_path = None
+
+    def report(self):
+        """
+        Returns the duplicate counts of each added batch as a Pandas
+        DataFrame indexed by batch number.  Counts for rows held back are
+        only complete after finish().  While the 'first' policy streams, a
+        row only counts as an exact duplicate of the row kept for its key,
+        so when a key has both kinds of duplicates the split between the
+        two counts can differ from the other policies, but not their sum.
+        """
+
+        import pandas as pd
+
+        report = pd.DataFrame.from_dict(self.counts, orient='index',
+                                        columns=REPORT_COLUMNS[:-1]).rename_axis('batch')
+        report['rows_kept'] = (report['rows'] - report['exact_duplicates']
+                               - report['key_duplicates'])
+
+        return report
+
+
+def deduplicate_chunks(chunks, policy='first', **kwargs):
+    """
+    Removes duplicate events from a stream of chunks, ie pd.read_csv with a
+    chunksize, read_csv_sharded shards or event_chunks_from_db.  Yields
+    deduplicated Pandas DataFrames.  The EventDeduplicator is passed to
+    on_finish, when given, once the stream is exhausted so its report can
+    be read.
+
+    chunks (iterable of Pandas DataFrames): event level rows
+
+    policy (str): one of DEDUP_POLICIES
+
+    kwargs: further EventDeduplicator arguments, plus on_finish
+    """
+
+    on_finish = kwargs.pop('on_finish', None)
+    deduplicator = EventDeduplicator(policy, **kwargs)
+
+    for chunk in chunks:
+        released = deduplicator.add(chunk)
+        if len(released):
+            yield released
+
+    yield from deduplicator.finish()
+
+    if on_finish is not None:
+        on_finish(deduplicator)
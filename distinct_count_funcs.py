@@ -0,0 +1,303 @@
+import math
+
+
+def precision_for_error(relative_error):
+    """
+    Returns the smallest HyperLogLog precision (number of index bits) whose
+    standard error, 1.04 / sqrt(2 ** precision), is at most relative_error.
+
+    relative_error (float): desired standard error, ie 0.01 for ~1%
+    """
+
+    if not 0 < relative_error < 1:
+        raise ValueError('relative_error must be between 0 and 1')
+
+    precision = math.ceil(2 * math.log2(1.04 / relative_error))
+
+    return min(max(precision, 4), 18)
+
+
+def hash_userids(userids):
+    """
+    Hashes userids to unsigned 64 bit integers.  The hash is deterministic
+    across processes and runs so sketches built separately can be merged.
+
+    userids (array-like): userids to hash
+    """
+
+    import pandas as pd
+
+    return pd.util.hash_pandas_object(pd.Series(userids, dtype=object),
+                                      index=False).to_numpy()
+
+
+class HyperLogLog:
+    """
+    Mergeable HyperLogLog sketch for approximate distinct counts.  Two
+    sketches with the same precision can be merged by taking the element-wise
+    max of their registers, so a sketch per gaming event can be combined into
+    counts for any month, season or date range without rescanning events.
+
+    precision (int): number of index bits, between 4 and 18.  The sketch uses
+    2 ** precision one byte registers and has a standard error of
+    1.04 / sqrt(2 ** precision).
+    """
+
+    def __init__(self, precision=14, registers=None):
+        import numpy as np
+
+        if not 4 <= precision <= 18:
+            raise ValueError('precision must be between 4 and 18')
+
+        self.precision = precision
+        self.num_registers = 1 << precision
+
+        if registers is None:
+            registers = np.zeros(self.num_registers, dtype=np.uint8)
+        elif len(registers) != self.num_registers:
+            raise ValueError('registers do not match precision')
+
+        self.registers = registers
+
+    @classmethod
+    def from_userids(cls, userids, precision=14):
+        """
+        Builds a sketch from an array-like of userids.
+        """
+
+        sketch = cls(precision)
+        sketch.add_hashes(hash_userids(userids))
+
+        return sketch
+
+    def add_hashes(self, hashes):
+        """
+        Adds already hashed values (unsigned 64 bit integers) to the sketch.
+        """
+
+        import numpy as np
+
+        hashes = np.asarray(hashes, dtype=np.uint64)
+        if len(hashes) == 0:
+            return self
+
+        p = self.precision
+        index = (hashes >> np.uint64(64 - p)).astype(np.intp)
+        remaining = hashes << np.uint64(p)
+
+        # Leading zeros of the remaining bits, computed exactly on the two
+        # 32 bit halves since frexp is exact for integers below 2 ** 53.
+        high = (remaining >> np.uint64(32)).astype(np.float64)
+        low = (remaining & np.uint64(0xFFFFFFFF)).astype(np.float64)
+        leading_zeros = np.where(high > 0,
+                                 32 - np.frexp(high)[1],
+                                 64 - np.frexp(low)[1])
+        rank = np.minimum(leading_zeros + 1, 64 - p + 1).astype(np.uint8)
+
+        np.maximum.at(self.registers, index, rank)
+
+        return self
+
+    def add(self, userids):
+        """
+        Hashes and adds an array-like of userids to the sketch.
+        """
+
+        return self.add_hashes(hash_userids(userids))
+
+    def merge(self, other):
+        """
+        Merges another sketch into this one in place.
+        """
+
+        import numpy as np
+
+        if other.precision != self.precision:
+            raise ValueError('Cannot merge sketches with different precision')
+
+        np.maximum(self.registers, other.registers, out=self.registers)
+
+        return self
+
+    def copy(self):
+        return HyperLogLog(self.precision, self.registers.copy())
+
+    def count(self):
+        """
+        Returns the estimated number of distinct values added to the sketch.
+        """
+
+        import numpy as np
+
+        m = self.num_registers
+        if m >= 128:
+            alpha = 0.7213 / (1 + 1.079 / m)
+        else:
+            alpha = {16: 0.673, 32: 0.697, 64: 0.709}[m]
+
+        estimate = alpha * m * m / np.sum(np.ldexp(1.0, -self.registers.astype(np.int64)))
+
+        num_zero_registers = int(np.count_nonzero(self.registers == 0))
+        if estimate <= 2.5 * m and num_zero_registers > 0:
+            estimate = m * math.log(m / num_zero_registers)
+
+        return int(round(estimate))
+
+    def standard_error(self):
+        return 1.04 / math.sqrt(self.num_registers)
+
+    def to_bytes(self):
+        """
+        Serializes the sketch so it can be stored next to rollups, ie in a
+        BYTEA column or a Parquet binary column.  The first byte holds the
+        precision.
+        """
+
+        return bytes([self.precision]) + self.registers.tobytes()
+
+    @classmethod
+    def from_bytes(cls, data):
+        import numpy as np
+
+        registers = np.frombuffer(data[1:], dtype=np.uint8).copy()
+
+        return cls(data[0], registers)
+
+    def __repr__(self):
+        return f'HyperLogLog(precision={self.precision}, count~{self.count()})'
+
+
+def daily_sketches(event_performance, relative_error=0.01):
+    """
+    Builds one HyperLogLog sketch of participating userids per gaming event.
+    Returns a Pandas Series of sketches indexed by day, suitable for storing
+    with the per-day rollups (see sketches_to_frame).
+
+    event_performance (Pandas DataFrame): event level rows with userid and
+    event_date columns
+
+    relative_error (float): target standard error of distinct counts
+    """
+
+    import pandas as pd
+
+    precision = precision_for_error(relative_error)
+
+    hashes = pd.Series(hash_userids(event_performance['userid'].to_numpy()),
+                       index=pd.to_datetime(event_performance['event_date']).to_numpy())
+
+    sketches = hashes.groupby(level=0).apply(
+        lambda day_hashes: HyperLogLog(precision).add_hashes(day_hashes.to_numpy()))
+    sketches.index.name = 'day'
+
+    return sketches.rename('userid_sketch')
+
+
+def merge_sketches(sketches):
+    """
+    Merges an iterable of sketches into a new sketch.  Returns None if the
+    iterable is empty.
+
+    sketches (iterable of HyperLogLog): sketches to merge
+    """
+
+    merged = None
+    for sketch in sketches:
+        if merged is None:
+            merged = sketch.copy()
+        else:
+            merged.merge(sketch)
+
+    return merged
+
+
+def distinct_users_between(sketches, start=None, end=None):
+    """
+    Estimates the number of distinct users that participated between start
+    and end (inclusive) by merging the per-day sketches in that range.
+
+    sketches (Pandas Series): per-day sketches indexed by day, ie the output
+    of daily_sketches
+
+    start, end (str or datetime-like): optional bounds of the date range
+    """
+
+    merged = merge_sketches(sketches.loc[start:end])
+
+    return 0 if merged is None else merged.count()
+
+
+def participation_curve(sketches, freq='MS'):
+    """
+    Estimates distinct participating users per period by merging per-day
+    sketches.  Returns a Pandas Series indexed by period start.
+
+    sketches (Pandas Series): per-day sketches indexed by day
+
+    freq (str): Pandas frequency alias of the period, ie 'MS' for months or
+    'QS-DEC' for meteorological seasons
+    """
+
+    import pandas as pd
+
+    curve = sketches.groupby(pd.Grouper(freq=freq)).agg(
+        lambda period: 0 if len(period) == 0 else merge_sketches(period).count())
+
+    return curve.rename('total_users')
+
+
+def distinct_users_per_period(event_performance,
+                              freq='MS',
+                              approximate=True,
+                              relative_error=0.01):
+    """
+    Counts distinct participating users per period, either approximately via
+    per-day HyperLogLog sketches or exactly as the fallback.
+
+    event_performance (Pandas DataFrame): event level rows with userid and
+    event_date columns
+
+    freq (str): Pandas frequency alias of the period
+
+    approximate (bool): use sketches when True, exact nunique when False
+
+    relative_error (float): target standard error when approximate
+    """
+
+    import pandas as pd
+
+    if approximate:
+        return participation_curve(daily_sketches(event_performance,
+                                                  relative_error),
+                                   freq)
+
+    userids = pd.Series(event_performance['userid'].to_numpy(),
+                        index=pd.to_datetime(event_performance['event_date']).to_numpy())
+    curve = userids.groupby(pd.Grouper(freq=freq)).nunique()
+    curve.index.name = 'day'
+
+    return curve.rename('total_users')
+
+
+def sketches_to_frame(sketches):
+    """
+    Converts per-day sketches to a Pandas DataFrame with the sketch
+    serialized to bytes, so it can be written alongside the per-day rollups
+    with to_sql or to_parquet.
+
+    sketches (Pandas Series): per-day sketches indexed by day
+    """
+
+    return sketches.map(lambda sketch: sketch.to_bytes()).to_frame()
+
+
+def sketches_from_frame(frame, column='userid_sketch'):
+    """
+    Inverse of sketches_to_frame.
+
+    frame (Pandas DataFrame): serialized sketches indexed by day
+
+    column (str): name of the column holding the serialized sketches
+    """
+
+    return frame[column].map(HyperLogLog.from_bytes)
@@ -0,0 +1,246 @@
+# Text columns with at most this many distinct values per row are stored as
+# categoricals, ie season, category/country and userid in event level frames
+CATEGORY_MAX_RATIO = 0.5
+
+
+def memory_profile(df):
+    """
+    Returns a Pandas DataFrame indexed by column (plus 'Index') with the
+    dtype and deep memory usage in bytes of each column of df.
+
+    df (Pandas DataFrame): frame to measure
+    """
+
+    import pandas as pd
+
+    usage = df.memory_usage(deep=True)
+    dtypes = pd.Series({'Index': str(df.index.dtype),
+                        **{column: str(dtype) for column, dtype in df.dtypes.items()}})
+
+    return pd.DataFrame({'dtype': dtypes, 'bytes': usage})
+
+
+def memory_report(before, after):
+    """
+    Compares two memory profiles, ie of a frame before and after
+    optimize_dtypes.  Returns a Pandas DataFrame with one row per column and
+    a total row, holding the dtypes and bytes before and after and the
+    ratio of the two.
+
+    before, after (Pandas DataFrame): frames or results of memory_profile
+    """
+
+    import pandas as pd
+
+    if 'bytes' not in before.columns:
+        before = memory_profile(before)
+    if 'bytes' not in after.columns:
+        after = memory_profile(after)
+
+    report = before.join(after, lsuffix='_before', rsuffix='_after', how='outer')
+    report.loc['total'] = ['', before['bytes'].sum(), '', after['bytes'].sum()]
+
+    report[['bytes_before', 'bytes_after']] = report[['bytes_before', 'bytes_after']].astype('int64')
+    report['ratio'] = report['bytes_before'] / report['bytes_after']
+
+    return report
+
+
+def _is_text(series):
+    import pandas as pd
+
+    return (not isinstance(series.dtype, pd.CategoricalDtype)
+            and (pd.api.types.is_object_dtype(series) or pd.api.types.is_string_dtype(series))
+            and pd.api.types.infer_dtype(series, skipna=True) == 'string')
+
+
+def _string_dtype():
+    """
+    Pyarrow backed strings when pyarrow is installed, otherwise None to
+    leave text columns as they are.
+    """
+
+    try:
+        import pyarrow
+    except ImportError:
+        return None
+
+    return 'string[pyarrow]'
+
+
+def text_column_kinds(df, category_max_ratio=CATEGORY_MAX_RATIO):
+    """
+    Decides how each text column of df should be stored.  Returns a dict
+    mapping column names to 'category' for low cardinality columns and
+    'string' for the rest.
+
+    df (Pandas DataFrame): frame whose text columns are inspected
+
+    category_max_ratio (float): largest ratio of distinct values to rows
+    stored as a categorical
+    """
+
+    kinds = {}
+    for column in df.columns:
+        series = df[column]
+        if _is_text(series):
+            ratio = series.nunique() / max(len(series), 1)
+            kinds[column] = 'category' if ratio <= category_max_ratio else 'string'
+
+    return kinds
+
+
+def optimize_dtypes(df,
+                    category_max_ratio=CATEGORY_MAX_RATIO,
+                    downcast_integers=True,
+                    text_kinds=None,
+                    report=False):
+    """
+    Returns a copy of df using less memory: low cardinality text columns
+    become categoricals, other text columns pyarrow strings, and int64
+    columns are downcast to the smallest integer type holding their values.
+    Floats, dates and booleans are left alone.
+
+    Downcast integers keep their range but not headroom, so cast back to
+    int64 before arithmetic that can overflow, ie squaring points.
+
+    df (Pandas DataFrame): frame to optimize
+
+    category_max_ratio (float): largest ratio of distinct values to rows
+    stored as a categorical
+
+    downcast_integers (bool): downcast int64 columns
+
+    text_kinds (dict): decisions from text_column_kinds to use instead of
+    inspecting df, so chunks of one result are stored alike
+
+    report (bool): print a memory report comparing df and the result
+    """
+
+    import pandas as pd
+
+    if text_kinds is None:
+        text_kinds = text_column_kinds(df, category_max_ratio)
+
+    string_dtype = _string_dtype()
+    optimized = df.copy()
+
+    for column in df.columns:
+        series = df[column]
+
+        if column in text_kinds and _is_text(series):
+            if text_kinds[column] == 'category':
+                optimized[column] = series.astype('category')
+            elif string_dtype is not None:
+                optimized[column] = series.astype(string_dtype)
+
+        elif downcast_integers and pd.api.types.is_integer_dtype(series) \
+                and not pd.api.types.is_extension_array_dtype(series):
+            optimized[column] = pd.to_numeric(series, downcast='integer')
+
+    if report:
+        print(memory_report(df, optimized))
+
+    return optimized
+
+
+def optimize_chunks(chunks, category_max_ratio=CATEGORY_MAX_RATIO, downcast_integers=True):
+    """
+    Optimizes the dtypes of a stream of chunks of one result, ie from
+    pd.read_csv or pd.read_sql_query with a chunksize, as they arrive.  How
+    each text column is stored is decided from the first chunk so every
+    chunk matches.  Yields the optimized Pandas DataFrames.
+
+    chunks (iterable of Pandas DataFrames): chunks to optimize
+
+    category_max_ratio (float): largest ratio of distinct values to rows
+    stored as a categorical
+
+    downcast_integers (bool): downcast int64 columns
+    """
+
+    text_kinds = None
+    for chunk in chunks:
+        if text_kinds is None:
+            text_kinds = text_column_kinds(chunk, category_max_ratio)
+
+        yield optimize_dtypes(chunk,
+                              downcast_integers=downcast_integers,
+                              text_kinds=text_kinds)
+
+
+def concat_optimized(frames):
+    """
+    Concatenates optimized chunks into one Pandas DataFrame.  Categorical
+    columns are given the union of every chunk's categories first, since
+    pandas falls back to object columns when concatenating categoricals
+    whose categories differ.
+
+    frames (list of Pandas DataFrames): chunks from optimize_chunks
+    """
+
+    import pandas as pd
+
+    frames = list(frames)
+    if not frames:
+        return pd.DataFrame()
+
+    categorical = [column for column, dtype in frames[0].dtypes.items()
+                   if isinstance(dtype, pd.CategoricalDtype)]
+
+    for column in categorical:
+        categories = pd.api.types.union_categoricals(
+            [frame[column] for frame in frames]).categories
+        frames = [frame.assign(**{column: frame[column].cat.set_categories(categories)})
+                  for frame in frames]
+
+    # Chunks read without an index column each number their rows from 0
+    ignore_index = all(isinstance(frame.index, pd.RangeIndex) for frame in frames)
+
+    return pd.concat(frames, ignore_index=ignore_index)
+
+
+def collect_chunks(chunks,
+                   optimize=True,
+                   category_max_ratio=CATEGORY_MAX_RATIO,
+                   downcast_integers=True):
+    """
+    Builds one Pandas DataFrame from a result read whole or in chunks,
+    optimizing each chunk's dtypes as it arrives so the unoptimized result
+    is never held in memory at once.  Returns a tuple of the DataFrame and
+    the summed memory_profile of the chunks as read, for memory_report.
+
+    chunks (Pandas DataFrame or iterable of Pandas DataFrames): the result
+
+    optimize (bool): optimize dtypes, otherwise chunks are only concatenated
+
+    category_max_ratio (float): largest ratio of distinct values to rows
+    stored as a categorical
+
+    downcast_integers (bool): downcast int64 columns
+    """
+
+    import pandas as pd
+
+    if isinstance(chunks, pd.DataFrame):
+        chunks = [chunks]
+
+    raw_profile = None
+
+    def profiled(chunks):
+        nonlocal raw_profile
+        for chunk in chunks:
+            profile = memory_profile(chunk)
+            if raw_profile is None:
+                raw_profile = profile
+            else:
+                raw_profile['bytes'] = raw_profile['bytes'].add(profile['bytes'], fill_value=0)
+            yield chunk
+
+    chunks = profiled(chunks)
+    if optimize:
+        chunks = optimize_chunks(chunks, category_max_ratio, downcast_integers)
+
+    df = concat_optimized(chunks)
+
+    return df, raw_profile
@@ -0,0 +1,283 @@
+import json
+import os
+
+from event_store_funcs import SEASONS, SEASON_OF_MONTH
+
+
+CUBE_DIRECTORY = 'data/cube'
+
+# Grain of the cube, every roll-up is a coarser grouping of these
+CUBE_DIMENSIONS = ['event_date', 'hour', 'subscriber', 'category']
+
+# Coarser time buckets derived from event_date, each named like the part 2
+# products grouping by it
+TIME_GRAINS = ['day', 'week', 'month', 'quarter', 'season', 'year', 'weekday']
+
+CUBE_EVENTS_QUERY = """
+  SELECT ep.event_date
+       , ep.hour
+       , u.subscriber
+       , u.category
+       , ep.points
+    FROM event_performance AS ep
+    LEFT JOIN users AS u
+      ON ep.userid = u.userid;
+"""
+
+
+def build_cube_cells(events, compression=200):
+    """
+    Aggregates event level rows to the cube's grain: one row per
+    (event_date, hour, subscriber, category) holding the points sum, number
+    of events, sum of squared points, min and max points, and a serialized
+    t-digest of the points.  Every column combines across cells, so any
+    coarser grouping can be computed from the cells alone.  Returns a Pandas
+    DataFrame.
+
+    events (Pandas DataFrame): event level rows with the cube dimensions and
+    points, ie the result of CUBE_EVENTS_QUERY
+
+    compression (float): digest size parameter
+    """
+
+    import pandas as pd
+    from quantile_sketch_funcs import TDigest
+
+    events = events.assign(event_date=pd.to_datetime(events['event_date']),
+                           points=events['points'].astype('int64'))
+    events['sq_points'] = events['points'] ** 2
+
+    # Events of users missing from users keep null attributes rather than
+    # dropping out, so cube totals match event_performance
+    cells = events.groupby(CUBE_DIMENSIONS, observed=True, dropna=False).agg(
+        points=('points', 'sum'),
+        events=('points', 'size'),
+        sum_sq_points=('sq_points', 'sum'),
+        min_points=('points', 'min'),
+        max_points=('points', 'max'))
+
+    sketches = events.groupby(CUBE_DIMENSIONS, observed=True, dropna=False)['points'].agg(
+        lambda values: TDigest.from_values(values.to_numpy(), compression).to_bytes())
+    cells['points_sketch'] = sketches
+
+    return cells.reset_index()
+
+
+def build_event_cube(engine, directory=CUBE_DIRECTORY, compression=200):
+    """
+    Builds the cube from the clean event_performance and users tables and
+    saves it to directory with the fingerprints of both tables, so
+    refresh_event_cube can tell when a load has changed them.  Returns the
+    EventCube.
+
+    engine (sql alchemy engine object): Used to establish a connection to the db
+
+    directory (str): location of the cube
+
+    compression (float): digest size parameter
+    """
+
+    from analysis_dag_funcs import table_fingerprint
+    from sql_query_helper_funcs import sql_query_to_pandas_df
+
+    fingerprints = {table: table_fingerprint(engine, table)
+                    for table in ['event_performance', 'users']}
+
+    events = sql_query_to_pandas_df(CUBE_EVENTS_QUERY, engine)
+
+    cells = build_cube_cells(events, compression)
+
+    os.makedirs(directory, exist_ok=True)
+    cells.to_parquet(os.path.join(directory, 'cells.parquet'), index=False)
+    with open(os.path.join(directory, 'cube.json'), 'w') as f:
+        json.dump({'fingerprints': fingerprints, 'compression': compression}, f)
+
+    return EventCube(cells)
+
+
+def refresh_event_cube(engine, directory=CUBE_DIRECTORY, compression=200):
+    """
+    Opens the cube saved in directory, rebuilding it first if
+    event_performance or users changed since it was built.  Meant to run
+    after each load.  Returns the EventCube.
+
+    engine (sql alchemy engine object): Used to establish a connection to the db
+
+    directory (str): location of the cube
+
+    compression (float): digest size parameter
+    """
+
+    from analysis_dag_funcs import table_fingerprint
+
+    path = os.path.join(directory, 'cube.json')
+    if os.path.exists(path):
+        with open(path) as f:
+            saved = json.load(f)
+
+        current = {table: table_fingerprint(engine, table) for table in saved['fingerprints']}
+        # JSON turns the fingerprint tuples into lists
+        if all(saved['fingerprints'][table] == (None if fingerprint is None else list(fingerprint))
+               for table, fingerprint in current.items()):
+            return open_event_cube(directory)
+
+    return build_event_cube(engine, directory, compression)
+
+
+def open_event_cube(directory=CUBE_DIRECTORY):
+    """
+    Opens the cube saved in directory.  Returns an EventCube.
+
+    directory (str): location of the cube
+    """
+
+    import pandas as pd
+
+    return EventCube(pd.read_parquet(os.path.join(directory, 'cells.parquet')))
+
+
+class EventCube:
+    """
+    Pre-aggregated points at (event_date, hour, subscriber, category) grain
+    with a roll-up API for coarser groupings.  The cells number a few per
+    hour of each gaming event whatever the number of events, so roll-ups
+    take milliseconds and don't touch the event_performance table.
+
+    Points totals, event counts, means, standard deviations, min and max
+    roll up exactly.  Quantiles are estimated by merging the cells'
+    t-digests.  Distinct user counts don't roll up from cells, so they aren't
+    part of the cube.
+
+    cells (Pandas DataFrame): output of build_cube_cells
+    """
+
+    def __init__(self, cells):
+        import pandas as pd
+
+        cells = cells.copy()
+        day = pd.to_datetime(cells['event_date'])
+
+        cells['day'] = day
+        cells['week'] = day - pd.to_timedelta(day.dt.dayofweek, unit='D')
+        cells['month'] = day.dt.to_period('M').dt.start_time
+        cells['quarter'] = day.dt.to_period('Q').dt.start_time
+        cells['season'] = pd.Categorical.from_codes(
+            [SEASON_OF_MONTH[month - 1] for month in day.dt.month], SEASONS)
+        cells['year'] = day.dt.year
+        cells['weekday'] = day.dt.dayofweek
+
+        self.cells = cells
+        self._digests = None
+
+    def _sketches(self):
+        """
+        Returns the cells' digests, deserialized the first time quantiles
+        are asked for.
+        """
+
+        import pandas as pd
+        from quantile_sketch_funcs import TDigest
+
+        if self._digests is None:
+            self._digests = pd.Series([TDigest.from_bytes(blob)
+                                       for blob in self.cells['points_sketch']],
+                                      index=self.cells.index)
+
+        return self._digests
+
+    def __len__(self):
+        return len(self.cells)
+
+    def _filter(self, start=None, end=None, where=None):
+        import pandas as pd
+
+        if start is None and end is None and not where:
+            return self.cells
+
+        mask = pd.Series(True, index=self.cells.index)
+        if start is not None:
+            mask &= self.cells['day'] >= pd.Timestamp(start)
+        if end is not None:
+            mask &= self.cells['day'] <= pd.Timestamp(end)
+
+        for column, values in (where or {}).items():
+            if isinstance(values, (list, tuple, set)):
+                mask &= self.cells[column].isin(values)
+            else:
+                mask &= self.cells[column] == values
+
+        return self.cells[mask]
+
+    def rollup(self, by=(), start=None, end=None, where=None, quantiles=None):
+        """
+        Aggregates the cells to a coarser grouping.  Returns a Pandas
+        DataFrame indexed by the by columns, or a single row when by is
+        empty, with the columns points, events, mean_points, std_points,
+        min_points and max_points, plus one column per quantile.
+
+        by (str or list of str): any of TIME_GRAINS, hour, subscriber and
+        category, ie ['month'] or ['season', 'hour']
+
+        start, end (str or datetime-like): optional inclusive bounds of the
+        event_date range
+
+        where (dict): filters on cube columns, each mapping a column to a
+        value or a list of values, ie {'category': ['A', 'B']}
+
+        quantiles (list of float): points quantiles to estimate per group,
+        named like p50_points
+        """
+
+        import numpy as np
+        import pandas as pd
+
+        by = [by] if isinstance(by, str) else list(by)
+        unknown = set(by) - set(TIME_GRAINS) - set(CUBE_DIMENSIONS)
+        if unknown:
+            raise ValueError(f"Unknown roll-up columns {sorted(unknown)}, use any of "
+                             f"{TIME_GRAINS + CUBE_DIMENSIONS[1:]}")
+
+        cells = self._filter(start, end, where)
+        keys = by if by else np.zeros(len(cells), dtype=np.int8)
+        groups = cells.groupby(keys, observed=True, sort=True, dropna=False)
+
+        rolled = groups[['points', 'events', 'sum_sq_points']].sum()
+        rolled['min_points'] = groups['min_points'].min()
+        rolled['max_points'] = groups['max_points'].max()
+
+        rolled.insert(2, 'mean_points', rolled['points'] / rolled['events'])
+        variance = ((rolled['sum_sq_points'] - rolled['points'] ** 2 / rolled['events'])
+                    / (rolled['events'] - 1))
+        rolled.insert(3, 'std_points', np.sqrt(variance.clip(lower=0)))
+        rolled = rolled.drop(columns='sum_sq_points')
+
+        if quantiles:
+            from quantile_sketch_funcs import merge_sketches
+
+            merged = self._sketches()[cells.index].groupby(
+                [cells[column] for column in by] if by else keys,
+                observed=True, sort=True, dropna=False).agg(merge_sketches)
+            estimates = np.array([sketch.quantile(quantiles) for sketch in merged])
+            for i, q in enumerate(quantiles):
+                rolled[f'p{q * 100:g}_points'] = estimates[:, i] if len(merged) else []
+
+        if not by:
+            rolled.index = pd.RangeIndex(len(rolled))
+
+        return rolled
+
+    def drilldown(self, column, value, by, start=None, end=None, where=None, quantiles=None):
+        """
+        Rolls up the cells where column equals value to a finer grouping, ie
+        drilldown('month', '2019-03-01', 'day') for the days of one month.
+        """
+
+        import pandas as pd
+
+        cells = self.cells[column]
+        if pd.api.types.is_datetime64_any_dtype(cells):
+            value = pd.Timestamp(value)
+
+        where = {**(where or {}), column: value}
+
+        return self.rollup(by, start, end, where, quantiles)
@@ -0,0 +1,202 @@
+import re
+
+from ingestion_funcs import EARLIEST_EVENT_DATE, LATEST_EVENT_DATE
+
+
+# Why a date was rejected, in code order.  Code 0 is a valid date.
+DATE_REASONS = ['valid',
+                'missing',
+                'unrecognized_format',
+                'invalid_month',
+                'invalid_day',
+                'before_window',
+                'after_window']
+
+# Formats event dates arrive in, matched against a string's shape, ie
+# '6/11/19' has the shape '9/99/99'.  Raw exports use M/D/YY, some rows have
+# four digit years, and live clients may send ISO dates.
+DATE_FORMATS = {'M/D/YY': re.compile(r'^(?P<month>9{1,2})/(?P<day>9{1,2})/(?P<year>99)$'),
+                'M/D/YYYY': re.compile(r'^(?P<month>9{1,2})/(?P<day>9{1,2})/(?P<year>9999)$'),
+                'YYYY-MM-DD': re.compile(r'^(?P<year>9999)-(?P<month>99)-(?P<day>99)$')}
+
+
+def _shapes(strings):
+    """
+    Replaces every digit of each string by 9.  Returns a NumPy bytes array.
+
+    strings (NumPy bytes array): ascii strings
+    """
+
+    import numpy as np
+
+    width = strings.dtype.itemsize
+    chars = strings.view(np.uint8).reshape(len(strings), width)
+    shapes = np.where((chars >= ord('0')) & (chars <= ord('9')), ord('9'), chars).astype(np.uint8)
+
+    return shapes.view(f'S{width}').ravel()
+
+
+def _field(chars, span):
+    """
+    Reads the digits at columns span of each row as an integer.
+    """
+
+    import numpy as np
+
+    value = np.zeros(len(chars), dtype=np.int64)
+    for column in range(*span):
+        value = value * 10 + (chars[:, column] - ord('0'))
+
+    return value
+
+
+def _parse_distinct(strings, earliest_date, latest_date):
+    """
+    Parses distinct date strings.  Strings are grouped by shape and each
+    group's fields are read as integers by column arithmetic on its
+    characters, so the work per group is a few NumPy operations whatever
+    its size.  Returns a tuple of (dates, reasons) NumPy arrays.
+    """
+
+    import numpy as np
+
+    # Non-ascii characters can't be part of a date, so any placeholder works
+    encoded = np.array([string.strip().strip('"').encode('ascii', 'replace')
+                        for string in strings], dtype=bytes)
+    if encoded.dtype.itemsize == 0:
+        encoded = encoded.astype('S1')
+
+    dates = np.full(len(strings), np.datetime64('NaT'), dtype='datetime64[D]')
+    reasons = np.full(len(strings), DATE_REASONS.index('unrecognized_format'), dtype=np.int8)
+    reasons[encoded == b''] = DATE_REASONS.index('missing')
+
+    chars = encoded.view(np.uint8).reshape(len(encoded), encoded.dtype.itemsize)
+    shapes, groups = np.unique(_shapes(encoded), return_inverse=True)
+
+    for group, shape in enumerate(shapes):
+        matches = (pattern.match(shape.decode()) for pattern in DATE_FORMATS.values())
+        match = next((match for match in matches if match is not None), None)
+        if match is None:
+            continue
+
+        rows = np.flatnonzero(groups == group)
+        year = _field(chars[rows], match.span('year'))
+        month = _field(chars[rows], match.span('month'))
+        day = _field(chars[rows], match.span('day'))
+
+        if match.end('year') - match.start('year') == 2:
+            # Same century pivot as strptime's %y
+            year = np.where(year < 69, 2000 + year, 1900 + year)
+
+        valid_month = (month >= 1) & (month <= 12)
+        month_start = ((year - 1970) * 12 + np.where(valid_month, month, 1) - 1).astype('datetime64[M]')
+        days_in_month = ((month_start + 1).astype('datetime64[D]')
+                         - month_start.astype('datetime64[D]')).astype(np.int64)
+        valid_day = (day >= 1) & (day <= days_in_month)
+
+        group_reasons = np.where(~valid_month, DATE_REASONS.index('invalid_month'),
+                                 np.where(~valid_day, DATE_REASONS.index('invalid_day'),
+                                          DATE_REASONS.index('valid')))
+        group_dates = np.where(valid_month & valid_day,
+                               month_start.astype('datetime64[D]') + (day - 1),
+                               np.datetime64('NaT'))
+
+        reasons[rows] = group_reasons
+        dates[rows] = group_dates
+
+    # Dates outside the window keep their value so they can be reported
+    parsed = reasons == DATE_REASONS.index('valid')
+    reasons[parsed & (dates < np.datetime64(earliest_date, 'D'))] = DATE_REASONS.index('before_window')
+    reasons[parsed & (dates > np.datetime64(latest_date, 'D'))] = DATE_REASONS.index('after_window')
+
+    return dates, reasons
+
+
+def parse_event_dates(values,
+                      earliest_date=EARLIEST_EVENT_DATE,
+                      latest_date=LATEST_EVENT_DATE):
+    """
+    Parses event_date strings in any of DATE_FORMATS and flags the ones that
+    aren't valid event dates.  Only the distinct strings are parsed, a few
+    hundred for the whole events file, and the results are spread back over
+    the rows by their codes, so throughput is bound by factorizing the
+    column (tens of millions of rows per second, and no work at all for
+    categoricals).  Returns a tuple of NumPy arrays: the dates as
+    datetime64[D], NaT where unparseable, and the int8 reason codes, indexes
+    into DATE_REASONS with 0 for valid dates.
+
+    values (Pandas Series, Categorical or array-like of str): raw event_date
+    values, missing values are flagged as missing
+
+    earliest_date, latest_date (str): inclusive bounds of valid event dates
+    """
+
+    import numpy as np
+    import pandas as pd
+
+    if isinstance(getattr(values, 'dtype', None), pd.CategoricalDtype):
+        values = values.array if isinstance(values, pd.Series) else values
+        codes, distinct = values.codes, values.categories
+    else:
+        if not isinstance(values, (pd.Series, pd.Index, np.ndarray)):
+            values = np.asarray(values, dtype=object)
+        codes, distinct = pd.factorize(values)
+
+    dates, reasons = _parse_distinct([str(value) for value in distinct],
+                                     earliest_date, latest_date)
+
+    # Code -1 marks missing values, which picks the appended last element
+    dates = np.append(dates, np.datetime64('NaT', 'D'))
+    reasons = np.append(reasons, np.int8(DATE_REASONS.index('missing')))
+
+    return dates[codes], reasons[codes]
+
+
+def normalize_event_dates(values,
+                          earliest_date=EARLIEST_EVENT_DATE,
+                          latest_date=LATEST_EVENT_DATE):
+    """
+    Same as parse_event_dates, returned as a Pandas DataFrame with the
+    columns event_date and reason, reason as a categorical of DATE_REASONS.
+    The index is that of values when it is a Series.
+    """
+
+    import pandas as pd
+
+    dates, reasons = parse_event_dates(values, earliest_date, latest_date)
+
+    return pd.DataFrame({'event_date': dates.astype('datetime64[s]'),
+                         'reason': pd.Categorical.from_codes(reasons, DATE_REASONS)},
+                        index=values.index if isinstance(values, pd.Series) else None)
+
+
+def event_date_formats(values):
+    """
+    Counts event_date values by shape, each digit replaced by 9, ie
+    '9/99/99', after stripping spaces and quotes like parse_event_dates.
+    Returns a Pandas DataFrame indexed by shape with the matching entry of
+    DATE_FORMATS (None for unrecognized shapes), the number of rows and an
+    example value, most common shape first.
+
+    values (Pandas Series or array-like of str): raw event_date values
+    """
+
+    import numpy as np
+    import pandas as pd
+
+    counts = pd.Series(np.asarray(values, dtype=object)).value_counts()
+    # Stripped the same way _parse_distinct strips them before parsing
+    encoded = np.array([str(value).strip().strip('"').encode('ascii', 'replace')
+                        for value in counts.index],
+                       dtype=bytes)
+    shapes = pd.Series(_shapes(encoded), index=counts.index).str.decode('ascii')
+
+    formats = pd.DataFrame({'shape': shapes.to_numpy(),
+                            'rows': counts.to_numpy(),
+                            'example': counts.index.to_numpy()})
+    summary = formats.groupby('shape').agg(rows=('rows', 'sum'), example=('example', 'first'))
+    summary.insert(0, 'format', [next((name for name, pattern in DATE_FORMATS.items()
+                                       if pattern.match(shape)), None)
+                                 for shape in summary.index])
+
+    return summary.sort_values('rows', ascending=False)
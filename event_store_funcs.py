@@ -0,0 +1,357 @@
+import os
+import shutil
+
+
+EVENT_STORE_DIRECTORY = 'data/event_store'
+
+# Fixed-width on-disk type of each column.  Days count from 1970-01-01, so
+# they convert to datetime64[D] without arithmetic.
+EVENT_STORE_COLUMNS = {'user_key': 'int32',
+                       'day': 'int32',
+                       'hour': 'int8',
+                       'points': 'int32'}
+
+# Same season boundaries as HOURLY_POINTS_BY_SEASON_QUERY, in the order the
+# query sorts them
+SEASONS = ['fall', 'spring', 'summer', 'winter']
+SEASON_OF_MONTH = [3, 3, 1, 1, 1, 2, 2, 2, 0, 0, 0, 3]
+
+
+def _fixed_width(values, dtype, column):
+    import numpy as np
+
+    info = np.iinfo(dtype)
+    if len(values) and (values.min() < info.min or values.max() > info.max):
+        raise ValueError(f'{column} values fall outside the range of {dtype}')
+
+    return values.astype(dtype)
+
+
+def write_event_store(events, directory=EVENT_STORE_DIRECTORY):
+    """
+    Writes events to an event store: one fixed-width NumPy file per column,
+    sorted by event_date and hour, with users replaced by int32 keys and a
+    sparse index holding the first row of every event_date.  The store is
+    written next to directory and moved into place once complete, so readers
+    never see a partial store.  Returns the opened EventStore.
+
+    events (Pandas DataFrame or iterable of Pandas DataFrames): event level
+    rows with userid, event_date, hour and points, ie the clean
+    event_performance table whole or in chunks
+
+    directory (str): location of the store
+    """
+
+    import numpy as np
+    import pandas as pd
+
+    if isinstance(events, pd.DataFrame):
+        events = [events]
+
+    user_keys = {}
+    columns = {column: [] for column in EVENT_STORE_COLUMNS}
+
+    for chunk in events:
+        if len(chunk) == 0:
+            continue
+
+        userids = chunk['userid'].to_numpy()
+        for userid in pd.unique(userids):
+            if userid not in user_keys:
+                user_keys[userid] = len(user_keys)
+
+        days = pd.to_datetime(chunk['event_date']).to_numpy().astype('datetime64[D]')
+
+        columns['user_key'].append(pd.Series(userids).map(user_keys).to_numpy(dtype=np.int32))
+        columns['day'].append(_fixed_width(days.astype(np.int64), 'int32', 'event_date'))
+        columns['hour'].append(_fixed_width(chunk['hour'].to_numpy(dtype=np.int64), 'int8', 'hour'))
+        columns['points'].append(_fixed_width(chunk['points'].to_numpy(dtype=np.int64),
+                                              'int32', 'points'))
+
+    columns = {column: (np.concatenate(arrays) if arrays else np.zeros(0, dtype))
+               for (column, dtype), arrays in zip(EVENT_STORE_COLUMNS.items(), columns.values())}
+
+    order = np.lexsort((columns['hour'], columns['day']))
+    columns = {column: values[order] for column, values in columns.items()}
+
+    index_days, index_starts = np.unique(columns['day'], return_index=True)
+
+    tmp_directory = f'{directory.rstrip(os.sep)}.tmp'
+    shutil.rmtree(tmp_directory, ignore_errors=True)
+    os.makedirs(tmp_directory)
+
+    for column, values in columns.items():
+        np.save(os.path.join(tmp_directory, f'{column}.npy'), values)
+    np.save(os.path.join(tmp_directory, 'userids.npy'),
+            np.array(list(user_keys), dtype=str))
+    np.save(os.path.join(tmp_directory, 'index_days.npy'), index_days.astype(np.int32))
+    np.save(os.path.join(tmp_directory, 'index_offsets.npy'),
+            np.append(index_starts, len(order)).astype(np.int64))
+
+    old_directory = f'{directory.rstrip(os.sep)}.old'
+    shutil.rmtree(old_directory, ignore_errors=True)
+    if os.path.exists(directory):
+        os.replace(directory, old_directory)
+    os.replace(tmp_directory, directory)
+    shutil.rmtree(old_directory, ignore_errors=True)
+
+    return EventStore(directory)
+
+
+def build_event_store(engine, directory=EVENT_STORE_DIRECTORY, chunksize=100_000):
+    """
+    Writes the clean event_performance table to an event store, streaming it
+    from the database in chunks.  Returns the opened EventStore.
+
+    engine (sql alchemy engine object): Used to establish a connection to the db
+
+    directory (str): location of the store
+
+    chunksize (int): number of rows per chunk
+    """
+
+    from feature_store_funcs import event_chunks_from_db
+
+    return write_event_store(event_chunks_from_db(engine, chunksize=chunksize), directory)
+
+
+class EventSlice:
+    """
+    A contiguous range of a store's rows.  The column attributes are views of
+    the memory-mapped files, so creating a slice reads nothing from disk
+    until its values are used.
+
+    user_key, day, hour, points (NumPy arrays): the columns of the range
+
+    index_days (NumPy array): event_dates in the range as days since epoch
+
+    offsets (NumPy array): start row of each index day within the range,
+    followed by the number of rows
+    """
+
+    def __init__(self, user_key, day, hour, points, index_days, offsets):
+        self.user_key = user_key
+        self.day = day
+        self.hour = hour
+        self.points = points
+        self.index_days = index_days
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.points)
+
+    @property
+    def event_dates(self):
+        return self.index_days.astype('datetime64[D]')
+
+
+class EventStore:
+    """
+    Read-only view of an event store written by write_event_store.  Columns
+    are memory-mapped, so opening a store only reads the file headers and
+    the sparse date index, whatever the number of events, and pages are
+    read by the OS as scans touch them.  Aggregations run on the mapped
+    arrays without building a DataFrame and return frames shaped like the
+    matching part 2 query results.
+
+    directory (str): location of the store
+    """
+
+    def __init__(self, directory=EVENT_STORE_DIRECTORY):
+        import numpy as np
+
+        self.directory = directory
+        self.columns = {column: np.load(os.path.join(directory, f'{column}.npy'), mmap_mode='r')
+                        for column in EVENT_STORE_COLUMNS}
+        self.userids = np.load(os.path.join(directory, 'userids.npy'))
+        self.index_days = np.load(os.path.join(directory, 'index_days.npy'))
+        self.index_offsets = np.load(os.path.join(directory, 'index_offsets.npy'))
+
+    def __len__(self):
+        return len(self.columns['points'])
+
+    def __repr__(self):
+        return (f'EventStore({self.directory!r}, events={len(self)}, '
+                f'users={len(self.userids)}, event_dates={len(self.index_days)})')
+
+    @property
+    def event_dates(self):
+        return self.index_days.astype('datetime64[D]')
+
+    def _day_bounds(self, start=None, end=None):
+        import numpy as np
+
+        first = 0 if start is None else np.searchsorted(
+            self.index_days, np.datetime64(start, 'D').astype(np.int64), side='left')
+        last = len(self.index_days) if end is None else np.searchsorted(
+            self.index_days, np.datetime64(end, 'D').astype(np.int64), side='right')
+
+        return first, max(first, last)
+
+    def scan(self, start=None, end=None):
+        """
+        Returns an EventSlice of the events between start and end
+        (inclusive) without copying them.
+
+        start, end (str, date or datetime64): optional bounds of the
+        event_date range
+        """
+
+        first, last = self._day_bounds(start, end)
+        row_start, row_end = self.index_offsets[first], self.index_offsets[last]
+        rows = slice(row_start, row_end)
+
+        return EventSlice(user_key=self.columns['user_key'][rows],
+                          day=self.columns['day'][rows],
+                          hour=self.columns['hour'][rows],
+                          points=self.columns['points'][rows],
+                          index_days=self.index_days[first:last],
+                          offsets=self.index_offsets[first:last + 1] - row_start)
+
+    def to_frame(self, start=None, end=None):
+        """
+        Copies the events between start and end into a Pandas DataFrame with
+        the columns of event_performance, userid as a categorical.
+        """
+
+        import pandas as pd
+
+        events = self.scan(start, end)
+
+        return pd.DataFrame({'userid': pd.Categorical.from_codes(events.user_key, self.userids),
+                             'event_date': events.day.astype('datetime64[D]')
+                                                     .astype('datetime64[s]'),
+                             'hour': events.hour.astype('int64'),
+                             'points': events.points.astype('int64')})
+
+    def points_per_event(self, start=None, end=None):
+        """
+        Total points of each gaming event, the daily_points the event
+        summary statistics are computed from.  Returns a Pandas DataFrame
+        indexed by event_date.
+        """
+
+        import numpy as np
+        import pandas as pd
+
+        events = self.scan(start, end)
+        totals = (np.add.reduceat(events.points, events.offsets[:-1], dtype=np.int64)
+                  if len(events) else np.zeros(0, np.int64))
+
+        return pd.DataFrame({'points_per_event': totals},
+                            index=pd.Index(events.event_dates.astype('datetime64[s]'),
+                                           name='event_date'))
+
+    def _months(self, events):
+        import numpy as np
+
+        # Month of each index day, and of each row by repeating it over the
+        # day's rows, since rows are sorted by day
+        months = events.index_days.astype('datetime64[D]').astype('datetime64[M]')
+        row_months = np.repeat(months, np.diff(events.offsets))
+
+        return months, row_months
+
+    def total_points_per_month(self, start=None, end=None):
+        """
+        Same result as the total_points_per_month product.
+        """
+
+        import numpy as np
+        import pandas as pd
+
+        events = self.scan(start, end)
+        months, _ = self._months(events)
+        month_starts = np.flatnonzero(np.r_[True, months[1:] != months[:-1]]) \
+            if len(months) else np.zeros(0, np.int64)
+
+        totals = (np.add.reduceat(events.points, events.offsets[month_starts], dtype=np.int64)
+                  if len(events) else np.zeros(0, np.int64))
+
+        return pd.DataFrame({'total_points': totals},
+                            index=pd.Index(months[month_starts].astype('datetime64[s]'),
+                                           name='month'))
+
+    def total_users_per_month(self, start=None, end=None):
+        """
+        Same result as the total_users_per_month product.
+        """
+
+        import numpy as np
+        import pandas as pd
+
+        events = self.scan(start, end)
+        _, row_months = self._months(events)
+
+        pairs = np.unique(row_months.astype(np.int64) * len(self.userids) + events.user_key)
+        months, users = np.unique(pairs // len(self.userids), return_counts=True) \
+            if len(pairs) else (np.zeros(0, np.int64), np.zeros(0, np.int64))
+
+        return pd.DataFrame({'total_users': users},
+                            index=pd.Index(months.astype('datetime64[M]').astype('datetime64[s]'),
+                                           name='month'))
+
+    def points_per_hour(self, start=None, end=None):
+        """
+        Total points per hour of the day.  Returns a Pandas DataFrame indexed
+        by hour.
+        """
+
+        import numpy as np
+        import pandas as pd
+
+        events = self.scan(start, end)
+        totals = np.bincount(events.hour, weights=events.points, minlength=24).astype(np.int64)
+        hours = np.flatnonzero(np.bincount(events.hour, minlength=24))
+
+        return pd.DataFrame({'points': totals[hours]}, index=pd.Index(hours, name='hour'))
+
+    def hourly_point_totals_by_season(self, start=None, end=None):
+        """
+        Same result as the hourly_point_totals_by_season product.
+        """
+
+        import numpy as np
+        import pandas as pd
+
+        events = self.scan(start, end)
+        _, row_months = self._months(events)
+
+        month_numbers = row_months.astype(np.int64) % 12
+        cells = np.asarray(SEASON_OF_MONTH)[month_numbers] * 24 + events.hour
+
+        totals = np.bincount(cells, weights=events.points, minlength=len(SEASONS) * 24)
+        present = np.flatnonzero(np.bincount(cells, minlength=len(SEASONS) * 24))
+
+        index = pd.MultiIndex.from_arrays([np.asarray(SEASONS)[present // 24], present % 24],
+                                          names=['season', 'hour'])
+
+        return pd.DataFrame({'points': totals[present].astype(np.int64)}, index=index)
+
+    def points_per_user(self, start=None, end=None):
+        """
+        Total points of every user with events between start and end.
+        Returns a Pandas DataFrame indexed by userid.
+        """
+
+        import numpy as np
+        import pandas as pd
+
+        events = self.scan(start, end)
+        num_users = len(self.userids)
+        totals = np.bincount(events.user_key, weights=events.points,
+                             minlength=num_users).astype(np.int64)
+        played = np.flatnonzero(np.bincount(events.user_key, minlength=num_users))
+
+        return pd.DataFrame({'total_points': totals[played]},
+                            index=pd.Index(self.userids[played], name='userid'))
+
+
+def open_event_store(directory=EVENT_STORE_DIRECTORY):
+    """
+    Opens the event store in directory.  Returns an EventStore.
+
+    directory (str): location of the store
+    """
+
+    return EventStore(directory)
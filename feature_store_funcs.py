@@ -0,0 +1,347 @@
+import os
+
+
+FEATURE_COLUMNS = ['userid',
+                   'events_played',
+                   'total_points',
+                   'mean_points',
+                   'median_points',
+                   'std_points',
+                   'min_points',
+                   'max_points',
+                   'active_months',
+                   'preferred_hour',
+                   'first_event',
+                   'last_event',
+                   'longest_streak',
+                   'current_streak']
+
+
+class UserFeatureStore:
+    """
+    Per-user features aggregated from event_performance, so correlation and
+    regression work reads one pre-aggregated row per user instead of
+    re-aggregating the raw events.  Users get compact int32 keys in order of
+    first appearance.
+
+    The store only keeps mergeable state: running sums per user, per-user
+    counts of each hour and point value, and a RetentionTracker of the days
+    each user played.  Batches of events can therefore be added in any order
+    with update(), ie one chunk of a CSV at a time or the events of each new
+    gaming event, and features() finishes the state into the feature table.
+    Streaks count consecutive gaming events, where the gaming events are the
+    days anybody played, not calendar days.
+    """
+
+    def __init__(self):
+        import pandas as pd
+        from retention_funcs import RetentionTracker
+
+        self.user_keys = {}
+        self.totals = pd.DataFrame(columns=['events_played', 'total_points', 'sum_sq_points',
+                                            'min_points', 'max_points'],
+                                   dtype='int64',
+                                   index=pd.Index([], dtype='int32', name='user_key'))
+        self.hour_counts = pd.Series(index=pd.MultiIndex.from_arrays([[], []],
+                                                                     names=['user_key', 'hour']),
+                                     dtype='int64',
+                                     name='events')
+        self.point_counts = pd.Series(index=pd.MultiIndex.from_arrays([[], []],
+                                                                      names=['user_key', 'points']),
+                                      dtype='int64',
+                                      name='events')
+        self.active_days = RetentionTracker(freq='D')
+
+    def _keys_for(self, userids):
+        import numpy as np
+        import pandas as pd
+
+        for userid in pd.unique(userids):
+            if userid not in self.user_keys:
+                self.user_keys[userid] = len(self.user_keys)
+
+        return pd.Series(userids).map(self.user_keys).to_numpy(dtype=np.int32)
+
+    def update(self, event_performance):
+        """
+        Adds a batch of events to the store.  Returns the store.
+
+        event_performance (Pandas DataFrame): event level rows with userid,
+        event_date, hour and points columns
+        """
+
+        import pandas as pd
+
+        if len(event_performance) == 0:
+            return self
+
+        events = pd.DataFrame({'user_key': self._keys_for(event_performance['userid'].to_numpy()),
+                               'event_date': pd.to_datetime(event_performance['event_date']).to_numpy(),
+                               'hour': event_performance['hour'].to_numpy(dtype='int64'),
+                               'points': event_performance['points'].to_numpy(dtype='int64')})
+        events['sq_points'] = events['points'] ** 2
+
+        batch_totals = events.groupby('user_key').agg(events_played=('points', 'size'),
+                                                      total_points=('points', 'sum'),
+                                                      sum_sq_points=('sq_points', 'sum'),
+                                                      min_points=('points', 'min'),
+                                                      max_points=('points', 'max'))
+
+        merged = pd.concat([self.totals, batch_totals]).groupby(level='user_key')
+        self.totals = pd.concat([merged[['events_played', 'total_points', 'sum_sq_points']].sum(),
+                                 merged['min_points'].min(),
+                                 merged['max_points'].max()],
+                                axis=1).astype('int64')
+
+        self.hour_counts = (self.hour_counts.add(events.groupby(['user_key', 'hour']).size(),
+                                                 fill_value=0)
+                                            .astype('int64')
+                                            .rename('events'))
+        self.point_counts = (self.point_counts.add(events.groupby(['user_key', 'points']).size(),
+                                                   fill_value=0)
+                                              .astype('int64')
+                                              .rename('events'))
+
+        self.active_days.update(events.rename(columns={'user_key': 'userid'}))
+
+        return self
+
+    def _median_points(self):
+        import numpy as np
+
+        # Point counts are sorted by (user_key, points), so the median is
+        # where each user's running count passes half their events
+        counts = self.point_counts.sort_index().reset_index()
+        counts['points'] = counts['points'].astype(np.float64)
+
+        cumulative = counts.groupby('user_key')['events'].cumsum()
+        n = counts['user_key'].map(self.totals['events_played'])
+
+        lower = counts['points'][cumulative >= (n + 1) // 2].groupby(counts['user_key']).first()
+        upper = counts['points'][cumulative >= n // 2 + 1].groupby(counts['user_key']).first()
+
+        return ((lower + upper) / 2).rename('median_points')
+
+    def _activity_features(self):
+        import numpy as np
+        import pandas as pd
+
+        tracker = self.active_days
+        active = tracker.activity()
+        days = tracker.periods
+
+        months = days.to_period('M')
+        month_starts = np.flatnonzero(np.r_[True, months[1:] != months[:-1]])
+        active_months = np.logical_or.reduceat(active, month_starts, axis=1).sum(axis=1)
+
+        # Run lengths of consecutive gaming events, resetting at every
+        # gaming event the user missed
+        played = active[:, active.any(axis=0)].astype(np.int64)
+        played_so_far = np.cumsum(played, axis=1)
+        at_last_miss = np.maximum.accumulate(np.where(played == 0, played_so_far, 0), axis=1)
+        runs = played_so_far - at_last_miss
+
+        first = np.argmax(active, axis=1)
+        last = active.shape[1] - 1 - np.argmax(active[:, ::-1], axis=1)
+
+        return pd.DataFrame({'active_months': active_months,
+                             'first_event': days[first].to_numpy(),
+                             'last_event': days[last].to_numpy(),
+                             'longest_streak': runs.max(axis=1, initial=0),
+                             'current_streak': runs[:, -1] if runs.shape[1] else 0},
+                            index=pd.Index(tracker.userids, dtype='int32', name='user_key'))
+
+    def features(self):
+        """
+        Returns the feature table as a Pandas DataFrame indexed by int32
+        user_key with the columns in FEATURE_COLUMNS.
+        """
+
+        import numpy as np
+        import pandas as pd
+
+        totals = self.totals.sort_index()
+        n = totals['events_played']
+
+        variance = ((n * totals['sum_sq_points'] - totals['total_points'] ** 2)
+                    / (n * (n - 1)).where(n > 1))
+
+        preferred_hour = (self.hour_counts.sort_index()
+                                          .groupby(level='user_key')
+                                          .idxmax()
+                                          .map(lambda key: key[1]))
+
+        userids = pd.Series(list(self.user_keys), index=list(self.user_keys.values()))
+
+        features = pd.DataFrame({'userid': userids,
+                                 'events_played': n,
+                                 'total_points': totals['total_points'],
+                                 'mean_points': totals['total_points'] / n,
+                                 'median_points': self._median_points(),
+                                 'std_points': np.sqrt(variance),
+                                 'min_points': totals['min_points'],
+                                 'max_points': totals['max_points'],
+                                 'preferred_hour': preferred_hour})
+        features.index = features.index.astype('int32')
+        features.index.name = 'user_key'
+
+        features = features.join(self._activity_features())
+
+        return features[FEATURE_COLUMNS]
+
+    def save(self, directory):
+        """
+        Writes the feature table to directory/features.parquet and the
+        mergeable state next to it under directory/state, so the store can be
+        loaded and refreshed later.
+
+        directory (str): location of the store
+        """
+
+        state_dir = os.path.join(directory, 'state')
+        os.makedirs(state_dir, exist_ok=True)
+
+        self.features().to_parquet(os.path.join(directory, 'features.parquet'))
+
+        self.totals.to_parquet(os.path.join(state_dir, 'totals.parquet'))
+        self.hour_counts.to_frame().to_parquet(os.path.join(state_dir, 'hour_counts.parquet'))
+        self.point_counts.to_frame().to_parquet(os.path.join(state_dir, 'point_counts.parquet'))
+        self.active_days.save(os.path.join(state_dir, 'active_days.npz'))
+
+    @classmethod
+    def load(cls, directory):
+        """
+        Reads a store written by save().
+
+        directory (str): location of the store
+        """
+
+        import pandas as pd
+        from retention_funcs import RetentionTracker
+
+        state_dir = os.path.join(directory, 'state')
+        store = cls()
+
+        userids = pd.read_parquet(os.path.join(directory, 'features.parquet'),
+                                  columns=['userid'])['userid']
+        store.user_keys = {userid: int(key) for key, userid in userids.items()}
+
+        store.totals = pd.read_parquet(os.path.join(state_dir, 'totals.parquet'))
+        store.hour_counts = pd.read_parquet(os.path.join(state_dir, 'hour_counts.parquet'))['events']
+        store.point_counts = pd.read_parquet(os.path.join(state_dir, 'point_counts.parquet'))['events']
+        store.active_days = RetentionTracker.load(os.path.join(state_dir, 'active_days.npz'))
+
+        return store
+
+    @property
+    def last_event_date(self):
+        """
+        Latest event_date in the store, or None when it's empty.
+        """
+
+        periods = self.active_days.periods
+
+        return periods[-1] if len(periods) else None
+
+
+def event_chunks_from_db(engine, since=None, chunksize=100_000):
+    """
+    Streams event_performance from the database in chunks of event level
+    rows.  Yields Pandas DataFrames.
+
+    engine (sql alchemy engine object or LocalDatabase): Used to establish a
+    connection to the db
+
+    since (str or date): only read events after this date
+
+    chunksize (int): number of rows per chunk
+    """
+
+    import pandas as pd
+    from sqlalchemy import text
+    from sql_query_helper_funcs import LocalDatabase
+
+    sql = """
+  SELECT userid, event_date, hour, points
+    FROM event_performance
+   WHERE CAST(:since AS date) IS NULL OR event_date > CAST(:since AS date);
+"""
+
+    if isinstance(engine, LocalDatabase):
+        yield from engine.read_frame(sql, params={'since': since}, chunksize=chunksize)
+        return
+
+    sql = text(sql)
+
+    with engine.connect() as conn:
+        conn = conn.execution_options(stream_results=True)
+        yield from pd.read_sql_query(sql,
+                                     conn,
+                                     params={'since': since},
+                                     chunksize=chunksize)
+
+
+def build_feature_store(chunks, directory=None):
+    """
+    Builds a feature store in one streaming pass over chunks of events, and
+    saves it to directory when given.  Returns the UserFeatureStore.
+
+    chunks (iterable of Pandas DataFrames): event level rows, ie from
+    event_chunks_from_db or pd.read_csv(..., chunksize=...)
+
+    directory (str): location to save the store
+    """
+
+    store = UserFeatureStore()
+    for chunk in chunks:
+        store.update(chunk)
+
+    if directory is not None:
+        store.save(directory)
+
+    return store
+
+
+def refresh_feature_store(engine, directory='data/features', chunksize=100_000):
+    """
+    Adds events newer than the store's latest event_date to the store saved
+    in directory, building it from scratch if there's none yet, and saves it
+    again.  Events are assumed to be loaded a whole gaming event at a time.
+    Returns the UserFeatureStore.
+
+    engine (sql alchemy engine object): Used to establish a connection to the db
+
+    directory (str): location of the store
+
+    chunksize (int): number of rows per chunk
+    """
+
+    if os.path.exists(os.path.join(directory, 'features.parquet')):
+        store = UserFeatureStore.load(directory)
+    else:
+        store = UserFeatureStore()
+
+    since = store.last_event_date
+    for chunk in event_chunks_from_db(engine,
+                                      since=None if since is None else since.date(),
+                                      chunksize=chunksize):
+        store.update(chunk)
+
+    store.save(directory)
+
+    return store
+
+
+def read_features(directory='data/features', columns=None):
+    """
+    Reads the feature table saved by a feature store.  Returns a Pandas
+    DataFrame indexed by user_key.
+
+    directory (str): location of the store
+
+    columns (list of str): only read these columns
+    """
+
+    import pandas as pd
+
+    return pd.read_parquet(os.path.join(directory, 'features.parquet'), columns=columns)
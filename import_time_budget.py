@@ -0,0 +1,121 @@
+"""
+Measures the cold import time of the helper modules and checks it against a
+budget.  Each module is imported in a fresh interpreter with -X importtime.
+A module fails the check when it takes longer than the budget to import or
+when importing it eagerly loads one of the heavy dependencies, which should
+only ever be imported inside the functions that use them.
+
+    python import_time_budget.py
+    python import_time_budget.py --budget-ms 50 sql_query_helper_funcs
+
+Exits with status 1 if any module is over budget.
+"""
+
+import argparse
+import json
+import subprocess
+import sys
+
+
+LIGHTWEIGHT_MODULES = ['sql_query_helper_funcs',
+                       'chi_square_funcs',
+                       'time_series_funcs',
+                       'distinct_count_funcs',
+                       'integrity_funcs',
+                       'ingestion_funcs',
+                       'table_export_funcs',
+                       'query_template_funcs',
+                       'cohort_funcs',
+                       'retention_funcs',
+                       'feature_store_funcs',
+                       'dtype_funcs',
+                       'quantile_sketch_funcs',
+                       'live_ingestion',
+                       'spool_funcs',
+                       'event_store_funcs',
+                       'event_cube_funcs',
+                       'dedup_funcs',
+                       'query_plan_guard',
+                       'event_date_funcs',
+                       'metrics_funcs',
+                       'analysis_dag_funcs',
+                       'analysis_products',
+                       'run_report']
+
+HEAVY_MODULES = ['pandas',
+                 'numpy',
+                 'scipy',
+                 'sqlalchemy',
+                 'matplotlib',
+                 'seaborn',
+                 'statsmodels',
+                 'dataframe_image',
+                 'pyarrow',
+                 'psycopg2']
+
+
+def measure_import(module):
+    """
+    Imports a module in a fresh interpreter.  Returns a tuple of the
+    cumulative import time in milliseconds and the list of heavy
+    dependencies that were loaded along with it.
+
+    module (str): name of the module to import
+    """
+
+    check_heavy = (f"import sys, json, {module}; "
+                   f"print(json.dumps(sorted({{m.split('.')[0] for m in sys.modules}} "
+                   f"& set({HEAVY_MODULES!r}))))")
+
+    completed = subprocess.run([sys.executable, '-X', 'importtime', '-c', check_heavy],
+                               capture_output=True,
+                               text=True,
+                               check=True)
+
+    # Lines look like "import time:   self [us] | cumulative | imported package"
+    cumulative_us = 0
+    for line in completed.stderr.splitlines():
+        fields = [field.strip() for field in line.split('|')]
+        if len(fields) == 3 and fields[2] == module:
+            cumulative_us = int(fields[1])
+
+    return cumulative_us / 1000, json.loads(completed.stdout)
+
+
+def check_budget(modules=LIGHTWEIGHT_MODULES, budget_ms=100):
+    """
+    Measures every module and prints a report.  Returns True when all of
+    them are within budget and import no heavy dependencies.
+
+    modules (list of str): names of the modules to check
+
+    budget_ms (float): maximum cumulative import time per module
+    """
+
+    within_budget = True
+
+    print(f"{'module':<25} {'import ms':>10}  heavy dependencies loaded")
+    for module in modules:
+        import_ms, heavy_loaded = measure_import(module)
+        ok = import_ms <= budget_ms and not heavy_loaded
+        within_budget &= ok
+
+        print(f"{module:<25} {import_ms:>10.1f}  {', '.join(heavy_loaded) or '-'}"
+              f"{'' if ok else '  <-- over budget'}")
+
+    return within_budget
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Check helper module import times.')
+    parser.add_argument('modules', nargs='*', default=LIGHTWEIGHT_MODULES)
+    parser.add_argument('--budget-ms', type=float, default=100,
+                        help='maximum cumulative import time per module')
+    args = parser.parse_args(argv)
+
+    if not check_budget(args.modules, args.budget_ms):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
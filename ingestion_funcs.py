@@ -0,0 +1,271 @@
+import os
+
+
+EVENT_PERFORMANCE_COLUMNS = ['userid', 'event_date', 'hour', 'points']
+
+# Same window part 1 uses when moving rows into the clean event_performance
+# table: nothing before the company was founded or after the analysis.
+EARLIEST_EVENT_DATE = '2013-01-01'
+LATEST_EVENT_DATE = '2023-07-13'
+
+
+def clean_event_performance(raw_events,
+                            earliest_date=EARLIEST_EVENT_DATE,
+                            latest_date=LATEST_EVENT_DATE):
+    """
+    Applies the part 1 cleaning rules to raw event_performance rows in
+    Python.  Quotes and spaces are stripped from userid, event_date is parsed
+    from any of event_date_funcs.DATE_FORMATS, quotes and question marks are
+    stripped from points before converting it to an int, and rows with
+    unparseable values, hours outside 0-23 or dates outside the valid window
+    are dropped.  Dropped rows are counted in ROWS_REJECTED.  Returns a new
+    Pandas DataFrame with the columns userid, event_date, hour and points.
+
+    raw_events (Pandas DataFrame): raw rows with the columns userid,
+    event_date, hour and points, all as strings
+
+    earliest_date, latest_date (str): inclusive bounds of valid event dates
+    """
+
+    clean_events, rejections = _clean_event_performance(raw_events, earliest_date, latest_date)
+    record_rejections(rejections)
+
+    return clean_events
+
+
+def record_rejections(rejections, stage='clean'):
+    """
+    Adds rejected row counts to ROWS_REJECTED.
+
+    rejections (dict): rows rejected by reason
+
+    stage (str): stage label of the counts
+    """
+
+    from metrics_funcs import ROWS_REJECTED
+
+    for reason, count in rejections.items():
+        if count:
+            ROWS_REJECTED.labels(stage, reason).inc(int(count))
+
+
+def _clean_event_performance(raw_events, earliest_date, latest_date):
+    """
+    clean_event_performance without recording metrics, for worker processes
+    whose counters would be lost.  Returns a tuple of the clean DataFrame
+    and a dict of rejected rows by reason.
+    """
+
+    import numpy as np
+    import pandas as pd
+    from event_date_funcs import DATE_REASONS, parse_event_dates
+
+    userid = raw_events['userid'].astype(str).str.replace(r'[" ]', '', regex=True)
+
+    dates, reasons = parse_event_dates(raw_events['event_date'], earliest_date, latest_date)
+    event_date = pd.Series(dates.astype('datetime64[s]'), index=raw_events.index)
+
+    hour = pd.to_numeric(raw_events['hour'], errors='coerce')
+
+    points = pd.to_numeric(raw_events['points'].astype(str)
+                                               .str.replace(r'["?]', '', regex=True),
+                           errors='coerce')
+
+    valid_date = reasons == 0
+    valid_hour = hour.between(0, 23)
+    is_valid = (valid_date
+                & valid_hour
+                & points.notna())
+
+    # Each rejected row counts once, against the first rule it fails
+    rejections = dict(zip(DATE_REASONS[1:],
+                          np.bincount(reasons, minlength=len(DATE_REASONS))[1:].tolist()))
+    rejections['invalid_hour'] = int((valid_date & ~valid_hour).sum())
+    rejections['invalid_points'] = int((valid_date & valid_hour & points.isna()).sum())
+
+    clean_events = pd.DataFrame({'userid': userid[is_valid],
+                                 'event_date': event_date[is_valid],
+                                 'hour': hour[is_valid].astype('int64'),
+                                 'points': points[is_valid].astype('int64')})
+
+    return clean_events, rejections
+
+
+def shard_offsets(path, num_shards):
+    """
+    Splits a CSV file into byte ranges that start and end on newline
+    boundaries so each range holds only whole rows.  The header line is
+    excluded.  Quoted fields must not contain newlines, which holds for the
+    event_performance exports.  Returns a list of (start, end) tuples.
+
+    path (str): location of the CSV file
+
+    num_shards (int): desired number of shards.  Fewer are returned when the
+    file is too small to split that many ways.
+    """
+
+    file_size = os.path.getsize(path)
+
+    with open(path, 'rb') as f:
+        f.readline()
+        data_start = f.tell()
+
+        shard_size = max((file_size - data_start) // max(num_shards, 1), 1)
+
+        boundaries = [data_start]
+        while boundaries[-1] < file_size:
+            f.seek(min(boundaries[-1] + shard_size, file_size))
+            f.readline()
+            boundaries.append(min(f.tell(), file_size))
+
+    return [(start, end) for start, end in zip(boundaries[:-1], boundaries[1:])
+            if end > start]
+
+
+def _read_raw_shard(path, start, end):
+    import io
+    import pandas as pd
+
+    with open(path, 'rb') as f:
+        f.seek(start)
+        data = f.read(end - start)
+
+    return pd.read_csv(io.BytesIO(data),
+                       header=None,
+                       names=EVENT_PERFORMANCE_COLUMNS,
+                       dtype=str,
+                       keep_default_na=False)
+
+
+def read_shard(path, start, end, clean=True):
+    """
+    Parses the rows of one shard of a raw event_performance CSV, optionally
+    cleaning them with clean_event_performance.
+
+    path (str): location of the CSV file
+
+    start, end (int): byte range of the shard, as returned by shard_offsets
+
+    clean (bool): apply the part 1 cleaning rules to the shard
+    """
+
+    shard = _read_raw_shard(path, start, end)
+
+    if clean:
+        shard = clean_event_performance(shard)
+
+    return shard
+
+
+def _read_shard_star(args):
+    # Runs in a worker process, so rejections are returned for the parent
+    # to record rather than counted here
+    path, start, end, clean = args
+    shard = _read_raw_shard(path, start, end)
+
+    if not clean:
+        return shard, {}
+
+    return _clean_event_performance(shard, EARLIEST_EVENT_DATE, LATEST_EVENT_DATE)
+
+
+def read_csv_sharded(path, num_workers=None, clean=True):
+    """
+    Reads a large raw event_performance CSV in parallel.  The file is split
+    on newline boundaries into one shard per worker, each shard is parsed
+    and cleaned in its own process and the results are concatenated in file
+    order.  The shards' rejected rows are counted in ROWS_REJECTED by the
+    calling process.
+
+    path (str): location of the CSV file
+
+    num_workers (int): number of processes, defaults to the number of CPU
+    cores
+
+    clean (bool): apply the part 1 cleaning rules to each shard
+    """
+
+    from concurrent.futures import ProcessPoolExecutor
+    import pandas as pd
+
+    num_workers = num_workers or os.cpu_count() or 1
+    shards = [(path, start, end, clean)
+              for start, end in shard_offsets(path, num_workers)]
+
+    if len(shards) <= 1:
+        results = [_read_shard_star(shard) for shard in shards]
+    else:
+        with ProcessPoolExecutor(max_workers=min(num_workers, len(shards))) as pool:
+            results = list(pool.map(_read_shard_star, shards))
+
+    frames = [frame for frame, _ in results]
+
+    rejections = {}
+    for _, shard_rejections in results:
+        for reason, count in shard_rejections.items():
+            rejections[reason] = rejections.get(reason, 0) + count
+    record_rejections(rejections)
+
+    if not frames:
+        return pd.DataFrame(columns=EVENT_PERFORMANCE_COLUMNS)
+
+    return pd.concat(frames, ignore_index=True)
+
+
+def _copy_shard(path, start, end, engine, table, columns):
+    import io
+
+    with open(path, 'rb') as f:
+        f.seek(start)
+        data = io.BytesIO(f.read(end - start))
+
+    conn = engine.raw_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.copy_expert(f"COPY {table}({', '.join(columns)}) "
+                           "FROM STDIN WITH (FORMAT csv)",
+                           data)
+        conn.commit()
+    finally:
+        conn.close()
+
+    return end - start
+
+
+def copy_csv_sharded(path,
+                     engine,
+                     table='event_performance_staging',
+                     columns=EVENT_PERFORMANCE_COLUMNS,
+                     num_workers=None):
+    """
+    Loads a CSV into a staging table with one COPY ... FROM STDIN stream per
+    shard, running the streams concurrently on separate connections.  Unlike
+    COPY ... FROM a server side path, the file only has to be readable by
+    the client.  Each shard commits on its own, so a staging table that is
+    truncated and reloaded is the expected use.
+
+    path (str): location of the CSV file
+
+    engine (sql alchemy engine object): Used to establish connections to the
+    db.  Its pool should allow num_workers connections.
+
+    table (str): name of the table to COPY into
+
+    columns (list of str): table columns in CSV column order
+
+    num_workers (int): number of concurrent COPY streams, defaults to the
+    number of CPU cores
+    """
+
+    from concurrent.futures import ThreadPoolExecutor
+
+    num_workers = num_workers or os.cpu_count() or 1
+    shards = shard_offsets(path, num_workers)
+
+    with ThreadPoolExecutor(max_workers=max(len(shards), 1)) as pool:
+        futures = [pool.submit(_copy_shard, path, start, end, engine, table, columns)
+                   for start, end in shards]
+        bytes_loaded = sum(future.result() for future in futures)
+
+    print(f"Copied {bytes_loaded:,} bytes into {table} "
+          f"using {len(shards)} parallel COPY streams.")
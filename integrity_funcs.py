@@ -0,0 +1,226 @@
+import math
+
+
+class BloomFilter:
+    """
+    Fixed-size Bloom filter over hashed userids.  Membership checks can give
+    false positives (an orphan userid reported as known) at roughly
+    false_positive_rate, but never false negatives, so every userid flagged
+    as an orphan really is missing from users.
+
+    capacity (int): expected number of distinct userids
+
+    false_positive_rate (float): target false positive rate at capacity
+    """
+
+    def __init__(self, capacity, false_positive_rate=0.001):
+        import numpy as np
+
+        capacity = max(int(capacity), 1)
+
+        self.num_bits = max(int(-capacity * math.log(false_positive_rate)
+                                / math.log(2) ** 2), 64)
+        self.num_hashes = max(int(round(self.num_bits / capacity * math.log(2))), 1)
+        self.bits = np.zeros(self.num_bits, dtype=bool)
+
+    def _positions(self, hashes):
+        import numpy as np
+
+        hashes = np.asarray(hashes, dtype=np.uint64)
+        h1 = (hashes & np.uint64(0xFFFFFFFF)).astype(np.int64)
+        h2 = (hashes >> np.uint64(32)).astype(np.int64) | 1
+        rounds = np.arange(self.num_hashes, dtype=np.int64)
+
+        return (h1[:, None] + rounds[None, :] * h2[:, None]) % self.num_bits
+
+    def add_hashes(self, hashes):
+        self.bits[self._positions(hashes).ravel()] = True
+
+        return self
+
+    def contains_hashes(self, hashes):
+        return self.bits[self._positions(hashes)].all(axis=1)
+
+
+class UserIdValidator:
+    """
+    Referential integrity check between incoming event_performance batches
+    and the users table.  The known userids are held in memory, either as an
+    exact hash set or a Bloom filter, so every batch can be checked for
+    orphan (ghost) userids as it arrives instead of running a full anti-join
+    over event_performance after the load.
+
+    known_userids (array-like): every userid present in users
+
+    use_bloom_filter (bool): trade exactness for memory by storing the
+    known userids in a Bloom filter instead of a set
+
+    false_positive_rate (float): Bloom filter false positive rate, ignored
+    when use_bloom_filter is False
+
+    sample_size (int): maximum number of orphan userids kept as a sample in
+    the load report
+    """
+
+    def __init__(self,
+                 known_userids,
+                 use_bloom_filter=False,
+                 false_positive_rate=0.001,
+                 sample_size=10):
+
+        import pandas as pd
+
+        known_userids = pd.unique(pd.Series(known_userids, dtype=object).str.strip())
+
+        self.use_bloom_filter = use_bloom_filter
+        self.sample_size = sample_size
+
+        if use_bloom_filter:
+            from distinct_count_funcs import hash_userids
+
+            self.known = BloomFilter(len(known_userids), false_positive_rate)
+            self.known.add_hashes(hash_userids(known_userids))
+        else:
+            self.known = set(known_userids)
+
+        self.reset()
+
+    @classmethod
+    def from_users_table(cls, engine, **kwargs):
+        """
+        Builds a validator from the userids in the users table.
+
+        engine (sql alchemy engine object): Used to establish a connection to the db
+        """
+
+        from sql_query_helper_funcs import sql_query_to_pandas_df
+
+        users = sql_query_to_pandas_df('SELECT userid FROM users;', engine)
+
+        return cls(users['userid'], **kwargs)
+
+    def reset(self):
+        """
+        Clears the running totals so the validator can be reused for a new
+        load.
+        """
+
+        self.batches = []
+        self.orphan_userids = {}
+
+    def is_known(self, userids):
+        """
+        Returns a boolean NumPy array flagging which userids exist in users.
+
+        userids (array-like): userids to check
+        """
+
+        import numpy as np
+        import pandas as pd
+
+        userids = pd.Series(userids, dtype=object)
+
+        if self.use_bloom_filter:
+            from distinct_count_funcs import hash_userids
+
+            return self.known.contains_hashes(hash_userids(userids.to_numpy()))
+
+        return np.fromiter((userid in self.known for userid in userids),
+                           dtype=bool,
+                           count=len(userids))
+
+    def validate_batch(self, batch, batch_id=None):
+        """
+        Checks one batch of event rows for orphan userids and records the
+        result in the load report.  Returns a boolean Pandas Series aligned
+        with the batch that is True for orphan rows, so callers can decide
+        whether to drop, quarantine or keep them.
+
+        batch (Pandas DataFrame): event rows containing a userid column
+
+        batch_id (hashable): label of the batch in the load report, defaults
+        to its position in the load
+        """
+
+        import pandas as pd
+
+        if batch_id is None:
+            batch_id = len(self.batches)
+
+        # Check each distinct userid once rather than once per row
+        codes, uniques = pd.factorize(batch['userid'])
+        unique_is_orphan = ~self.is_known(uniques)
+        is_orphan = pd.Series(unique_is_orphan[codes] & (codes >= 0),
+                              index=batch.index)
+
+        orphan_uniques = uniques[unique_is_orphan]
+        orphan_row_counts = pd.Series(codes[is_orphan.to_numpy()]).value_counts()
+        for code, num_rows in orphan_row_counts.items():
+            userid = uniques[code]
+            self.orphan_userids[userid] = self.orphan_userids.get(userid, 0) + num_rows
+
+        self.batches.append({'batch_id': batch_id,
+                             'num_rows': len(batch),
+                             'num_orphan_rows': int(is_orphan.sum()),
+                             'num_orphan_userids': len(orphan_uniques),
+                             'sample_orphan_userids': list(orphan_uniques[:self.sample_size])})
+
+        return is_orphan
+
+    def batch_report(self):
+        """
+        Returns a Pandas DataFrame with one row per validated batch.
+        """
+
+        import pandas as pd
+
+        return pd.DataFrame(self.batches,
+                            columns=['batch_id',
+                                     'num_rows',
+                                     'num_orphan_rows',
+                                     'num_orphan_userids',
+                                     'sample_orphan_userids']).set_index('batch_id')
+
+    def load_report(self):
+        """
+        Returns a dict summarizing the whole load: rows and batches checked,
+        orphan rows, distinct orphan userids and a sample of them ordered by
+        number of orphan rows.
+        """
+
+        sample = sorted(self.orphan_userids,
+                        key=self.orphan_userids.get,
+                        reverse=True)[:self.sample_size]
+
+        return {'num_batches': len(self.batches),
+                'num_rows': sum(batch['num_rows'] for batch in self.batches),
+                'num_orphan_rows': sum(self.orphan_userids.values()),
+                'num_orphan_userids': len(self.orphan_userids),
+                'sample_orphan_userids': sample}
+
+
+def validated_event_batches(path, validator, chunksize=100_000, drop_orphans=False):
+    """
+    Reads an event_performance CSV in batches and validates each batch
+    against the users table as it arrives.  Yields one Pandas DataFrame per
+    batch, with orphan rows removed when drop_orphans is True.  The load
+    report is available from the validator afterwards.
+
+    path (str): location of the CSV file
+
+    validator (UserIdValidator): validator holding the known userids
+
+    chunksize (int): number of rows per batch
+
+    drop_orphans (bool): drop rows whose userid is not in users
+    """
+
+    import pandas as pd
+
+    for batch_id, batch in enumerate(pd.read_csv(path,
+                                                 dtype={'userid': str},
+                                                 chunksize=chunksize)):
+        batch['userid'] = batch['userid'].str.replace(r'[" ]', '', regex=True)
+        is_orphan = validator.validate_batch(batch, batch_id=batch_id)
+
+        yield batch[~is_orphan] if drop_orphans else batch
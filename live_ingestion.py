@@ -0,0 +1,568 @@
+"""
+Live ingestion service for gaming events.  Point events are accepted over a
+plain TCP socket (one JSON event, or a JSON list of events, per line) and
+over HTTP, validated with the part 1 cleaning rules, kept in running
+per-user, per-hour and leaderboard totals in memory, and flushed to
+event_performance in micro-batches with COPY.
+
+    python live_ingestion.py --port 8765 --http-port 8080
+
+    echo '{"userid": "...", "event_date": "2019-07-05", "hour": 19, "points": 24}' | nc localhost 8765
+    curl -d @events.json localhost:8080/events
+    curl 'localhost:8080/leaderboard?k=10'
+    curl 'localhost:8080/hours?event_date=2019-07-05'
+    curl localhost:8080/stats
+    curl localhost:8080/metrics
+
+The database connection settings are read from .env like run_report.
+"""
+
+import argparse
+import asyncio
+import bisect
+import datetime
+import functools
+import json
+import time
+
+from ingestion_funcs import EVENT_PERFORMANCE_COLUMNS
+from metrics_funcs import (LIVE_BUFFERED_EVENTS, LIVE_FLUSH_SECONDS, ROWS_LOADED,
+                           ROWS_REJECTED, render_metrics)
+
+
+PROMETHEUS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class InvalidEvent(ValueError):
+    """
+    Raised for an event that fails the part 1 cleaning rules.  The message
+    is the rejection reason.
+    """
+
+
+@functools.lru_cache(maxsize=4096)
+def _parse_event_date(value, today):
+    # Same formats and rules as batch cleaning, cached since a gaming event
+    # only sends a handful of distinct dates.  Live events run up to today,
+    # like the event_date <= CURRENT_DATE check on event_performance, rather
+    # than to the end of the historical analysis, and today is part of the
+    # cache key so the window moves at midnight.
+    from event_date_funcs import DATE_REASONS, parse_event_dates
+
+    dates, reasons = parse_event_dates([value], latest_date=today)
+    reason = DATE_REASONS[reasons[0]]
+
+    if reason in ('before_window', 'after_window'):
+        raise InvalidEvent('event_date outside valid window')
+    if reason != 'valid':
+        raise InvalidEvent('unparseable event_date')
+
+    return str(dates[0])
+
+
+def validate_event(record):
+    """
+    Applies the part 1 cleaning rules to one event: quotes and spaces are
+    stripped from userid, event_date must parse (M/D/YY, M/D/YYYY or
+    YYYY-MM-DD) and fall between EARLIEST_EVENT_DATE and today, hour must
+    be 0-23, and points must be an integer once quotes and question marks
+    are stripped.  Returns a tuple of (userid, event_date, hour, points)
+    with event_date as an ISO string, or raises InvalidEvent with the
+    reason.
+
+    record (dict): event with userid, event_date, hour and points keys
+    """
+
+    try:
+        userid, event_date, hour, points = (record[column]
+                                            for column in EVENT_PERFORMANCE_COLUMNS)
+    except (KeyError, TypeError):
+        raise InvalidEvent('missing field') from None
+
+    userid = str(userid).replace('"', '').replace(' ', '')
+    if not userid:
+        raise InvalidEvent('missing userid')
+
+    try:
+        hour = int(hour)
+    except (TypeError, ValueError):
+        raise InvalidEvent('unparseable hour') from None
+    if not 0 <= hour <= 23:
+        raise InvalidEvent('hour outside 0-23')
+
+    try:
+        points = int(str(points).replace('"', '').replace('?', ''))
+    except ValueError:
+        raise InvalidEvent('unparseable points') from None
+
+    event_date = _parse_event_date(str(event_date), datetime.date.today().isoformat())
+
+    return userid, event_date, hour, points
+
+
+class Leaderboard:
+    """
+    Running point totals per user with the users kept in rank order, so
+    reading the top K costs O(K) no matter how many users there are.  The
+    ranking is a sorted list of (-total, userid) updated with bisect; moving
+    a user is a binary search plus a memmove, which stays in the
+    microseconds for tens of thousands of users.  Totals can go down as well
+    as up, which a heap can't track without rebuilding.
+    """
+
+    def __init__(self):
+        self.totals = {}
+        self.ranking = []
+
+    def add(self, userid, points):
+        old_total = self.totals.get(userid)
+        new_total = (old_total or 0) + points
+
+        if old_total is not None:
+            del self.ranking[bisect.bisect_left(self.ranking, (-old_total, userid))]
+
+        bisect.insort(self.ranking, (-new_total, userid))
+        self.totals[userid] = new_total
+
+    def top(self, k=10):
+        """
+        Returns a list of the top k users as dicts with rank, userid and
+        total_points.  Tied users share a rank.
+        """
+
+        leaders = []
+        rank = 0
+        previous = None
+        for position, (negative_total, userid) in enumerate(self.ranking[:k], start=1):
+            if negative_total != previous:
+                rank, previous = position, negative_total
+            leaders.append({'rank': rank, 'userid': userid, 'total_points': -negative_total})
+
+        return leaders
+
+    def rank_of(self, userid):
+        """
+        Returns the rank of a user, or None if they haven't played.
+        """
+
+        if userid not in self.totals:
+            return None
+
+        return bisect.bisect_left(self.ranking, (-self.totals[userid], '')) + 1
+
+    def __len__(self):
+        return len(self.totals)
+
+
+class LiveStandings:
+    """
+    In-memory running totals of validated events: a Leaderboard per gaming
+    event (event_date) and point and event counts per (event_date, hour).
+    """
+
+    def __init__(self):
+        self.leaderboards = {}
+        self.hour_totals = {}
+        self.latest_event_date = None
+
+    def add(self, userid, event_date, hour, points):
+        leaderboard = self.leaderboards.get(event_date)
+        if leaderboard is None:
+            leaderboard = self.leaderboards[event_date] = Leaderboard()
+        leaderboard.add(userid, points)
+
+        totals = self.hour_totals.setdefault((event_date, hour), [0, 0])
+        totals[0] += points
+        totals[1] += 1
+
+        if self.latest_event_date is None or event_date > self.latest_event_date:
+            self.latest_event_date = event_date
+
+    def leaderboard(self, event_date=None, k=10):
+        """
+        Returns the top k users of a gaming event, the latest one by
+        default.
+        """
+
+        event_date = event_date or self.latest_event_date
+        leaderboard = self.leaderboards.get(event_date)
+
+        return {'event_date': event_date,
+                'users': 0 if leaderboard is None else len(leaderboard),
+                'leaders': [] if leaderboard is None else leaderboard.top(k)}
+
+    def hours(self, event_date=None):
+        """
+        Returns the points and events per hour of a gaming event, the latest
+        one by default.
+        """
+
+        event_date = event_date or self.latest_event_date
+
+        return {'event_date': event_date,
+                'hours': [{'hour': hour, 'points': points, 'events': events}
+                          for (day, hour), (points, events) in sorted(self.hour_totals.items())
+                          if day == event_date]}
+
+
+def copy_rows(engine, rows, table='event_performance'):
+    """
+    Writes (userid, event_date, hour, points) tuples to a table with one
+    COPY ... FROM STDIN and commits.  Returns the number of rows written.
+
+    engine (sql alchemy engine object): Used to establish a connection to the db
+
+    rows (list of tuples): validated events
+
+    table (str): name of the table to COPY into
+    """
+
+    import csv
+    import io
+
+    data = io.StringIO()
+    csv.writer(data).writerows(rows)
+    data.seek(0)
+
+    conn = engine.raw_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.copy_expert(f"COPY {table}({', '.join(EVENT_PERFORMANCE_COLUMNS)}) "
+                           "FROM STDIN WITH (FORMAT csv)",
+                           data)
+        conn.commit()
+    finally:
+        conn.close()
+
+    return len(rows)
+
+
+class EventIngestionService:
+    """
+    Asyncio service that validates incoming events, updates LiveStandings
+    immediately and buffers the events for micro-batch COPYs to the
+    database, so reads never wait on the database.  A batch is flushed
+    every flush_interval seconds or as soon as batch_size events are
+    buffered.  COPYs run in a worker thread one at a time, in arrival order.
+
+    engine (sql alchemy engine object): Used to establish a connection to
+    the db, or None to keep events in memory only
+
+    table (str): table the events are copied into
+
+    batch_size (int): buffered events that trigger a flush
+
+    flush_interval (float): seconds between flushes
+
+    validator (integrity_funcs.UserIdValidator): optional check that userids
+    exist in users; unknown userids are rejected
+    """
+
+    def __init__(self,
+                 engine=None,
+                 table='event_performance',
+                 batch_size=5000,
+                 flush_interval=1.0,
+                 validator=None):
+        self.engine = engine
+        self.table = table
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.validator = validator
+
+        self.standings = LiveStandings()
+        self.buffer = []
+        self.stats = {'accepted': 0, 'rejected': 0, 'flushed': 0, 'flushes': 0,
+                      'last_flush_seconds': None, 'rejections': {}}
+
+        self._servers = []
+        self._flush_requested = None
+        self._flusher = None
+        self._flush_lock = None
+
+    def ingest(self, records):
+        """
+        Validates and applies a list of event dicts.  Returns a dict with
+        the accepted and rejected counts and the reasons for rejections.
+        """
+
+        events = []
+        reasons = {}
+
+        for record in records:
+            try:
+                events.append(validate_event(record))
+            except InvalidEvent as e:
+                reasons[str(e)] = reasons.get(str(e), 0) + 1
+
+        if self.validator is not None and events:
+            is_known = self.validator.is_known([event[0] for event in events])
+            if not is_known.all():
+                reasons['unknown userid'] = int((~is_known).sum())
+                events = [event for event, known in zip(events, is_known) if known]
+
+        for event in events:
+            self.standings.add(*event)
+        self.buffer.extend(events)
+        accepted = len(events)
+
+        self.stats['accepted'] += accepted
+        rejected = self._record_rejections(reasons)
+
+        if len(self.buffer) >= self.batch_size and self._flush_requested is not None:
+            self._flush_requested.set()
+
+        return {'accepted': accepted, 'rejected': rejected, 'reasons': reasons}
+
+    def _record_rejections(self, reasons):
+        """
+        Adds rejected events by reason to stats and ROWS_REJECTED.  Returns
+        the number rejected.
+        """
+
+        rejected = sum(reasons.values())
+        self.stats['rejected'] += rejected
+        for reason, count in reasons.items():
+            self.stats['rejections'][reason] = self.stats['rejections'].get(reason, 0) + count
+            ROWS_REJECTED.labels('live', reason).inc(count)
+
+        return rejected
+
+    async def flush(self):
+        """
+        Copies the buffered events to the database.  Returns the number of
+        rows written.
+        """
+
+        async with self._flush_lock:
+            rows, self.buffer = self.buffer, []
+            if not rows or self.engine is None:
+                return 0
+
+            start = time.perf_counter()
+            loop = asyncio.get_running_loop()
+            try:
+                written = await loop.run_in_executor(None, copy_rows, self.engine, rows, self.table)
+            except Exception:
+                # Keep the rows for the next flush rather than losing them
+                self.buffer = rows + self.buffer
+                raise
+
+            self.stats['flushed'] += written
+            self.stats['flushes'] += 1
+            self.stats['last_flush_seconds'] = time.perf_counter() - start
+            ROWS_LOADED.labels(self.table).inc(written)
+            LIVE_FLUSH_SECONDS.observe(self.stats['last_flush_seconds'])
+
+            return written
+
+    async def _flush_periodically(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._flush_requested.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._flush_requested.clear()
+
+            try:
+                await self.flush()
+            except Exception as e:
+                print(f"Flush failed, will retry: {e}")
+
+    def _decode(self, payload):
+        """
+        Turns a request payload into a list of event dicts.  Accepts one
+        JSON event, a JSON list of events or newline delimited JSON.
+        """
+
+        payload = payload.strip()
+        if not payload:
+            return []
+
+        try:
+            decoded = json.loads(payload)
+        except json.JSONDecodeError:
+            decoded = [json.loads(line) for line in payload.splitlines() if line.strip()]
+
+        return decoded if isinstance(decoded, list) else [decoded]
+
+    async def _handle_socket(self, reader, writer):
+        try:
+            while line := await reader.readline():
+                try:
+                    result = self.ingest(self._decode(line))
+                except json.JSONDecodeError:
+                    reasons = {'invalid json': 1}
+                    result = {'accepted': 0,
+                              'rejected': self._record_rejections(reasons),
+                              'reasons': reasons}
+                writer.write(json.dumps(result).encode() + b'\n')
+                await writer.drain()
+        except (ConnectionError, asyncio.CancelledError):
+            # Clients dropping off, or the service shutting down
+            pass
+        finally:
+            writer.close()
+
+    def _route(self, method, target, body):
+        from urllib.parse import parse_qs, urlsplit
+
+        url = urlsplit(target)
+        query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+
+        if method == 'POST' and url.path == '/events':
+            try:
+                return 200, self.ingest(self._decode(body))
+            except json.JSONDecodeError:
+                self._record_rejections({'invalid json': 1})
+                return 400, {'error': 'invalid json'}
+        if method == 'GET' and url.path == '/leaderboard':
+            try:
+                k = int(query.get('k', 10))
+            except ValueError:
+                return 400, {'error': 'k must be an integer'}
+            if k < 0:
+                return 400, {'error': 'k must not be negative'}
+            return 200, self.standings.leaderboard(query.get('event_date'), k)
+        if method == 'GET' and url.path == '/hours':
+            return 200, self.standings.hours(query.get('event_date'))
+        if method == 'GET' and url.path == '/stats':
+            return 200, {**self.stats, 'buffered': len(self.buffer)}
+        if method == 'GET' and url.path == '/metrics':
+            return 200, render_metrics()
+
+        return 404, {'error': f'no route for {method} {url.path}'}
+
+    async def _handle_http(self, reader, writer):
+        reasons = {200: 'OK', 400: 'Bad Request', 404: 'Not Found'}
+
+        try:
+            while request_line := await reader.readline():
+                try:
+                    method, target, _ = request_line.decode('latin-1').split(' ', 2)
+
+                    headers = {}
+                    while (header := await reader.readline()) not in (b'\r\n', b'\n', b''):
+                        name, _, value = header.decode('latin-1').partition(':')
+                        headers[name.strip().lower()] = value.strip()
+
+                    body = await reader.readexactly(int(headers.get('content-length', 0)))
+                    body = body.decode()
+                except ValueError:
+                    # A malformed request line, Content-Length or body, after
+                    # which the rest of the stream can't be framed
+                    status, response, close = 400, {'error': 'malformed request'}, True
+                else:
+                    status, response = self._route(method, target, body)
+                    close = headers.get('connection', '').lower() == 'close'
+
+                if isinstance(response, str):
+                    payload, content_type = response.encode(), PROMETHEUS_CONTENT_TYPE
+                else:
+                    payload, content_type = json.dumps(response).encode(), 'application/json'
+                writer.write(f'HTTP/1.1 {status} {reasons[status]}\r\n'
+                             f'Content-Type: {content_type}\r\n'
+                             f'Content-Length: {len(payload)}\r\n\r\n'.encode() + payload)
+                await writer.drain()
+
+                if close:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            writer.close()
+
+    async def start(self, host='127.0.0.1', port=8765, http_port=8080):
+        """
+        Starts the socket and HTTP listeners and the periodic flusher.
+        Either port can be None to skip that listener.
+        """
+
+        self._flush_requested = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        LIVE_BUFFERED_EVENTS.set_function(lambda: len(self.buffer))
+        self._flusher = asyncio.create_task(self._flush_periodically())
+
+        if port is not None:
+            self._servers.append(await asyncio.start_server(self._handle_socket, host, port))
+        if http_port is not None:
+            self._servers.append(await asyncio.start_server(self._handle_http, host, http_port))
+
+    async def stop(self):
+        """
+        Stops accepting events and flushes whatever is still buffered.
+        """
+
+        for server in self._servers:
+            server.close()
+            await server.wait_closed()
+        self._servers = []
+
+        if self._flusher is not None:
+            self._flusher.cancel()
+            try:
+                await self._flusher
+            except asyncio.CancelledError:
+                pass
+
+        await self.flush()
+
+    async def serve_forever(self, host='127.0.0.1', port=8765, http_port=8080):
+        await self.start(host, port, http_port)
+        try:
+            await asyncio.Event().wait()
+        finally:
+            await self.stop()
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Ingest live gaming events and serve leaderboards.')
+    parser.add_argument('--host', default='127.0.0.1',
+                        help='interface to listen on')
+    parser.add_argument('--port', type=int, default=8765,
+                        help='port of the line delimited JSON socket')
+    parser.add_argument('--http-port', type=int, default=8080,
+                        help='port of the HTTP listener')
+    parser.add_argument('--table', default='event_performance',
+                        help='table events are copied into')
+    parser.add_argument('--batch-size', type=int, default=5000,
+                        help='buffered events that trigger a flush')
+    parser.add_argument('--flush-interval', type=float, default=1.0,
+                        help='seconds between flushes')
+    parser.add_argument('--check-userids', action='store_true',
+                        help='reject events whose userid is not in users')
+    parser.add_argument('--no-db', action='store_true',
+                        help='keep events in memory only')
+
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    engine = None
+    validator = None
+    if not args.no_db:
+        from run_report import create_engine_from_env
+
+        engine = create_engine_from_env()
+
+        if args.check_userids:
+            from integrity_funcs import UserIdValidator
+
+            validator = UserIdValidator.from_users_table(engine)
+
+    service = EventIngestionService(engine,
+                                    table=args.table,
+                                    batch_size=args.batch_size,
+                                    flush_interval=args.flush_interval,
+                                    validator=validator)
+
+    try:
+        asyncio.run(service.serve_forever(args.host, args.port, args.http_port))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
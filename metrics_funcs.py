@@ -0,0 +1,405 @@
+# Operational metrics of the pipeline, exported in the Prometheus text format
+# as a file for the node exporter's textfile collector or from the live
+# ingestion service's /metrics endpoint.  Every metric the pipeline records
+# is declared at the bottom of this module.  Recording a value is a dict
+# lookup for the label values, an uncontended lock and an addition, and
+# gauges for memory and pool usage are only read when the metrics are
+# rendered.
+
+import bisect
+import math
+import os
+import threading
+import time
+
+
+# Seconds, spanning memoized lookups to full scans of the events table
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    if value == -math.inf:
+        return '-Inf'
+
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+               for value in labels.values())
+
+    return '{' + ','.join(f'{name}="{value}"' for name, value in zip(labels, escaped)) + '}'
+
+
+class _CounterValue:
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        if amount < 0:
+            raise ValueError('Counters only go up, use a gauge')
+        with self._lock:
+            self.value += amount
+
+    def samples(self):
+        return [('', {}, self.value)]
+
+
+class _GaugeValue:
+    def __init__(self):
+        self.value = 0
+        self.function = None
+        self._lock = threading.Lock()
+
+    def set(self, value):
+        self.value = value
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def dec(self, amount=1):
+        self.inc(-amount)
+
+    def set_function(self, function):
+        """
+        Reads the gauge from function when the metrics are rendered instead
+        of from set calls.  Rendering skips the gauge while function raises
+        or returns None.
+        """
+
+        self.function = function
+
+    def samples(self):
+        if self.function is None:
+            return [('', {}, self.value)]
+
+        try:
+            value = self.function()
+        except Exception:
+            return []
+
+        return [] if value is None else [('', {}, value)]
+
+
+class _HistogramValue:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        # The bucket is found before locking, the lock only covers two adds
+        bucket = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[bucket] += 1
+            self.sum += value
+
+    def time(self):
+        """
+        Context manager observing the seconds spent in its block.
+        """
+
+        return _Timer(self)
+
+    def samples(self):
+        with self._lock:
+            counts, total = list(self.counts), self.sum
+
+        cumulative, samples = 0, []
+        for bound, count in zip(self.buckets + (math.inf,), counts):
+            cumulative += count
+            samples.append(('_bucket', {'le': _format_value(bound)}, cumulative))
+
+        return samples + [('_sum', {}, total), ('_count', {}, cumulative)]
+
+
+class _Timer:
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.start)
+
+
+class Metric:
+    """
+    A named metric with one value per combination of label values.  Values
+    are created on first use by labels(); a metric without labels records
+    directly, ie ROWS_LOADED.labels('users').inc(1100) or
+    ANALYSIS_RUN_SECONDS.observe(2.5).
+
+    kind (str): 'counter', 'gauge' or 'histogram'
+
+    name (str): metric name, ending in _total for counters
+
+    documentation (str): help text
+
+    labelnames (list of str): names of the labels
+
+    buckets (tuple of float): upper bounds of a histogram's buckets
+    """
+
+    def __init__(self, kind, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.kind = kind
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+        self._values = {}
+        self._lock = threading.Lock()
+
+        if not self.labelnames:
+            self._default = self.labels()
+
+    def _new_value(self):
+        if self.kind == 'counter':
+            return _CounterValue()
+        if self.kind == 'gauge':
+            return _GaugeValue()
+
+        return _HistogramValue(self.buckets)
+
+    def labels(self, *values, **named_values):
+        """
+        Returns the value recording for the given label values, passed in
+        labelnames order or by name.
+        """
+
+        # Already recorded label values take a single lookup
+        value = None if named_values else self._values.get(values)
+        if value is not None:
+            return value
+
+        if named_values:
+            values = values + tuple(named_values[name] for name in self.labelnames[len(values):])
+        key = tuple(str(value) for value in values)
+
+        value = self._values.get(key)
+        if value is None:
+            if len(key) != len(self.labelnames):
+                raise ValueError(f"{self.name} takes the labels {list(self.labelnames)}")
+            with self._lock:
+                value = self._values.setdefault(key, self._new_value())
+
+        return value
+
+    def inc(self, amount=1):
+        self._default.inc(amount)
+
+    def dec(self, amount=1):
+        self._default.dec(amount)
+
+    def set(self, value):
+        self._default.set(value)
+
+    def set_function(self, function):
+        self._default.set_function(function)
+
+    def observe(self, value):
+        self._default.observe(value)
+
+    def time(self):
+        return self._default.time()
+
+    def render(self):
+        """
+        Returns the metric in the Prometheus text format.
+        """
+
+        lines = [f'# HELP {self.name} {self.documentation}',
+                 f'# TYPE {self.name} {self.kind}']
+
+        with self._lock:
+            values = sorted(self._values.items())
+
+        for key, value in values:
+            labels = dict(zip(self.labelnames, key))
+            for suffix, extra_labels, sample in value.samples():
+                lines.append(f'{self.name}{suffix}{_format_labels({**labels, **extra_labels})} '
+                             f'{_format_value(sample)}')
+
+        return '\n'.join(lines) + '\n'
+
+
+class MetricsRegistry:
+    """
+    The set of metrics rendered together.  Asking for a metric that is
+    already registered returns it, so modules can declare the metrics they
+    record wherever they are first used.
+    """
+
+    def __init__(self):
+        self.metrics = {}
+        self._lock = threading.Lock()
+
+    def _metric(self, kind, name, documentation, labelnames, **kwargs):
+        with self._lock:
+            metric = self.metrics.get(name)
+            if metric is None:
+                metric = self.metrics[name] = Metric(kind, name, documentation,
+                                                     labelnames, **kwargs)
+
+        if metric.kind != kind or metric.labelnames != tuple(labelnames):
+            raise ValueError(f"{name} is already registered as a {metric.kind} "
+                             f"with the labels {list(metric.labelnames)}")
+
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._metric('counter', name, documentation, labelnames)
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self._metric('gauge', name, documentation, labelnames)
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._metric('histogram', name, documentation, labelnames, buckets=buckets)
+
+    def render(self):
+        """
+        Returns every metric in the Prometheus text format.
+        """
+
+        with self._lock:
+            metrics = list(self.metrics.values())
+
+        return ''.join(metric.render() for metric in metrics)
+
+    def write(self, path):
+        """
+        Writes the rendered metrics to path, replacing the file in one step
+        so a collector never reads a partial file.
+        """
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        tmp_path = f'{path}.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(self.render())
+        os.replace(tmp_path, path)
+
+
+REGISTRY = MetricsRegistry()
+
+
+def render_metrics(registry=REGISTRY):
+    """
+    Returns the registry's metrics in the Prometheus text format.
+    """
+
+    return registry.render()
+
+
+def write_metrics(path, registry=REGISTRY):
+    """
+    Writes the registry's metrics to path in the Prometheus text format,
+    ie into the node exporter's --collector.textfile.directory as a .prom
+    file.
+
+    path (str): location of the file
+    """
+
+    registry.write(path)
+
+
+def _resident_memory_bytes():
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+def _peak_resident_memory_bytes():
+    import resource
+    import sys
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Reported in bytes on macOS and kilobytes elsewhere
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def register_pool_metrics(engine):
+    """
+    Reports the connections of a SQLAlchemy engine's QueuePool in
+    POOL_CONNECTIONS: checked out, idle in the pool and opened beyond
+    pool_size.  Only the last registered engine is reported.  Engines
+    without a QueuePool, ie a LocalDatabase, are ignored.
+
+    engine (sql alchemy engine object): engine whose pool to report
+    """
+
+    pool = getattr(engine, 'pool', None)
+    if not all(hasattr(pool, method) for method in ('checkedout', 'checkedin', 'overflow')):
+        return
+
+    POOL_CONNECTIONS.labels('checked_out').set_function(pool.checkedout)
+    POOL_CONNECTIONS.labels('idle').set_function(pool.checkedin)
+    # overflow() counts up from -pool_size until the pool is full
+    POOL_CONNECTIONS.labels('overflow').set_function(lambda: max(pool.overflow(), 0))
+
+
+# Metrics recorded by the pipeline
+ROWS_LOADED = REGISTRY.counter(
+    'botbattles_rows_loaded_total',
+    'Rows committed to a table by the spool loader or live ingestion',
+    ['table'])
+
+ROWS_REJECTED = REGISTRY.counter(
+    'botbattles_rows_rejected_total',
+    'Rows dropped by a cleaning or deduplication rule',
+    ['stage', 'reason'])
+
+QUERY_SECONDS = REGISTRY.histogram(
+    'botbattles_query_seconds',
+    'Latency of queries sent through the SQL helpers',
+    ['backend', 'kind'])
+
+QUERIES_CANCELLED = REGISTRY.counter(
+    'botbattles_queries_cancelled_total',
+    'Queries stopped by a statement timeout or a CancelToken',
+    ['backend', 'reason'])
+
+ANALYSIS_CACHE = REGISTRY.counter(
+    'botbattles_analysis_cache_total',
+    'Analysis products loaded from the cache (hit) or recomputed (miss)',
+    ['result'])
+
+ANALYSIS_RUN_SECONDS = REGISTRY.histogram(
+    'botbattles_analysis_run_seconds',
+    'Duration of AnalysisDAG runs')
+
+LIVE_FLUSH_SECONDS = REGISTRY.histogram(
+    'botbattles_live_flush_seconds',
+    'Duration of live ingestion flushes to the database')
+
+LIVE_BUFFERED_EVENTS = REGISTRY.gauge(
+    'botbattles_live_buffered_events',
+    'Validated live events waiting for the next flush')
+
+POOL_CONNECTIONS = REGISTRY.gauge(
+    'botbattles_pool_connections',
+    'Database connections of the pool by state, see register_pool_metrics',
+    ['state'])
+
+RESIDENT_MEMORY = REGISTRY.gauge(
+    'botbattles_process_resident_memory_bytes',
+    'Resident memory of the process')
+RESIDENT_MEMORY.set_function(_resident_memory_bytes)
+
+PEAK_RESIDENT_MEMORY = REGISTRY.gauge(
+    'botbattles_process_peak_resident_memory_bytes',
+    'Peak resident memory of the process')
+PEAK_RESIDENT_MEMORY.set_function(_peak_resident_memory_bytes)
@@ -28,6 +28,10 @@ import traceback
 
 from sql_query_helper_funcs import exec_and_commit_query, sql_query_to_pandas_df
 
+from spool_funcs import read_dedup_report, spool_and_load
+
+from event_date_funcs import event_date_formats, normalize_event_dates
+
 import pandas as pd
 
 from sqlalchemy import create_engine
@@ -87,15 +91,20 @@ COPY users_staging(userid, subscriber, category)
 FROM '{working_dir}/data/users.csv'
 DELIMITER ','
 CSV HEADER;
-
-COPY event_performance_staging(userid, event_date, hour, points)
-FROM '{working_dir}/data/event_performance.csv'
-DELIMITER ','
-CSV HEADER;
 """.format(working_dir = wd)
 
 exec_and_commit_query(sql_query, engine)
 
+# Event files are spooled into checksummed batches and committed batch by
+# batch.  Rerunning just this cell after an interruption resumes where it
+# stopped; rerunning the cells above recreates event_performance_staging,
+# after which every batch is loaded again.  Duplicate events are dropped on
+# the way into the spool.
+spool_and_load('data/event_performance.csv',
+               'data/spool/event_performance',
+               engine,
+               dedup='first')
+
 # %% [markdown]
 # # Checking for NULL Values
 
@@ -146,14 +155,9 @@ sql_query_to_pandas_df(sql_query, engine)
 # No duplicate values found in the users_staging table.
 
 # %%
-sql_query = """ 
-  SELECT userid, event_date, hour, points, COUNT(*)
-    FROM event_performance_staging
-    GROUP BY userid, event_date, hour, points
-    HAVING COUNT(*) > 1;
-"""
-
-sql_query_to_pandas_df(sql_query, engine)
+# Exact duplicates and rows repeating a (userid, event_date, hour) were
+# counted per batch by the loader while spooling
+read_dedup_report('data/spool/event_performance').sum()
 
 # %% [markdown]
 # No duplicate values found in the event_performance_staging table.
@@ -270,6 +274,19 @@ except Exception as e:
 # %% [markdown]
 # The error is caused by one entry in the event_date column that's set to "19/24/2019".  Since there's no way to identify whether this date is meant to be "1/24/2019" or "9/24/2019" or perhaps something else entirely, the safest option is to drop it.  Dropping one entry in a dataset this size shouldn't make much of a difference.
 
+# %% [markdown]
+# Classifying the raw event_date strings by shape, each digit replaced by 9, confirms that "19/24/2019" is the only one not in the M/D/YY format, and `normalize_event_dates` gives the reason each rejected date is invalid.  It also flags the two dates from 1999 and 2039 that parse fine but fall outside the window of valid event dates.
+
+# %%
+raw_event_dates = pd.read_csv('data/event_performance.csv', usecols=['date'], dtype=str)['date']
+
+event_date_formats(raw_event_dates)
+
+# %%
+normalized_dates = normalize_event_dates(raw_event_dates)
+
+normalized_dates.assign(raw_event_date=raw_event_dates)[normalized_dates['reason'] != 'valid']
+
 # %%
 sql_query = """
 DELETE FROM event_performance_staging
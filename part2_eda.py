@@ -28,6 +28,10 @@ import datetime
 
 from sql_query_helper_funcs import exec_and_commit_query, sql_query_to_pandas_df
 
+from time_series_funcs import event_day_stats_query, extreme_days
+
+from query_template_funcs import points_per_period
+
 import pandas as pd
 
 from sqlalchemy import create_engine
@@ -409,50 +413,14 @@ plt.tight_layout();
 # ### Total Points Per Month Based on User Type (Users With Positive Point Totals vs. Users With Negative Point Totals)
 
 # %%
-sql_query = """
-WITH users_with_positive_totals AS (
-  SELECT userid
-    FROM event_performance
-GROUP BY userid
-  HAVING SUM(points) > 0
-  )
-
-SELECT DATE_TRUNC('month', event_date)::date AS month
-     , SUM(points) AS total_positive_points
-FROM event_performance
-WHERE userid IN (SELECT userid FROM users_with_positive_totals)
-GROUP BY DATE_TRUNC('month', event_date)
-ORDER BY 1;
-"""
-
 users_total_positive_points_per_month = \
-                                sql_query_to_pandas_df(sql_query,
-                                                       engine,
-                                                       index_column='month',
-                                                       dates_column='month')
+                        points_per_period(engine, 'month', sign='positive')[['total_points']] \
+                            .rename(columns={'total_points': 'total_positive_points'})
 
 # %%
-sql_query = """
-WITH users_with_negative_totals AS (
-  SELECT userid
-    FROM event_performance
-GROUP BY userid
-  HAVING SUM(points) < 0
-  )
-
-SELECT DATE_TRUNC('month', event_date)::date AS month
-     , SUM(points) AS total_negative_points
-FROM event_performance
-WHERE userid IN (SELECT userid FROM users_with_negative_totals)
-GROUP BY DATE_TRUNC('month', event_date)
-ORDER BY 1;
-"""
-
 users_total_negative_points_per_month = \
-                                sql_query_to_pandas_df(sql_query,
-                                                       engine,
-                                                       index_column='month',
-                                                       dates_column='month')
+                        points_per_period(engine, 'month', sign='negative')[['total_points']] \
+                            .rename(columns={'total_points': 'total_negative_points'})
 
 # %%
 positive_users_min_total = users_total_positive_points_per_month['total_positive_points'].min()
@@ -561,7 +529,8 @@ SELECT userid
 event_performance_with_seasons = sql_query_to_pandas_df(sql_query,
                                                         engine,
                                                         index_column='event_date',
-                                                        dates_column='event_date')
+                                                        dates_column='event_date',
+                                                        optimize_dtypes=True)
 
 # %%
 event_performance_spring = event_performance_with_seasons[event_performance_with_seasons['season']=='spring']
@@ -572,13 +541,13 @@ event_performance_fall = event_performance_with_seasons[event_performance_with_s
 
 event_performance_winter = event_performance_with_seasons[event_performance_with_seasons['season']=='winter']
 
-hourly_point_totals_spring = event_performance_spring.groupby('hour').agg(sum)[['points']]
+hourly_point_totals_spring = event_performance_spring.groupby('hour')[['points']].sum()
 
-hourly_point_totals_summer = event_performance_summer.groupby('hour').agg(sum)[['points']]
+hourly_point_totals_summer = event_performance_summer.groupby('hour')[['points']].sum()
 
-hourly_point_totals_fall = event_performance_fall.groupby('hour').agg(sum)[['points']]
+hourly_point_totals_fall = event_performance_fall.groupby('hour')[['points']].sum()
 
-hourly_point_totals_winter = event_performance_winter.groupby('hour').agg(sum)[['points']]
+hourly_point_totals_winter = event_performance_winter.groupby('hour')[['points']].sum()
 
 # %%
 fig, ax = plt.subplots(1, 4, sharex=True, sharey=True, figsize=(10,5))
@@ -613,39 +582,17 @@ plt.tight_layout();
 # ## Total Points Per Gaming Event
 
 # %%
-sql_query = """
-  SELECT DATE_TRUNC('day', event_date)::date AS day
-       , SUM(points) AS total_points
-    FROM event_performance
-GROUP BY DATE_TRUNC('day', event_date)::date
-ORDER BY 1;
-"""
+sql_query = event_day_stats_query(window=7)
 
-total_points_per_day = sql_query_to_pandas_df(sql_query,
-                                              engine,
-                                              index_column='day',
-                                              dates_column='day')
+event_day_stats = sql_query_to_pandas_df(sql_query,
+                                         engine,
+                                         index_column='day',
+                                         dates_column='day')
 
 # %%
-sql_query = """
-WITH total_points_per_day AS (
-  SELECT DATE_TRUNC('day', event_date)::date AS day
-       , SUM(points) AS total_points
-    FROM event_performance
-GROUP BY DATE_TRUNC('day', event_date)::date
-)
-
-  SELECT day
-       , total_points
-    FROM total_points_per_day
-   WHERE total_points = (SELECT MIN(total_points) FROM total_points_per_day)
-      OR total_points = (SELECT MAX(total_points) FROM total_points_per_day);
-"""
+total_points_per_day = event_day_stats[['total_points']]
 
-extreme_points_days = sql_query_to_pandas_df(sql_query,
-                                             engine,
-                                             index_column='day',
-                                             dates_column='day')
+extreme_points_days = extreme_days(event_day_stats)
 
 # %%
 num_gaming_events = quantitative_summary_stats.loc['num_gaming_events'][0]
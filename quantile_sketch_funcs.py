@@ -0,0 +1,425 @@
+import math
+import struct
+
+
+SUMMARY_QUANTILES = {'min': 0.0, 'q1': 0.25, 'median': 0.5, 'q3': 0.75, 'max': 1.0}
+
+
+class TDigest:
+    """
+    Mergeable t-digest sketch of a distribution for approximate quantiles,
+    CDFs and histograms.  Values are summarized by weighted centroids that
+    are kept small near the tails, so extreme quantiles stay accurate and the
+    most extreme values are kept exactly.  Two digests are merged by pooling
+    their centroids and compressing again, so a digest per gaming event, user
+    or segment can be combined into any range without rescanning events.
+
+    With fewer than about compression / pi values every value is its own
+    centroid and quantiles match PERCENTILE_CONT exactly.
+
+    compression (float): size parameter, the digest keeps roughly
+    compression centroids.  Larger is more accurate and larger to store.
+    """
+
+    def __init__(self, compression=200, means=None, weights=None,
+                 minimum=math.inf, maximum=-math.inf):
+        import numpy as np
+
+        if compression < 10:
+            raise ValueError('compression must be at least 10')
+
+        self.compression = float(compression)
+        self.means = np.zeros(0) if means is None else np.asarray(means, dtype=np.float64)
+        self.weights = np.zeros(0) if weights is None else np.asarray(weights, dtype=np.float64)
+        self.min = minimum
+        self.max = maximum
+
+    @classmethod
+    def from_values(cls, values, compression=200):
+        """
+        Builds a digest from an array-like of numbers.
+        """
+
+        return cls(compression).add(values)
+
+    @property
+    def count(self):
+        return float(self.weights.sum())
+
+    def _scale(self, q):
+        import numpy as np
+
+        # k1 scale function, steep at the tails so clusters there stay small
+        return self.compression / (2 * math.pi) * np.arcsin(2 * q - 1)
+
+    def _compress(self, means, weights):
+        import numpy as np
+
+        order = np.argsort(means, kind='stable')
+        means = means[order]
+        weights = weights[order]
+
+        total = weights.sum()
+        if len(means) == 0 or total == 0:
+            return means, weights
+
+        # Centroids whose left edges fall within the same unit of the scale
+        # function are merged, which bounds the size of every cluster
+        left_q = (np.cumsum(weights) - weights) / total
+        clusters = np.floor(self._scale(left_q) - self._scale(0)).astype(np.int64)
+        starts = np.flatnonzero(np.r_[True, clusters[1:] != clusters[:-1]])
+
+        merged_weights = np.add.reduceat(weights, starts)
+        merged_means = np.add.reduceat(means * weights, starts) / merged_weights
+
+        return merged_means, merged_weights
+
+    def add(self, values, weights=None):
+        """
+        Adds an array-like of numbers, optionally weighted, to the digest.
+        Returns the digest.
+        """
+
+        import numpy as np
+
+        values = np.asarray(values, dtype=np.float64).ravel()
+        values_weights = (np.ones(len(values)) if weights is None
+                          else np.asarray(weights, dtype=np.float64).ravel())
+
+        keep = ~np.isnan(values)
+        values, values_weights = values[keep], values_weights[keep]
+        if len(values) == 0:
+            return self
+
+        self.min = min(self.min, float(values.min()))
+        self.max = max(self.max, float(values.max()))
+        self.means, self.weights = self._compress(np.concatenate([self.means, values]),
+                                                  np.concatenate([self.weights, values_weights]))
+
+        return self
+
+    def merge(self, other):
+        """
+        Merges another digest into this one in place.
+        """
+
+        import numpy as np
+
+        if other.count == 0:
+            return self
+
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        self.means, self.weights = self._compress(np.concatenate([self.means, other.means]),
+                                                  np.concatenate([self.weights, other.weights]))
+
+        return self
+
+    def copy(self):
+        return TDigest(self.compression, self.means.copy(), self.weights.copy(),
+                       self.min, self.max)
+
+    def _positions(self):
+        import numpy as np
+
+        # Rank of each centroid's middle, with the exact min and max pinned
+        # to the first and last ranks
+        centers = np.cumsum(self.weights) - self.weights / 2
+        positions = np.concatenate([[0.5], centers, [self.count - 0.5]])
+        values = np.concatenate([[self.min], self.means, [self.max]])
+
+        return positions, values
+
+    def quantile(self, q):
+        """
+        Returns the estimated q quantile, or an array of them when q is an
+        array-like, interpolating like PERCENTILE_CONT.  NaN when empty.
+        """
+
+        import numpy as np
+
+        q = np.asarray(q, dtype=np.float64)
+        if self.count == 0:
+            return np.full(q.shape, np.nan) if q.ndim else math.nan
+
+        positions, values = self._positions()
+        estimates = np.interp(q * (self.count - 1) + 0.5, positions, values)
+
+        return estimates if q.ndim else float(estimates)
+
+    def cdf(self, x):
+        """
+        Returns the estimated fraction of values at or below x, or an array
+        of them when x is an array-like.
+        """
+
+        import numpy as np
+
+        x = np.asarray(x, dtype=np.float64)
+        if self.count == 0:
+            return np.full(x.shape, np.nan) if x.ndim else math.nan
+
+        positions, values = self._positions()
+        ranks = np.interp(x, values, positions) + 0.5
+        ranks = np.where(x < self.min, 0, np.where(x >= self.max, self.count, ranks))
+        fractions = ranks / self.count
+
+        return fractions if x.ndim else float(fractions)
+
+    def histogram(self, bins=10):
+        """
+        Returns estimated (counts, bin_edges) like numpy.histogram, without
+        the raw values.
+
+        bins (int or array-like): number of equal width bins between min and
+        max, or the bin edges
+        """
+
+        import numpy as np
+
+        if np.ndim(bins) == 0:
+            edges = np.linspace(self.min, self.max, int(bins) + 1)
+        else:
+            edges = np.asarray(bins, dtype=np.float64)
+
+        below = self.cdf(edges) * self.count
+        # Values equal to the first edge belong in the first bin
+        below[0] = self.cdf(np.nextafter(edges[0], -np.inf)) * self.count
+
+        return np.diff(below), edges
+
+    def mean(self):
+        return float((self.means * self.weights).sum() / self.count) if self.count else math.nan
+
+    def summary(self):
+        """
+        Returns a dict of the estimated min, q1, median, q3 and max.
+        """
+
+        estimates = self.quantile(list(SUMMARY_QUANTILES.values()))
+
+        return dict(zip(SUMMARY_QUANTILES, estimates.tolist()))
+
+    def boxplot_stats(self, label=None, whis=1.5):
+        """
+        Returns a dict of boxplot statistics in the form matplotlib's
+        Axes.bxp takes.  Whiskers end at the most extreme centroids within
+        whis IQRs of the box and the centroids beyond them are the fliers;
+        centroids in the tails hold single values, so fliers are the actual
+        outlying values.
+        """
+
+        import numpy as np
+
+        q1, median, q3 = self.quantile([0.25, 0.5, 0.75])
+        iqr = q3 - q1
+
+        values = np.concatenate([[self.min], self.means, [self.max]])
+        low_limit, high_limit = q1 - whis * iqr, q3 + whis * iqr
+        inside = values[(values >= low_limit) & (values <= high_limit)]
+
+        fliers = np.repeat(self.means, np.maximum(np.round(self.weights), 1).astype(np.int64))
+        fliers = fliers[(fliers < low_limit) | (fliers > high_limit)]
+
+        return {'label': label,
+                'mean': self.mean(),
+                'med': median,
+                'q1': q1,
+                'q3': q3,
+                'iqr': iqr,
+                'whislo': inside.min() if len(inside) else q1,
+                'whishi': inside.max() if len(inside) else q3,
+                'fliers': fliers}
+
+    def to_bytes(self):
+        """
+        Serializes the digest so it can be stored next to rollups, ie in a
+        BYTEA column or a Parquet binary column.
+        """
+
+        header = struct.pack('<dddI', self.compression, self.min, self.max, len(self.means))
+
+        return header + self.means.astype('<f8').tobytes() + self.weights.astype('<f8').tobytes()
+
+    @classmethod
+    def from_bytes(cls, data):
+        import numpy as np
+
+        compression, minimum, maximum, size = struct.unpack_from('<dddI', data)
+        offset = struct.calcsize('<dddI')
+        centroids = np.frombuffer(data, dtype='<f8', count=2 * size, offset=offset)
+
+        return cls(compression, centroids[:size].copy(), centroids[size:].copy(),
+                   minimum, maximum)
+
+    def __repr__(self):
+        return (f'TDigest(compression={self.compression:g}, count={self.count:g}, '
+                f'centroids={len(self.means)})')
+
+
+def merge_sketches(sketches):
+    """
+    Merges an iterable of digests into a new digest.  The centroids of all
+    digests are pooled and compressed once, rather than once per digest.
+    Returns None if the iterable is empty.
+
+    sketches (iterable of TDigest): digests to merge
+    """
+
+    import numpy as np
+
+    sketches = list(sketches)
+    if not sketches:
+        return None
+
+    merged = sketches[0].copy()
+    if len(sketches) == 1:
+        return merged
+
+    merged.min = min(sketch.min for sketch in sketches)
+    merged.max = max(sketch.max for sketch in sketches)
+    merged.means, merged.weights = merged._compress(
+        np.concatenate([sketch.means for sketch in sketches]),
+        np.concatenate([sketch.weights for sketch in sketches]))
+
+    return merged
+
+
+def sketches_by(frame, keys, value='points', compression=200):
+    """
+    Builds one digest of a value column per group, ie per user, per segment
+    or per event_date.  Returns a Pandas Series of digests indexed by the
+    group keys.
+
+    frame (Pandas DataFrame): rows holding the keys and the value
+
+    keys (str or list of str): columns to group by
+
+    value (str): column summarized by the digests
+
+    compression (float): digest size parameter
+    """
+
+    sketches = frame.groupby(keys, observed=True)[value].agg(
+        lambda values: TDigest.from_values(values.to_numpy(), compression))
+
+    return sketches.rename(f'{value}_sketch')
+
+
+def daily_sketches(event_performance, value='points', compression=200):
+    """
+    Builds one digest of event level points per gaming event.  Returns a
+    Pandas Series of digests indexed by day, suitable for storing with the
+    per-day rollups (see sketches_to_frame).
+
+    event_performance (Pandas DataFrame): event level rows with event_date
+    and the value column
+
+    value (str): column summarized by the digests
+
+    compression (float): digest size parameter
+    """
+
+    import pandas as pd
+
+    days = pd.to_datetime(event_performance['event_date']).to_numpy()
+
+    return sketches_by(event_performance.assign(day=days), 'day', value, compression)
+
+
+def quantiles_between(sketches, q, start=None, end=None):
+    """
+    Estimates quantiles of the values between start and end (inclusive) by
+    merging the per-day digests in that range.
+
+    sketches (Pandas Series): per-day digests indexed by day, ie the output
+    of daily_sketches
+
+    q (float or array-like): quantiles to estimate
+
+    start, end (str or datetime-like): optional bounds of the date range
+    """
+
+    merged = merge_sketches(sketches.loc[start:end])
+
+    return TDigest().quantile(q) if merged is None else merged.quantile(q)
+
+
+def quantiles_per_period(sketches, q=(0.25, 0.5, 0.75), freq='MS'):
+    """
+    Estimates quantiles per period by merging per-day digests.  Returns a
+    Pandas DataFrame indexed by period start with one column per quantile.
+
+    sketches (Pandas Series): per-day digests indexed by day
+
+    q (array-like): quantiles to estimate
+
+    freq (str): Pandas frequency alias of the period, ie 'MS' for months or
+    'QS-DEC' for meteorological seasons
+    """
+
+    import pandas as pd
+
+    merged = sketches.groupby(pd.Grouper(freq=freq)).agg(merge_sketches).dropna()
+
+    return pd.DataFrame([sketch.quantile(q) for sketch in merged],
+                        index=merged.index,
+                        columns=pd.Index(list(q), name='quantile'))
+
+
+def summary_stats(sketch):
+    """
+    Returns the approximate counterparts of part 2's event summary
+    statistics from a digest as a Pandas Series: count, mean, min, q1,
+    median, q3 and max.
+
+    sketch (TDigest): digest to summarize, ie of points per gaming event
+    """
+
+    import pandas as pd
+
+    return pd.Series({'count': sketch.count, 'mean': sketch.mean(), **sketch.summary()})
+
+
+def boxplot_stats_by(frame, by, value='total_points', compression=200):
+    """
+    Builds boxplot statistics of a value per group from digests, ready for
+    matplotlib's Axes.bxp, ie ax.bxp(boxplot_stats_by(users_attributes_and_tot_points,
+    'category')).  Returns a list of dicts in group order.
+
+    frame (Pandas DataFrame): rows holding the group column and the value
+
+    by (str): column to group by
+
+    value (str): column to summarize
+
+    compression (float): digest size parameter
+    """
+
+    sketches = sketches_by(frame, by, value, compression)
+
+    return [sketch.boxplot_stats(label=str(label)) for label, sketch in sketches.items()]
+
+
+def sketches_to_frame(sketches):
+    """
+    Converts a Series of digests to a Pandas DataFrame with each digest
+    serialized to bytes, so it can be written alongside rollups with to_sql
+    or to_parquet.
+
+    sketches (Pandas Series): digests indexed by day, user or segment
+    """
+
+    return sketches.map(lambda sketch: sketch.to_bytes()).to_frame()
+
+
+def sketches_from_frame(frame, column='points_sketch'):
+    """
+    Inverse of sketches_to_frame.
+
+    frame (Pandas DataFrame): serialized digests
+
+    column (str): name of the column holding the serialized digests
+    """
+
+    return frame[column].map(TDigest.from_bytes)
@@ -0,0 +1,576 @@
+"""
+Regression guard for the analysis SQL in sql_queries/.  The files are run in
+order against a private schema loaded with a synthetic dataset: the part 1
+files load and clean the staging tables, then the part 0 and part 2 queries
+run on the clean tables.  Every query is run under EXPLAIN (ANALYZE,
+BUFFERS) and its plan shape, sequential scans and timing are recorded.  At
+scale 1 the dataset is the shipped CSVs and each query's result is checked
+against the expected output pasted below it in the file.  Larger scales add
+copies of every user and their events under new userids.
+
+    python query_plan_guard.py --update-baseline
+    python query_plan_guard.py --scale 20 --baseline sql_queries/plan_baseline_x20.json
+
+Against a baseline, a query fails when it sequentially scans a table it
+didn't before or when it runs more than --tolerance times slower.  Changed
+plan shapes are reported without failing.  Exits with status 1 on any
+failure.  The database connection settings are read from .env like
+run_report.
+
+With --backend duckdb the files run through the PostgreSQL dialect shim on
+an in-process DuckDB database instead, checking results only, since plans
+and timings don't carry over between the two.
+
+    python query_plan_guard.py --backend duckdb
+"""
+
+import argparse
+import csv
+import json
+import os
+import re
+import sys
+import tempfile
+
+
+SQL_QUERIES_DIR = 'sql_queries'
+
+BASELINE_PATH = os.path.join(SQL_QUERIES_DIR, 'plan_baseline.json')
+
+GUARD_SCHEMA = 'plan_guard'
+
+# Sources of the COPY ... FROM statements in sec1_loading.sql
+SOURCE_FILES = {'users.csv': os.path.join('data', 'users.csv'),
+                'event_performance.csv': os.path.join('data', 'event_performance.csv')}
+
+COPY_PATTERN = re.compile(r"^\s*COPY\s+(?P<target>\w+\s*\([^)]*\))\s+FROM\s+'(?P<path>[^']*)'"
+                          r"(?P<options>.*?);?\s*$",
+                          re.IGNORECASE | re.DOTALL)
+
+QUERY_PATTERN = re.compile(r'^\s*(SELECT|WITH)\b', re.IGNORECASE)
+
+RESULTS_PATTERN = re.compile(r'^results\b', re.IGNORECASE)
+
+
+def sql_files(directory=SQL_QUERIES_DIR):
+    """
+    Returns the .sql files under directory in the order they have to run:
+    the part 1 loading and cleaning files first, since the other parts query
+    the tables they create, then the rest in name order.
+    """
+
+    paths = [os.path.join(root, name)
+             for root, _, names in os.walk(directory)
+             for name in names if name.endswith('.sql')]
+
+    return sorted(paths, key=lambda path: ('loading_and_cleaning' not in path, path))
+
+
+def _statement_end(line, in_quote):
+    """
+    Scans a line for a semicolon outside string literals and comments.
+    Returns whether the line ends a statement and whether a string literal
+    is still open at its end.
+    """
+
+    i = 0
+    while i < len(line):
+        char = line[i]
+        if in_quote:
+            if char == "'":
+                in_quote = False
+        elif char == "'":
+            in_quote = True
+        elif line.startswith('--', i):
+            break
+        elif char == ';':
+            return True, in_quote
+        i += 1
+
+    return False, in_quote
+
+
+def parse_expected(comments):
+    """
+    Parses the psql style results pasted as comments after a query.  Returns
+    a dict with the column names, the rows as lists of strings and whether
+    the rows are only a sample, or None when the comments hold no results.
+
+    comments (list of str): comment lines following the query
+    """
+
+    lines = [line.strip()[2:] for line in comments]
+    starts = [i for i, line in enumerate(lines) if RESULTS_PATTERN.match(line.strip())]
+    if not starts:
+        return None
+
+    sample = 'sample' in lines[starts[0]].lower()
+    header, rows = None, []
+
+    for line in lines[starts[0] + 1:]:
+        text = line.strip()
+        if not text:
+            if header is None:
+                continue
+            break
+
+        if text.startswith('('):
+            # "(0 rows)"
+            break
+        if set(text) <= set('-+ '):
+            continue
+
+        cells = [cell.strip() for cell in line.split('|')]
+        if header is None:
+            header = cells
+        elif len(cells) != len(header):
+            break
+        elif all(set(cell) <= set('.') for cell in cells):
+            sample = True
+        else:
+            rows.append(cells)
+
+    if header is None:
+        return None
+
+    return {'columns': header, 'rows': rows, 'sample': sample}
+
+
+def parse_sql_file(path):
+    """
+    Splits a .sql file into statements.  Returns a list of dicts holding
+    each statement's SQL, the question it answers (from the comments before
+    it) and its expected results (from the comments after it).
+
+    path (str): location of the file
+    """
+
+    with open(path) as f:
+        lines = f.read().splitlines()
+
+    statements = []
+    comments, current = [], []
+    in_quote = False
+
+    def finish_statement():
+        # Statements answering a question in several steps share its label
+        question = next((line.strip('- ').strip() for line in comments
+                         if 'question' in line.lower()),
+                        statements[-1]['question'] if statements else None)
+        statements.append({'sql': '\n'.join(current).strip(),
+                           'question': question,
+                           'comments_before': list(comments)})
+
+    for line in lines:
+        stripped = line.strip()
+        if not current and (not stripped or stripped.startswith('--')):
+            comments.append(line)
+            continue
+
+        current.append(line)
+        ended, in_quote = _statement_end(line, in_quote)
+        if ended:
+            finish_statement()
+            comments, current = [], []
+
+    if current:
+        finish_statement()
+        comments = []
+
+    # Results pasted after a statement are in the comments before the next
+    for statement, following in zip(statements, statements[1:] + [{'comments_before': comments}]):
+        statement['expected'] = parse_expected(following['comments_before'])
+
+    for number, statement in enumerate(statements, start=1):
+        statement.pop('comments_before')
+        statement['key'] = f'{os.path.relpath(path, SQL_QUERIES_DIR)}#{number}'
+        statement['is_query'] = bool(QUERY_PATTERN.match(statement['sql']))
+
+    return statements
+
+
+def synthetic_dataset(scale, directory):
+    """
+    Writes raw users and event_performance CSVs scale times the size of the
+    shipped ones to directory.  Each copy of a user gets a new userid
+    derived from the original and keeps its attributes and events, raw
+    quoting and typos included, so the cleaning queries have the same work
+    to do at every scale.  Scale 1 uses the shipped files as they are.
+    Returns a dict mapping the shipped file names to the files to load.
+
+    scale (int): number of copies of the data
+
+    directory (str): where the synthetic files are written
+    """
+
+    import uuid
+
+    if scale == 1:
+        return dict(SOURCE_FILES)
+
+    paths = {}
+    for name, source in SOURCE_FILES.items():
+        path = os.path.join(directory, name)
+        with open(source, newline='') as source_file, open(path, 'w', newline='') as out:
+            reader = csv.reader(source_file)
+            writer = csv.writer(out)
+            header = next(reader)
+            rows = list(reader)
+
+            writer.writerow(header)
+            writer.writerows(rows)
+            for copy in range(1, scale):
+                for row in rows:
+                    clean_userid = re.sub(r'[" ]', '', row[0])
+                    new_userid = str(uuid.uuid5(uuid.NAMESPACE_OID, f'{clean_userid}/{copy}'))
+                    writer.writerow([row[0].replace(clean_userid, new_userid)] + row[1:])
+
+        paths[name] = path
+
+    return paths
+
+
+def plan_shape(plan, depth=0):
+    """
+    Flattens an EXPLAIN (FORMAT JSON) plan node into indented lines naming
+    each node type with the relation and index it reads.
+    """
+
+    label = plan['Node Type']
+    if 'Relation Name' in plan:
+        label += f" on {plan['Relation Name']}"
+    if 'Index Name' in plan:
+        label += f" using {plan['Index Name']}"
+
+    lines = ['  ' * depth + label]
+    for child in plan.get('Plans', []):
+        lines.extend(plan_shape(child, depth + 1))
+
+    return lines
+
+
+def _seq_scans(plan):
+    scans = {plan['Relation Name']} if plan['Node Type'] == 'Seq Scan' else set()
+    for child in plan.get('Plans', []):
+        scans |= _seq_scans(child)
+
+    return scans
+
+
+def _same_value(expected, actual):
+    if actual is None:
+        return expected in ('', 'NULL')
+
+    actual = str(actual).strip()
+    if expected == actual:
+        return True
+
+    try:
+        return abs(float(expected) - float(actual)) <= 1e-9 * max(1, abs(float(expected)))
+    except ValueError:
+        return False
+
+
+def check_result(expected, columns, rows):
+    """
+    Compares a query result with the expected output parsed from its file.
+    Rows are compared regardless of order, and a sample only has to be
+    contained in the result.  Returns a list of mismatch descriptions,
+    empty when the result matches.
+
+    expected (dict): output of parse_expected
+
+    columns (list of str): column names of the result
+
+    rows (list of tuples): the result
+    """
+
+    problems = []
+    if [column.lower() for column in expected['columns']] != [column.lower() for column in columns]:
+        problems.append(f"columns {columns} != expected {expected['columns']}")
+        return problems
+
+    remaining = list(rows)
+    for expected_row in expected['rows']:
+        match = next((i for i, row in enumerate(remaining)
+                      if all(_same_value(e, a) for e, a in zip(expected_row, row))), None)
+        if match is None:
+            problems.append(f"expected row {expected_row} is missing")
+        else:
+            remaining.pop(match)
+
+    if not expected['sample'] and remaining:
+        problems.append(f"{len(remaining)} unexpected rows, ie {list(remaining[0])}")
+
+    return problems
+
+
+def _run_copy(cursor, match, sources):
+    path = sources[os.path.basename(match.group('path'))]
+    with open(path, 'rb') as f:
+        cursor.copy_expert(f"COPY {match.group('target')} FROM STDIN {match.group('options')}", f)
+
+
+def run_statements(engine, scale=1, repeat=3):
+    """
+    Runs every statement of the sql_queries files in a fresh plan_guard
+    schema loaded with a synthetic dataset of the given scale, dropped
+    again once the statements have run.  Queries are run repeat times under
+    EXPLAIN (ANALYZE, BUFFERS) keeping the fastest run, and at scale 1 once
+    more for their result.  Returns a list of dicts
+    with each query's key, question, plan shape, sequentially scanned
+    tables, planning and execution time in milliseconds, shared buffers hit
+    and read, and result problems.
+
+    engine (sql alchemy engine object): Used to establish a connection to the db
+
+    scale (int): size of the synthetic dataset in copies of the shipped data
+
+    repeat (int): EXPLAIN ANALYZE runs per query
+    """
+
+    records = []
+    conn = engine.raw_connection()
+
+    with tempfile.TemporaryDirectory(prefix='plan-guard-') as directory:
+        sources = synthetic_dataset(scale, directory)
+
+        try:
+            conn.autocommit = True
+            cursor = conn.cursor()
+            cursor.execute(f"DROP SCHEMA IF EXISTS {GUARD_SCHEMA} CASCADE")
+            cursor.execute(f"CREATE SCHEMA {GUARD_SCHEMA}")
+            cursor.execute(f"SET search_path TO {GUARD_SCHEMA}")
+
+            for path in sql_files():
+                for statement in parse_sql_file(path):
+                    sql = statement['sql']
+
+                    copy = COPY_PATTERN.match(sql)
+                    if copy is not None:
+                        _run_copy(cursor, copy, sources)
+                        continue
+
+                    if not statement['is_query']:
+                        cursor.execute(sql)
+                        continue
+
+                    runs = []
+                    for _ in range(repeat):
+                        cursor.execute(f"EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) {sql}")
+                        runs.append(cursor.fetchone()[0][0])
+                    explain = min(runs, key=lambda run: run['Execution Time'])
+
+                    problems = []
+                    if scale == 1 and statement['expected'] is not None:
+                        cursor.execute(sql)
+                        columns = [column.name for column in cursor.description]
+                        problems = check_result(statement['expected'], columns, cursor.fetchall())
+
+                    records.append({'key': statement['key'],
+                                    'question': statement['question'],
+                                    'shape': plan_shape(explain['Plan']),
+                                    'seq_scans': sorted(_seq_scans(explain['Plan'])),
+                                    'planning_ms': explain['Planning Time'],
+                                    'execution_ms': explain['Execution Time'],
+                                    'shared_hit': explain['Plan'].get('Shared Hit Blocks', 0),
+                                    'shared_read': explain['Plan'].get('Shared Read Blocks', 0),
+                                    'result_problems': problems})
+        finally:
+            try:
+                conn.cursor().execute(f"DROP SCHEMA IF EXISTS {GUARD_SCHEMA} CASCADE")
+            finally:
+                # The search_path and autocommit were changed, so the
+                # connection is discarded instead of returned to the pool
+                conn.invalidate()
+                conn.close()
+
+    return records
+
+
+def run_statements_local():
+    """
+    Runs every statement of the sql_queries files on an in-process DuckDB
+    database loaded with the shipped CSVs, checking each query's result
+    against its expected output.  Returns a list of dicts with each query's
+    key, question and result problems, like run_statements without the plan
+    and timing fields.
+    """
+
+    from sql_query_helper_funcs import LocalDatabase, column_names, translate_sql
+
+    records = []
+    database = LocalDatabase()
+
+    try:
+        for path in sql_files():
+            for statement in parse_sql_file(path):
+                sql = statement['sql']
+
+                copy = COPY_PATTERN.match(sql)
+                if copy is not None:
+                    sql = (f"COPY {copy.group('target')} "
+                           f"FROM '{SOURCE_FILES[os.path.basename(copy.group('path'))]}' "
+                           f"{copy.group('options')}")
+
+                with database.connection.cursor() as cursor:
+                    cursor.execute(translate_sql(sql))
+
+                    if not statement['is_query']:
+                        continue
+
+                    problems = []
+                    if statement['expected'] is not None:
+                        problems = check_result(statement['expected'], column_names(cursor),
+                                                cursor.fetchall())
+
+                records.append({'key': statement['key'],
+                                'question': statement['question'],
+                                'result_problems': problems})
+    finally:
+        database.close()
+
+    return records
+
+
+def compare_to_baseline(records, baseline, tolerance=2.0, min_slowdown_ms=5.0):
+    """
+    Flags regressions of a run against a baseline run.  Returns a list of
+    (key, kind, message) tuples, where kind is 'seq_scan', 'slower',
+    'plan_changed', 'new_query' or 'result'.  Only plan_changed and
+    new_query are informational.
+
+    records (list of dicts): output of run_statements
+
+    baseline (dict): saved baseline, see save_baseline.  When None only
+    result problems are reported.
+
+    tolerance (float): allowed ratio of execution time to the baseline's
+
+    min_slowdown_ms (float): slowdowns smaller than this are noise
+    """
+
+    findings = []
+    queries = {} if baseline is None else baseline['queries']
+
+    for record in records:
+        key = record['key']
+        for problem in record['result_problems']:
+            findings.append((key, 'result', problem))
+
+        if baseline is None:
+            continue
+        if key not in queries:
+            findings.append((key, 'new_query', 'not in the baseline'))
+            continue
+
+        base = queries[key]
+        new_scans = sorted(set(record['seq_scans']) - set(base['seq_scans']))
+        if new_scans:
+            findings.append((key, 'seq_scan', f"new sequential scans on {', '.join(new_scans)}"))
+
+        slowdown = record['execution_ms'] - base['execution_ms']
+        if (record['execution_ms'] > tolerance * base['execution_ms']
+                and slowdown > min_slowdown_ms):
+            findings.append((key, 'slower', f"{record['execution_ms']:.1f} ms vs "
+                                            f"{base['execution_ms']:.1f} ms in the baseline"))
+
+        if record['shape'] != base['shape']:
+            findings.append((key, 'plan_changed', '\n'.join(record['shape'])))
+
+    return findings
+
+
+def save_baseline(records, path=BASELINE_PATH, scale=1):
+    """
+    Saves a run's plan shapes and timings as the baseline for later runs at
+    the same scale.
+    """
+
+    import datetime
+
+    baseline = {'scale': scale,
+                'created': datetime.datetime.now().isoformat(timespec='seconds'),
+                'queries': {record['key']: {field: value for field, value in record.items()
+                                            if field not in ('key', 'result_problems')}
+                            for record in records}}
+
+    with open(path, 'w') as f:
+        json.dump(baseline, f, indent=1)
+        f.write('\n')
+
+
+def load_baseline(path=BASELINE_PATH):
+    if not os.path.exists(path):
+        return None
+
+    with open(path) as f:
+        return json.load(f)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Check the sql_queries files for plan and '
+                                                 'timing regressions.')
+    parser.add_argument('--backend', choices=['postgres', 'duckdb'], default='postgres',
+                        help='duckdb only checks results, on an in-process database')
+    parser.add_argument('--scale', type=int, default=1,
+                        help='copies of the shipped data to load, results are checked at 1')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='EXPLAIN ANALYZE runs per query, the fastest is kept')
+    parser.add_argument('--baseline', default=BASELINE_PATH,
+                        help='baseline file to compare against or update')
+    parser.add_argument('--update-baseline', action='store_true',
+                        help='save this run as the baseline')
+    parser.add_argument('--tolerance', type=float, default=2.0,
+                        help='allowed ratio of execution time to the baseline')
+    parser.add_argument('--min-slowdown-ms', type=float, default=5.0,
+                        help='ignore slowdowns smaller than this')
+
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    from run_report import create_engine_from_env
+
+    args = parse_args(argv)
+
+    if args.backend == 'duckdb':
+        records = run_statements_local()
+        for record in records:
+            print(f"{record['key']:<70} {'FAIL' if record['result_problems'] else 'ok'}")
+
+        findings = compare_to_baseline(records, None)
+        for key, kind, message in findings:
+            print(f"\nFAIL {kind} {key}\n{message}")
+
+        if findings:
+            sys.exit(1)
+        return
+
+    records = run_statements(create_engine_from_env(), args.scale, args.repeat)
+
+    for record in records:
+        print(f"{record['key']:<70} {record['execution_ms']:>9.2f} ms  "
+              f"seq scans: {', '.join(record['seq_scans']) or '-'}")
+
+    baseline = load_baseline(args.baseline)
+    if baseline is not None and baseline['scale'] != args.scale:
+        sys.exit(f"{args.baseline} was recorded at scale {baseline['scale']}, not {args.scale}")
+
+    findings = compare_to_baseline(records, baseline, args.tolerance, args.min_slowdown_ms)
+    failures = [finding for finding in findings
+                if finding[1] not in ('plan_changed', 'new_query')]
+
+    for key, kind, message in findings:
+        print(f"\n{'FAIL' if (key, kind, message) in failures else 'note'} {kind} {key}\n{message}")
+
+    if args.update_baseline:
+        save_baseline(records, args.baseline, args.scale)
+        print(f"\nSaved the baseline to {args.baseline}")
+
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,242 @@
+import hashlib
+import re
+
+
+# Matches :name bind parameters but not PostgreSQL :: casts
+BIND_PARAM_PATTERN = re.compile(r'(?<![:\w]):([A-Za-z_]\w*)')
+
+PERIODS = ('day', 'week', 'month', 'quarter', 'year')
+
+SIGNS = {None: None, 'positive': 1, 'negative': -1, 'zero': 0}
+
+
+class QueryTemplate:
+    """
+    SQL query with named bind parameters (:name) and declared PostgreSQL
+    parameter types.  Values are always sent separately from the SQL text,
+    never formatted into it.  With prepared=True the template is PREPAREd
+    once per pooled connection and later calls only send EXECUTE with the new
+    values, so the server skips parsing and planning after the first call.
+
+    sql (str): query text using :name bind parameters
+
+    param_types (dict): maps each parameter name to its PostgreSQL type, ie
+    {'start_date': 'date', 'sign': 'int'}
+    """
+
+    def __init__(self, sql, param_types):
+        self.sql = sql
+        self.param_types = dict(param_types)
+
+        self.param_names = []
+        for name in BIND_PARAM_PATTERN.findall(sql):
+            if name not in self.param_names:
+                self.param_names.append(name)
+
+        missing = set(self.param_names) - set(self.param_types)
+        if missing:
+            raise ValueError(f"No type declared for parameters {sorted(missing)}")
+
+        self.positional_sql = BIND_PARAM_PATTERN.sub(
+            lambda match: f'${self.param_names.index(match.group(1)) + 1}', sql)
+        self.statement_name = 'bb_' + hashlib.sha1(sql.encode()).hexdigest()[:16]
+
+    def _values(self, params):
+        unknown = set(params) - set(self.param_names)
+        if unknown:
+            raise ValueError(f"Unknown parameters {sorted(unknown)}")
+
+        return [params.get(name) for name in self.param_names]
+
+    def _execute_prepared(self, conn, params):
+        prepared = conn.info.setdefault('prepared_templates', set())
+        cursor = conn.connection.dbapi_connection.cursor()
+
+        try:
+            if self.statement_name not in prepared:
+                types = ', '.join(self.param_types[name] for name in self.param_names)
+                cursor.execute(f'PREPARE {self.statement_name} ({types}) AS '
+                               f'{self.positional_sql.rstrip().rstrip(";")}')
+                prepared.add(self.statement_name)
+
+            placeholders = ', '.join(['%s'] * len(self.param_names))
+            cursor.execute(f'EXECUTE {self.statement_name}'
+                           + (f' ({placeholders})' if self.param_names else ''),
+                           self._values(params))
+
+            columns = [column[0] for column in cursor.description]
+            rows = cursor.fetchall()
+        finally:
+            cursor.close()
+
+        return columns, rows
+
+    def to_pandas_df(self,
+                     engine,
+                     index_column=None,
+                     dates_column=None,
+                     prepared=True,
+                     **params):
+        """
+        Runs the template with the given parameter values and returns the
+        results as a Pandas DataFrame.  Parameters that aren't passed are
+        sent as NULL.
+
+        engine (sql alchemy engine object): Used to establish a connection to the db
+
+        index_column (str or list of str): column(s) to set as the index
+
+        dates_column (str or list of str): column(s) to parse as dates
+
+        prepared (bool): use a server-side prepared statement; when False, or
+        on a LocalDatabase, the query is sent with bound parameters through
+        sql_query_to_pandas_df
+        """
+
+        import pandas as pd
+        from sql_query_helper_funcs import LocalDatabase
+
+        if not prepared or isinstance(engine, LocalDatabase):
+            from sql_query_helper_funcs import sql_query_to_pandas_df
+
+            return sql_query_to_pandas_df(self.sql,
+                                          engine,
+                                          index_column=index_column,
+                                          dates_column=dates_column,
+                                          params=dict(zip(self.param_names,
+                                                          self._values(params))))
+
+        from metrics_funcs import QUERY_SECONDS
+
+        with engine.connect() as conn, QUERY_SECONDS.labels(engine.dialect.name, 'prepared').time():
+            columns, rows = self._execute_prepared(conn, params)
+
+        df = pd.DataFrame.from_records(rows, columns=columns)
+
+        if dates_column is not None:
+            for column in [dates_column] if isinstance(dates_column, str) else dates_column:
+                df[column] = pd.to_datetime(df[column])
+
+        if index_column is not None:
+            df = df.set_index(index_column)
+
+        return df
+
+
+POINTS_PER_PERIOD = QueryTemplate("""
+WITH user_totals AS (
+  SELECT userid
+       , SIGN(SUM(points))::int AS total_points_sign
+    FROM event_performance
+GROUP BY userid
+  )
+
+  SELECT DATE_TRUNC(:period, ep.event_date)::date AS period
+       , SUM(ep.points) AS total_points
+       , COUNT(DISTINCT ep.userid) AS total_users
+    FROM event_performance AS ep
+    JOIN user_totals AS ut
+      ON ep.userid = ut.userid
+   WHERE (:start_date IS NULL OR ep.event_date >= :start_date)
+     AND (:end_date IS NULL OR ep.event_date <= :end_date)
+     AND (:sign IS NULL OR ut.total_points_sign = :sign)
+GROUP BY 1
+ORDER BY 1;
+""", {'period': 'text', 'start_date': 'date', 'end_date': 'date', 'sign': 'int'})
+
+TOP_PERFORMERS_PER_PERIOD = QueryTemplate("""
+WITH points_rankings AS (
+  SELECT userid
+       , DATE_TRUNC(:period, event_date)::date AS period
+       , SUM(points) AS points_earned
+       , DENSE_RANK() OVER (PARTITION BY DATE_TRUNC(:period, event_date)
+                            ORDER BY SUM(points) DESC) AS ranking
+    FROM event_performance
+   WHERE (:start_date IS NULL OR event_date >= :start_date)
+     AND (:end_date IS NULL OR event_date <= :end_date)
+GROUP BY userid, DATE_TRUNC(:period, event_date)
+  )
+
+  SELECT userid
+       , period
+       , points_earned
+       , ranking
+    FROM points_rankings
+   WHERE ranking <= :top_n
+ORDER BY period, ranking;
+""", {'period': 'text', 'start_date': 'date', 'end_date': 'date', 'top_n': 'int'})
+
+
+def _check_period(period):
+    if period not in PERIODS:
+        raise ValueError(f"period must be one of {PERIODS}, got '{period}'")
+
+
+def points_per_period(engine,
+                      period='month',
+                      start_date=None,
+                      end_date=None,
+                      sign=None,
+                      prepared=True):
+    """
+    Total points and participating users per period, optionally restricted
+    to a date range and to users whose yearly point total is positive,
+    negative or zero.  Returns a Pandas DataFrame indexed by period start
+    with total_points and total_users columns.
+
+    engine (sql alchemy engine object): Used to establish a connection to the db
+
+    period (str): one of 'day', 'week', 'month', 'quarter' or 'year'
+
+    start_date, end_date (str or date): optional inclusive bounds on event_date
+
+    sign (str): None for every user, or 'positive', 'negative' or 'zero'
+
+    prepared (bool): use a server-side prepared statement
+    """
+
+    _check_period(period)
+    if sign not in SIGNS:
+        raise ValueError(f"sign must be one of {list(SIGNS)}, got '{sign}'")
+
+    return POINTS_PER_PERIOD.to_pandas_df(engine,
+                                          index_column='period',
+                                          dates_column='period',
+                                          prepared=prepared,
+                                          period=period,
+                                          start_date=start_date,
+                                          end_date=end_date,
+                                          sign=SIGNS[sign])
+
+
+def top_performers_per_period(engine,
+                              period='month',
+                              top_n=2,
+                              start_date=None,
+                              end_date=None,
+                              prepared=True):
+    """
+    The top_n users by points earned in each period, ties sharing a rank.
+    Returns a Pandas DataFrame with userid, period, points_earned and
+    ranking columns.
+
+    engine (sql alchemy engine object): Used to establish a connection to the db
+
+    period (str): one of 'day', 'week', 'month', 'quarter' or 'year'
+
+    top_n (int): number of ranks to keep per period
+
+    start_date, end_date (str or date): optional inclusive bounds on event_date
+
+    prepared (bool): use a server-side prepared statement
+    """
+
+    _check_period(period)
+
+    return TOP_PERFORMERS_PER_PERIOD.to_pandas_df(engine,
+                                                  dates_column='period',
+                                                  prepared=prepared,
+                                                  period=period,
+                                                  top_n=int(top_n),
+                                                  start_date=start_date,
+                                                  end_date=end_date)
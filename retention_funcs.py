@@ -0,0 +1,324 @@
+PERIODS = ('day', 'week', 'month', 'quarter', 'year')
+
+
+def retention_query(period='month'):
+    """
+    Returns a SQL query computing the cohort x offset retention matrix in a
+    single pass over event_performance.  Each user's cohort (the period they
+    were first seen in) comes from a MIN window function rather than a self
+    join, so the cost is linear in the number of events.  Each row is one
+    (cohort, offset) pair and contains:
+
+    cohort, period_offset, active_users
+
+    where period_offset 0 is the cohort size.
+
+    period (str): one of 'day', 'week', 'month', 'quarter' or 'year'
+    """
+
+    if period not in PERIODS:
+        raise ValueError(f"period must be one of {PERIODS}, got '{period}'")
+
+    if period in ('day', 'week'):
+        divisor = 1 if period == 'day' else 7
+        offset = f"(active_period - cohort) / {divisor}"
+    else:
+        months = {'month': 1, 'quarter': 3, 'year': 12}[period]
+        offset = ("((EXTRACT(YEAR FROM active_period) - EXTRACT(YEAR FROM cohort)) * 12"
+                  " + EXTRACT(MONTH FROM active_period) - EXTRACT(MONTH FROM cohort))::int"
+                  f" / {months}")
+
+    return f"""
+WITH user_periods AS (
+  SELECT DISTINCT userid
+       , DATE_TRUNC('{period}', event_date)::date AS active_period
+    FROM event_performance
+  ),
+
+cohorts AS (
+  SELECT userid
+       , active_period
+       , MIN(active_period) OVER (PARTITION BY userid) AS cohort
+    FROM user_periods
+  )
+
+  SELECT cohort
+       , {offset} AS period_offset
+       , COUNT(*) AS active_users
+    FROM cohorts
+GROUP BY 1, 2
+ORDER BY 1, 2;
+"""
+
+
+class RetentionTracker:
+    """
+    Per-user activity bitmaps for retention and churn analysis.  Each user
+    gets one row of bits, one bit per period, packed eight periods to a byte,
+    so a year of months fits in two bytes per user.  Building the bitmaps is
+    a single pass over the events and every matrix is computed from them
+    with vectorized operations, so nothing is quadratic in the number of
+    events or users.
+
+    Events can be added in any number of batches with update(), ie as new
+    gaming events are loaded, and the bitmaps grow to fit new users and
+    periods.
+
+    freq (str): Pandas period frequency, ie 'M' for months or 'W-SUN' for
+    weeks
+    """
+
+    def __init__(self, freq='M'):
+        import numpy as np
+
+        self.freq = freq
+        self.origin = None
+        self.num_periods = 0
+        self.userids = []
+        self.user_rows = {}
+        self.bits = np.zeros((0, 0), dtype=np.uint8)
+
+    @classmethod
+    def from_events(cls, event_performance, freq='M'):
+        """
+        Builds a tracker from event level rows.
+        """
+
+        return cls(freq).update(event_performance)
+
+    def _resize(self, num_users, first_ordinal, last_ordinal):
+        import numpy as np
+
+        if self.origin is None:
+            self.origin = first_ordinal
+
+        # Events before the current origin shift every bitmap right
+        shift = max(self.origin - first_ordinal, 0)
+        num_periods = max(self.num_periods + shift, last_ordinal - self.origin + shift + 1)
+
+        if shift == 0:
+            # Only new users or later periods, so pad the packed bits in place
+            num_bytes = (num_periods + 7) // 8
+            self.bits = np.pad(self.bits, ((0, num_users - self.bits.shape[0]),
+                                           (0, num_bytes - self.bits.shape[1])))
+            self.num_periods = num_periods
+            return
+
+        active = np.zeros((num_users, num_periods), dtype=bool)
+        active[:self.bits.shape[0], shift:shift + self.num_periods] = self.activity()
+
+        self.bits = np.packbits(active, axis=1, bitorder='little')
+        self.origin -= shift
+        self.num_periods = num_periods
+
+    def update(self, event_performance):
+        """
+        Marks the periods each user was active in.  Returns the tracker.
+
+        event_performance (Pandas DataFrame): event level rows with userid
+        and event_date columns
+        """
+
+        import numpy as np
+        import pandas as pd
+
+        if len(event_performance) == 0:
+            return self
+
+        ordinals = (pd.PeriodIndex(pd.to_datetime(event_performance['event_date']),
+                                   freq=self.freq)
+                      .asi8)
+
+        userids = event_performance['userid'].to_numpy()
+        for userid in pd.unique(userids):
+            if userid not in self.user_rows:
+                self.user_rows[userid] = len(self.userids)
+                self.userids.append(userid)
+
+        self._resize(len(self.userids), int(ordinals.min()), int(ordinals.max()))
+
+        rows = pd.Series(userids).map(self.user_rows).to_numpy(dtype=np.intp)
+        columns = ordinals - self.origin
+
+        np.bitwise_or.at(self.bits,
+                         (rows, columns // 8),
+                         np.left_shift(1, columns % 8).astype(np.uint8))
+
+        return self
+
+    @property
+    def periods(self):
+        """
+        Start date of every period covered by the bitmaps.
+        """
+
+        import pandas as pd
+
+        if self.origin is None:
+            return pd.DatetimeIndex([], name='period')
+
+        ordinals = range(self.origin, self.origin + self.num_periods)
+        periods = pd.PeriodIndex.from_ordinals(ordinals, freq=self.freq)
+
+        return periods.start_time.rename('period')
+
+    def activity(self):
+        """
+        Returns the unpacked users x periods boolean activity matrix, with
+        rows in the order of self.userids.
+        """
+
+        import numpy as np
+
+        return np.unpackbits(self.bits, axis=1, count=self.num_periods,
+                             bitorder='little').astype(bool)
+
+    def _first_seen_columns(self, active):
+        import numpy as np
+
+        return np.argmax(active, axis=1)
+
+    def first_seen(self):
+        """
+        Returns a Pandas Series of the period each user was first seen in,
+        indexed by userid.
+        """
+
+        import pandas as pd
+
+        first = self._first_seen_columns(self.activity())
+
+        return pd.Series(self.periods[first],
+                         index=pd.Index(self.userids, name='userid'),
+                         name='cohort')
+
+    def retention_matrix(self, max_offset=None, normalize=False):
+        """
+        Returns the cohort x offset retention matrix as a Pandas DataFrame
+        indexed by cohort with one column per period offset.  Offset 0 holds
+        the cohort size and offset k the number of cohort users active k
+        periods after they were first seen.  Offsets past the last tracked
+        period are left empty.
+
+        max_offset (int): largest offset to compute, defaults to every offset
+
+        normalize (bool): divide by the cohort size to get retention rates
+        """
+
+        import numpy as np
+        import pandas as pd
+
+        active = self.activity()
+        first = self._first_seen_columns(active)
+
+        num_offsets = self.num_periods if max_offset is None else min(max_offset + 1,
+                                                                      self.num_periods)
+        offsets = np.arange(num_offsets)
+
+        # Align every user's bitmap on their first seen period
+        columns = first[:, None] + offsets
+        in_range = columns < self.num_periods
+        aligned = np.take_along_axis(active, np.minimum(columns, self.num_periods - 1), axis=1)
+        aligned &= in_range
+
+        counts = np.zeros((self.num_periods, num_offsets), dtype=np.int64)
+        np.add.at(counts, first, aligned)
+
+        matrix = pd.DataFrame(counts,
+                              index=self.periods.rename('cohort'),
+                              columns=pd.Index(offsets, name='period_offset'))
+
+        # Cohorts that can't have reached an offset yet are unknown, not zero
+        observable = (np.arange(self.num_periods)[:, None] + offsets) < self.num_periods
+        matrix = matrix.where(observable)
+        matrix = matrix.loc[matrix[0] > 0]
+
+        if normalize:
+            matrix = matrix.div(matrix[0], axis=0)
+
+        return matrix
+
+    def churn(self):
+        """
+        Returns a Pandas DataFrame indexed by period with the number of
+        active_users, new_users (first seen that period), returning_users
+        (active the period before too), reactivated_users (active before, but
+        not the period before) and churned_users (active that period but not
+        the next; empty for the last period).
+        """
+
+        import numpy as np
+        import pandas as pd
+
+        active = self.activity()
+        first = self._first_seen_columns(active)
+
+        previous = np.zeros_like(active)
+        previous[:, 1:] = active[:, :-1]
+        seen_before = np.zeros_like(active)
+        seen_before[:, 1:] = np.logical_or.accumulate(active, axis=1)[:, :-1]
+
+        churned = (active[:, :-1] & ~active[:, 1:]).sum(axis=0)
+
+        return pd.DataFrame({'active_users': active.sum(axis=0),
+                             'new_users': np.bincount(first, minlength=self.num_periods),
+                             'returning_users': (active & previous).sum(axis=0),
+                             'reactivated_users': (active & ~previous & seen_before).sum(axis=0),
+                             'churned_users': np.append(churned.astype(float), np.nan)},
+                            index=self.periods)
+
+    def save(self, path):
+        """
+        Writes the bitmaps and userids to a .npz file.
+        """
+
+        import numpy as np
+
+        np.savez_compressed(path,
+                            bits=self.bits,
+                            userids=np.asarray(self.userids),
+                            origin=np.int64(self.origin or 0),
+                            num_periods=np.int64(self.num_periods),
+                            freq=np.str_(self.freq))
+
+    @classmethod
+    def load(cls, path):
+        """
+        Reads a tracker written by save().
+        """
+
+        import numpy as np
+
+        with np.load(path) as data:
+            tracker = cls(str(data['freq']))
+            tracker.bits = data['bits']
+            tracker.userids = data['userids'].tolist()
+            tracker.user_rows = {userid: row for row, userid in enumerate(tracker.userids)}
+            tracker.num_periods = int(data['num_periods'])
+            tracker.origin = int(data['origin']) if tracker.num_periods else None
+
+        return tracker
+
+    def __repr__(self):
+        return (f'RetentionTracker(freq={self.freq!r}, users={len(self.userids)}, '
+                f'periods={self.num_periods})')
+
+
+def retention_matrix(event_performance, freq='M', max_offset=None, normalize=False):
+    """
+    Computes the cohort x offset retention matrix for event level rows, see
+    RetentionTracker.retention_matrix.
+
+    event_performance (Pandas DataFrame): event level rows with userid and
+    event_date columns
+
+    freq (str): Pandas period frequency, ie 'M' for months
+
+    max_offset (int): largest offset to compute, defaults to every offset
+
+    normalize (bool): divide by the cohort size to get retention rates
+    """
+
+    tracker = RetentionTracker.from_events(event_performance, freq)
+
+    return tracker.retention_matrix(max_offset=max_offset, normalize=normalize)
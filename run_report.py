@@ -0,0 +1,458 @@
+"""
+Headless runner for the part 2 and part 3 analysis.  Pulls the analysis
+products through the memoized AnalysisDAG (independent queries run
+concurrently), writes every table as Parquet and renders every figure as PNG
+in a process pool, all into one output directory.
+
+Example, as scheduled nightly:
+
+    python run_report.py --parts part2 part3 --output-dir reports/nightly --profile
+
+Only what a run needs gets imported: a summary-only run
+(--parts summary --no-figures --table-format csv) never loads matplotlib,
+statsmodels or pyarrow.  See import_time_budget.py.
+
+Connection settings are read from .env, the same way the notebooks do.
+With --backend duckdb no server is needed: the users and clean events CSV
+files are loaded into an in-process DuckDB database instead.
+
+    python run_report.py --backend duckdb --parts part2 --no-figures
+"""
+
+import argparse
+import os
+import time
+
+
+PART_PRODUCTS = {
+    'summary': ['quantitative_summary_stats',
+                'attribute_frequencies',
+                'user_profile_frequencies',
+                'user_type_frequencies'],
+    'part2': ['total_points_per_month',
+              'total_users_per_month',
+              'users_total_positive_points_per_month',
+              'users_total_negative_points_per_month',
+              'hourly_point_totals_by_season',
+              'event_day_stats'],
+    'part3': ['users_attributes_and_tot_points',
+              'linear_model_subscriber',
+              'linear_model_all'],
+}
+
+HUNDRED_THOUSANDS = 100_000
+
+
+def _hundred_thousands_formatter():
+    import matplotlib.ticker
+
+    return matplotlib.ticker.FuncFormatter(
+        lambda x, p: format(round(int(x)/HUNDRED_THOUSANDS, 2), ','))
+
+
+def plot_monthly_totals(total_points_per_month, total_users_per_month):
+    """
+    Line plots of total points and unique participating users per month.
+    """
+
+    from matplotlib.figure import Figure
+
+    fig = Figure(figsize=(6, 7))
+    ax = fig.subplots(2, 1, sharex=True)
+
+    total_points_per_month.plot(kind='line', legend=False, ax=ax[0])
+    ax[0].scatter(total_points_per_month.index, total_points_per_month.values, color='black', s=10)
+    ax[0].axhline(total_points_per_month.mean().values[0], linestyle='solid', color='orange', alpha=0.3)
+    ax[0].set_title('Total Points Per Month')
+    ax[0].get_yaxis().set_major_formatter(_hundred_thousands_formatter())
+    ax[0].set_ylabel('Total Points (In Hundred-Thousands)')
+
+    total_users_per_month.plot(kind='line', legend=False, ax=ax[1])
+    ax[1].scatter(total_users_per_month.index, total_users_per_month.values, color='black', s=10)
+    ax[1].set_title('Unique Participating Users Per Month')
+    ax[1].set_xlabel('Month')
+    ax[1].set_ylabel('Participation Frequency')
+
+    fig.tight_layout()
+
+    return fig
+
+
+def plot_user_type_points(users_total_positive_points_per_month,
+                          users_total_negative_points_per_month):
+    """
+    Monthly points of users with positive vs. negative yearly point totals.
+    """
+
+    from matplotlib.figure import Figure
+
+    fig = Figure()
+    ax = fig.subplots(1, 1)
+
+    for user_type_points in [users_total_positive_points_per_month,
+                             users_total_negative_points_per_month]:
+        user_type_points.plot(kind='line', legend=True, ax=ax)
+        ax.scatter(user_type_points.index, user_type_points.values, color='black', s=10)
+
+    ax.set_title('Users With Positive Yearly Point Totals Vs. Negative Yearly Point Totals')
+    ax.set_xlabel('Month')
+    ax.get_yaxis().set_major_formatter(_hundred_thousands_formatter())
+    ax.set_ylabel('Total Points (In Hundred-Thousands)')
+
+    fig.tight_layout()
+
+    return fig
+
+
+def plot_hourly_points_by_season(hourly_point_totals_by_season):
+    """
+    Bar charts of total points per hour, one per season.
+    """
+
+    from matplotlib.figure import Figure
+
+    fig = Figure(figsize=(10, 5))
+    ax = fig.subplots(1, 4, sharex=True, sharey=True)
+    fig.suptitle('Performance by Season')
+
+    seasons = hourly_point_totals_by_season.index.get_level_values('season')
+    for i, season in enumerate(['spring', 'summer', 'fall', 'winter']):
+        if season in seasons:
+            (hourly_point_totals_by_season.xs(season, level='season')
+                                          .plot(kind='bar', legend=False, ax=ax[i],
+                                                edgecolor='black', rot=0))
+        ax[i].set_title(season.title())
+
+    ax[0].set_ylabel('Total Points (In Hundred-Thousands)')
+    ax[0].get_yaxis().set_major_formatter(_hundred_thousands_formatter())
+
+    fig.tight_layout()
+
+    return fig
+
+
+def plot_points_per_event(event_day_stats):
+    """
+    Total points per gaming event with its rolling mean.
+    """
+
+    from matplotlib.figure import Figure
+
+    fig = Figure()
+    ax = fig.subplots(1, 1)
+
+    event_day_stats['total_points'].plot(kind='line', legend=False, ax=ax)
+    event_day_stats['rolling_mean'].plot(kind='line', legend=False, ax=ax,
+                                         linestyle=':', color='green')
+    ax.scatter(event_day_stats.index, event_day_stats['total_points'], color='black', s=10)
+    ax.axhline(0, color='red', alpha=0.3)
+
+    ax.set_title(f'Total Points Per Gaming Event (n = {len(event_day_stats)})')
+    ax.set_xlabel('Day')
+    ax.get_yaxis().set_major_formatter(_hundred_thousands_formatter())
+    ax.set_ylabel('Total Points (In Hundred-Thousands)')
+
+    return fig
+
+
+def plot_attribute_boxplots(users_attributes_and_tot_points):
+    """
+    Boxplots of yearly point totals by subscriber and by category.
+    """
+
+    from matplotlib.figure import Figure
+
+    fig = Figure()
+    ax = fig.subplots(2, 1, sharex=True)
+
+    for i, attribute in enumerate(['subscriber', 'category']):
+        users_attributes_and_tot_points.boxplot('total_points', by=attribute, ax=ax[i], vert=False)
+        ax[i].set_title(None)
+        ax[i].grid(None)
+
+    ax[1].set_xlabel('Total Points (In Hundred-Thousands)')
+    ax[1].get_xaxis().set_major_formatter(_hundred_thousands_formatter())
+    fig.suptitle('Boxplots Comparing Attribute Categories and Yearly Point Totals')
+
+    return fig
+
+
+PART_FIGURES = {
+    'summary': {},
+    'part2': {'monthly_totals': (plot_monthly_totals,
+                                 ['total_points_per_month', 'total_users_per_month']),
+              'user_type_points': (plot_user_type_points,
+                                   ['users_total_positive_points_per_month',
+                                    'users_total_negative_points_per_month']),
+              'hourly_points_by_season': (plot_hourly_points_by_season,
+                                          ['hourly_point_totals_by_season']),
+              'points_per_event': (plot_points_per_event, ['event_day_stats'])},
+    'part3': {'attribute_boxplots': (plot_attribute_boxplots,
+                                     ['users_attributes_and_tot_points'])},
+}
+
+
+def render_figure(plot_func, products, path):
+    """
+    Renders one figure to a PNG file.  Runs in a worker process, so it only
+    uses the object-oriented matplotlib API and never pyplot.  Returns the
+    number of seconds it took.
+
+    plot_func (callable): function taking the products as positional
+    arguments and returning a matplotlib Figure
+
+    products (list): analysis products passed to plot_func
+
+    path (str): location of the PNG file
+    """
+
+    start = time.perf_counter()
+
+    fig = plot_func(*products)
+    fig.savefig(path, dpi=100)
+
+    return time.perf_counter() - start
+
+
+def export_table(product, path):
+    """
+    Writes an analysis product to Parquet, or to CSV when path ends in .csv.
+    Fitted regression models are written as their coefficient table.
+    Returns the number of seconds it took.
+
+    product (Pandas DataFrame or statsmodels results): product to write
+
+    path (str): location of the Parquet or CSV file
+    """
+
+    import pandas as pd
+
+    start = time.perf_counter()
+
+    if hasattr(product, 'summary2'):
+        product = product.summary2().tables[1]
+
+    if not isinstance(product, pd.DataFrame):
+        product = pd.DataFrame(product)
+
+    if path.endswith('.csv'):
+        product.to_csv(path)
+    else:
+        product.to_parquet(path)
+
+    return time.perf_counter() - start
+
+
+def create_engine_from_env(statement_timeout=None):
+    """
+    Builds the PostgreSQL engine from the connection settings in .env.
+
+    statement_timeout (float): seconds any query may run before the server
+    stops it, see sql_query_helper_funcs.set_statement_timeout
+    """
+
+    from dotenv import load_dotenv
+    from sqlalchemy import create_engine
+
+    load_dotenv()
+
+    db_user = os.environ.get('USER_NAME')
+    db_pass = os.environ.get('PASS')
+    db_ip = os.environ.get('IP_ADDRESS')
+    db_port = os.environ.get('PORT')
+    db_name = os.environ.get('DB_NAME')
+
+    engine = create_engine(f'postgresql+psycopg2://{db_user}:{db_pass}@{db_ip}:{db_port}/{db_name}',
+                           pool_size=8)
+
+    if statement_timeout:
+        from sql_query_helper_funcs import set_statement_timeout
+        set_statement_timeout(engine, statement_timeout)
+
+    return engine
+
+
+def run_report(parts,
+               output_dir,
+               engine=None,
+               start_date=None,
+               end_date=None,
+               segment=None,
+               workers=4,
+               force=False,
+               figures=True,
+               table_format='parquet',
+               cache_dir='.analysis_cache',
+               optimize_dtypes=False):
+    """
+    Runs the selected parts and writes their tables and figures to
+    output_dir.  Returns a list of per-stage timing records with the keys
+    stage, kind, status and seconds.
+
+    parts (list of str): parts to run, keys of PART_PRODUCTS
+
+    output_dir (str): directory the tables and figures are written to
+
+    engine (sql alchemy engine object): Used to establish a connection to
+    the db, built from .env when None
+
+    start_date, end_date (str): optional inclusive bounds on event_date
+
+    segment (str): optional 'column=value' user segment
+
+    workers (int): number of concurrent queries and figure renders
+
+    force (bool): ignore memoized results and re-run every query
+
+    figures (bool): render figures as well as tables
+
+    table_format (str): 'parquet' or 'csv'
+
+    cache_dir (str): directory of the memoized analysis products
+
+    optimize_dtypes (bool): hold and cache products with compact dtypes
+    """
+
+    from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+    from analysis_products import build_analysis_dag
+    from metrics_funcs import register_pool_metrics
+
+    engine = engine or create_engine_from_env()
+    register_pool_metrics(engine)
+    os.makedirs(output_dir, exist_ok=True)
+
+    dag = build_analysis_dag(engine,
+                             cache_dir=cache_dir,
+                             start_date=start_date,
+                             end_date=end_date,
+                             segment=segment,
+                             optimize_dtypes=optimize_dtypes)
+
+    targets = [product for part in parts for product in PART_PRODUCTS[part]]
+    products = dag.run(targets, max_workers=workers, force=force)
+
+    profile = [{'stage': node_name, 'kind': 'query', **record}
+               for node_name, record in dag.last_run.items()]
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {name: pool.submit(export_table,
+                                     product,
+                                     os.path.join(output_dir, f'{name}.{table_format}'))
+                   for name, product in products.items()}
+        for name, future in futures.items():
+            profile.append({'stage': name, 'kind': 'table',
+                            'status': 'written', 'seconds': future.result()})
+
+    figure_specs = [(name, spec) for part in parts
+                    for name, spec in PART_FIGURES[part].items()]
+
+    if figures and figure_specs:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = {name: pool.submit(render_figure,
+                                         plot_func,
+                                         [products[input_name] for input_name in inputs],
+                                         os.path.join(output_dir, f'{name}.png'))
+                       for name, (plot_func, inputs) in figure_specs}
+            for name, future in futures.items():
+                profile.append({'stage': name, 'kind': 'figure',
+                                'status': 'rendered', 'seconds': future.result()})
+
+    return profile
+
+
+def write_profile(profile, path, total_seconds):
+    """
+    Writes per-stage timings to a CSV file, with a final row for the whole
+    run.
+    """
+
+    import csv
+
+    with open(path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=['stage', 'kind', 'status', 'seconds'])
+        writer.writeheader()
+        writer.writerows(profile)
+        writer.writerow({'stage': 'total', 'kind': 'run',
+                         'status': 'done', 'seconds': total_seconds})
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Run the Bot Battles analysis headlessly.')
+    parser.add_argument('--parts', nargs='+', choices=list(PART_PRODUCTS),
+                        default=list(PART_PRODUCTS),
+                        help='parts of the analysis to run (default: all)')
+    parser.add_argument('--output-dir', default='reports',
+                        help='directory tables and figures are written to')
+    parser.add_argument('--start-date', help='only include events on or after this date (YYYY-MM-DD)')
+    parser.add_argument('--end-date', help='only include events on or before this date (YYYY-MM-DD)')
+    parser.add_argument('--segment', help="restrict to a user segment, ie 'subscriber=1' or 'category=US'")
+    parser.add_argument('--backend', choices=['postgres', 'duckdb'], default='postgres',
+                        help='database backend to run the queries on; duckdb loads the '
+                             'CSV files into an in-process database')
+    parser.add_argument('--data-dir', default='data',
+                        help='directory of the CSV files the duckdb backend loads')
+    parser.add_argument('--workers', type=int, default=4,
+                        help='number of concurrent queries and figure renders')
+    parser.add_argument('--cache-dir', default='.analysis_cache',
+                        help='directory of memoized analysis products')
+    parser.add_argument('--force', action='store_true',
+                        help='ignore memoized results and re-run every query')
+    parser.add_argument('--optimize-dtypes', action='store_true',
+                        help='hold and cache products with categorical and downcast dtypes')
+    parser.add_argument('--no-figures', action='store_true',
+                        help='only write tables')
+    parser.add_argument('--table-format', choices=['parquet', 'csv'], default='parquet',
+                        help='file format of the written tables')
+    parser.add_argument('--profile', action='store_true',
+                        help='write per-stage timings to profile.csv in the output directory')
+    parser.add_argument('--statement-timeout', type=float,
+                        help='seconds any query may run before the database stops it')
+    parser.add_argument('--metrics-file',
+                        help='write run metrics in the Prometheus text format to this file, '
+                             'ie for the node exporter textfile collector')
+
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    start = time.perf_counter()
+
+    if args.backend == 'duckdb':
+        from sql_query_helper_funcs import local_database, set_statement_timeout
+        engine = local_database(data_dir=args.data_dir)
+        set_statement_timeout(engine, args.statement_timeout)
+    else:
+        engine = create_engine_from_env(args.statement_timeout)
+
+    profile = run_report(args.parts,
+                         args.output_dir,
+                         engine=engine,
+                         start_date=args.start_date,
+                         end_date=args.end_date,
+                         segment=args.segment,
+                         workers=args.workers,
+                         force=args.force,
+                         figures=not args.no_figures,
+                         table_format=args.table_format,
+                         cache_dir=args.cache_dir,
+                         optimize_dtypes=args.optimize_dtypes)
+
+    total_seconds = time.perf_counter() - start
+
+    if args.profile:
+        profile_path = os.path.join(args.output_dir, 'profile.csv')
+        write_profile(profile, profile_path, total_seconds)
+        print(f"Stage timings written to {profile_path}.")
+
+    if args.metrics_file:
+        from metrics_funcs import write_metrics
+        write_metrics(args.metrics_file)
+        print(f"Metrics written to {args.metrics_file}.")
+
+    print(f"Report written to {args.output_dir} in {total_seconds:.2f} seconds.")
+
+
+if __name__ == '__main__':
+    main()
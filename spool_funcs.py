@@ -0,0 +1,452 @@
+import hashlib
+import json
+import os
+
+from ingestion_funcs import EVENT_PERFORMANCE_COLUMNS
+
+
+MANIFEST_NAME = 'manifest.json'
+
+PROGRESS_TABLE = 'load_progress'
+
+
+class SpoolError(RuntimeError):
+    """
+    Raised when a spool doesn't match its manifest, ie a batch file was
+    changed or the source file changed while it was being spooled.
+    """
+
+
+def _durable_write(path, data):
+    """
+    Replaces path with data so that either the old or the new contents
+    survive a crash, never a partial write.
+    """
+
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+    # Persist the rename itself
+    dir_fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+
+
+def read_manifest(spool_dir):
+    """
+    Returns the manifest of a spool as a dict, or None if there is none.
+
+    spool_dir (str): directory holding the batch files and manifest
+    """
+
+    path = os.path.join(spool_dir, MANIFEST_NAME)
+    if not os.path.exists(path):
+        return None
+
+    with open(path) as f:
+        return json.load(f)
+
+
+def write_manifest(spool_dir, manifest):
+    _durable_write(os.path.join(spool_dir, MANIFEST_NAME),
+                   json.dumps(manifest, indent=1).encode())
+
+
+def _source_fingerprint(path):
+    stat = os.stat(path)
+
+    return {'path': os.path.abspath(path), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+def _line_batches(source_file, batch_rows):
+    """
+    Yields lists of up to batch_rows lines from the current position of
+    source_file, each ending in a newline.
+    """
+
+    while True:
+        lines = []
+        for line in source_file:
+            lines.append(line if line.endswith(b'\n') else line + b'\n')
+            if len(lines) == batch_rows:
+                break
+
+        if not lines:
+            return
+
+        yield lines
+
+
+def _append_batch(spool_dir, manifest, lines, source_offset):
+    data = b''.join(lines)
+    batch_id = len(manifest['batches']) + 1
+    batch_file = f'batch-{batch_id:06d}.csv'
+    _durable_write(os.path.join(spool_dir, batch_file), data)
+
+    manifest['source_offset'] = source_offset
+    manifest['batches'].append({'batch_id': batch_id,
+                                'file': batch_file,
+                                'rows': len(lines),
+                                'bytes': len(data),
+                                'sha256': hashlib.sha256(data).hexdigest(),
+                                'status': 'spooled'})
+    write_manifest(spool_dir, manifest)
+
+
+def _lines_frame(lines, columns):
+    """
+    Parses raw CSV lines into a Pandas DataFrame of strings with the raw
+    line of each row in a line column, so rows can be deduplicated on their
+    values and spooled exactly as they arrived.
+    """
+
+    import io
+
+    import pandas as pd
+
+    frame = pd.read_csv(io.BytesIO(b''.join(lines)),
+                        header=None,
+                        names=columns,
+                        dtype=str,
+                        keep_default_na=False,
+                        skip_blank_lines=False)
+
+    if len(frame) != len(lines):
+        raise SpoolError("Rows span several lines, they can't be spooled with dedup")
+
+    frame['line'] = pd.Series(lines, dtype=object)
+
+    return frame
+
+
+def spool_file(path,
+               spool_dir,
+               batch_rows=100_000,
+               dedup=None,
+               columns=EVENT_PERFORMANCE_COLUMNS):
+    """
+    Splits a CSV file into fixed-size batch files under spool_dir, each
+    fsynced and recorded with its row count and SHA-256 in a manifest that
+    is rewritten atomically after every batch.  Spooling an unchanged
+    source into the same directory again resumes after the last spooled
+    batch, so an interrupted spool only repeats one batch.  The header line
+    is kept in the manifest and left out of the batches.  Quoted fields
+    must not contain newlines, which holds for the event_performance
+    exports.  Returns the manifest.
+
+    With dedup, duplicate rows are dropped on the way into the batches by
+    an EventDeduplicator and its per-batch counts are kept in the manifest
+    (see read_dedup_report).  The deduplicator's state isn't durable, so an
+    interrupted deduplicating spool starts over instead of resuming, which
+    is cheap next to the load it precedes.
+
+    path (str): location of the CSV file
+
+    spool_dir (str): directory the batches and manifest are written to
+
+    batch_rows (int): rows per batch
+
+    dedup (str or EventDeduplicator): policy from dedup_funcs.DEDUP_POLICIES
+    or a configured deduplicator, None to spool every row
+
+    columns (list of str): names of the CSV columns, used for dedup
+    """
+
+    os.makedirs(spool_dir, exist_ok=True)
+
+    if isinstance(dedup, str):
+        from dedup_funcs import EventDeduplicator
+
+        dedup = EventDeduplicator(dedup)
+    dedup_policy = None if dedup is None else dedup.policy
+
+    source = _source_fingerprint(path)
+    manifest = read_manifest(spool_dir)
+
+    if manifest is not None and (manifest['source'] != source
+                                 or manifest.get('dedup_policy') != dedup_policy):
+        raise SpoolError(f"{spool_dir} already spools {manifest['source']['path']} "
+                         "at a different version or dedup policy, use a new spool directory")
+
+    if manifest is None or (dedup is not None and not manifest['complete']):
+        # Spooling the same source with the same settings always yields the
+        # same batches, so they can share progress records
+        spool_id = hashlib.sha256(json.dumps({**source, 'batch_rows': batch_rows,
+                                              'dedup_policy': dedup_policy},
+                                             sort_keys=True).encode()).hexdigest()[:16]
+        manifest = {'spool_id': spool_id,
+                    'source': source,
+                    'batch_rows': batch_rows,
+                    'dedup_policy': dedup_policy,
+                    'header': None,
+                    'source_offset': 0,
+                    'complete': False,
+                    'batches': []}
+
+    if manifest['complete']:
+        return manifest
+
+    with open(path, 'rb') as source_file:
+        if manifest['header'] is None:
+            header = source_file.readline()
+            manifest['header'] = header.decode().rstrip('\r\n')
+            manifest['source_offset'] = len(header)
+
+        source_file.seek(manifest['source_offset'])
+        batch_rows = manifest['batch_rows']
+
+        for lines in _line_batches(source_file, batch_rows):
+            if dedup is not None:
+                lines = dedup.add(_lines_frame(lines, columns))['line'].tolist()
+            if lines:
+                _append_batch(spool_dir, manifest, lines, source_file.tell())
+
+        if dedup is not None:
+            for released in dedup.finish():
+                lines = released['line'].tolist()
+                for start in range(0, len(lines), batch_rows):
+                    _append_batch(spool_dir, manifest, lines[start:start + batch_rows],
+                                  source_file.tell())
+
+            report = dedup.report()
+            manifest['dedup_report'] = report.reset_index().to_dict('records')
+
+            from metrics_funcs import ROWS_REJECTED
+            ROWS_REJECTED.labels('spool', 'exact_duplicate').inc(int(report['exact_duplicates'].sum()))
+            ROWS_REJECTED.labels('spool', 'key_duplicate').inc(int(report['key_duplicates'].sum()))
+
+    if _source_fingerprint(path) != source:
+        raise SpoolError(f"{path} changed while it was being spooled")
+
+    manifest['complete'] = True
+    write_manifest(spool_dir, manifest)
+
+    return manifest
+
+
+def read_dedup_report(spool_dir):
+    """
+    Returns the duplicate counts of a deduplicating spool as a Pandas
+    DataFrame with one row per source batch of batch_rows rows, or None if
+    the spool wasn't deduplicated.
+
+    spool_dir (str): directory written by spool_file
+    """
+
+    import pandas as pd
+
+    manifest = read_manifest(spool_dir)
+    if manifest is None or 'dedup_report' not in manifest:
+        return None
+
+    return pd.DataFrame(manifest['dedup_report']).set_index('batch')
+
+
+def ensure_progress_table(engine, progress_table=PROGRESS_TABLE):
+    """
+    Creates the table recording committed batches if it doesn't exist.
+
+    engine (sql alchemy engine object): Used to establish a connection to the db
+
+    progress_table (str): name of the progress table
+    """
+
+    from sqlalchemy import text
+
+    with engine.begin() as conn:
+        conn.execute(text(f"""
+CREATE TABLE IF NOT EXISTS {progress_table} (
+       spool_id text,
+    target_table text,
+      target_oid oid,
+        batch_id int,
+          sha256 text,
+            rows int,
+    committed_at timestamptz DEFAULT now(),
+     PRIMARY KEY (spool_id, target_oid, batch_id)
+    );
+"""))
+
+
+def committed_batches(engine, spool_id, table, progress_table=PROGRESS_TABLE):
+    """
+    Returns the set of batch_ids of a spool already committed to table.
+    Progress is tracked against the table's oid, so batches committed to a
+    table that has since been dropped and recreated, like the part 1
+    staging tables, don't count.
+
+    engine (sql alchemy engine object): Used to establish a connection to the db
+
+    spool_id (str): id from the spool's manifest
+
+    table (str): table the spool is loaded into
+
+    progress_table (str): name of the progress table
+    """
+
+    from sqlalchemy import text
+
+    with engine.connect() as conn:
+        rows = conn.execute(text(f"SELECT batch_id FROM {progress_table} "
+                                 "WHERE spool_id = :spool_id "
+                                 "  AND target_oid = CAST(:table AS regclass)::oid"),
+                            {'spool_id': spool_id, 'table': table})
+
+        return {row[0] for row in rows}
+
+
+def reset_progress(engine, spool_id, table, progress_table=PROGRESS_TABLE):
+    """
+    Forgets which batches of a spool were committed to table, ie after the
+    table was truncated, so the next load starts over.
+
+    engine (sql alchemy engine object): Used to establish a connection to the db
+
+    spool_id (str): id from the spool's manifest
+
+    table (str): table the spool is loaded into
+
+    progress_table (str): name of the progress table
+    """
+
+    from sqlalchemy import text
+
+    with engine.begin() as conn:
+        conn.execute(text(f"DELETE FROM {progress_table} "
+                          "WHERE spool_id = :spool_id "
+                          "  AND target_oid = CAST(:table AS regclass)::oid"),
+                     {'spool_id': spool_id, 'table': table})
+
+
+def load_spool(spool_dir,
+               engine,
+               table='event_performance_staging',
+               columns=EVENT_PERFORMANCE_COLUMNS,
+               progress_table=PROGRESS_TABLE):
+    """
+    Loads a spool's batches into a table with one COPY per batch.  Each
+    batch is checked against its checksum and committed in its own
+    transaction together with its row in the progress table, so a batch is
+    either fully loaded and recorded or not at all.  Batches already in the
+    progress table are skipped, so after a failure, running the load again
+    resumes at the first uncommitted batch and redoes at most one batch of
+    work.  Spools that were only partly written are refused.  Returns a dict with the number of batches and rows loaded and
+    skipped.
+
+    spool_dir (str): directory written by spool_file
+
+    engine (sql alchemy engine object): Used to establish a connection to the db
+
+    table (str): name of the table to COPY into
+
+    columns (list of str): table columns in CSV column order
+
+    progress_table (str): name of the progress table
+    """
+
+    import io
+    from metrics_funcs import ROWS_LOADED
+
+    manifest = read_manifest(spool_dir)
+    if manifest is None:
+        raise SpoolError(f"No manifest in {spool_dir}, spool a file first")
+    if not manifest['complete']:
+        raise SpoolError(f"Spool in {spool_dir} is incomplete, finish spooling the source first")
+
+    copy_sql = (f"COPY {table}({', '.join(columns)}) FROM STDIN WITH (FORMAT csv)")
+    record_sql = (f"INSERT INTO {progress_table} "
+                  "(spool_id, target_table, target_oid, batch_id, sha256, rows) "
+                  "VALUES (%s, %s, CAST(%s AS regclass)::oid, %s, %s, %s)")
+
+    ensure_progress_table(engine, progress_table)
+    done = committed_batches(engine, manifest['spool_id'], table, progress_table)
+
+    summary = {'batches_loaded': 0, 'rows_loaded': 0, 'batches_skipped': 0, 'rows_skipped': 0}
+
+    conn = engine.raw_connection()
+    try:
+        cursor = conn.cursor()
+
+        for batch in manifest['batches']:
+            if batch['batch_id'] in done:
+                summary['batches_skipped'] += 1
+                summary['rows_skipped'] += batch['rows']
+                continue
+
+            with open(os.path.join(spool_dir, batch['file']), 'rb') as f:
+                data = f.read()
+            if hashlib.sha256(data).hexdigest() != batch['sha256']:
+                raise SpoolError(f"Checksum mismatch in {batch['file']}, re-spool the source")
+
+            try:
+                cursor.copy_expert(copy_sql, io.BytesIO(data))
+                cursor.execute(record_sql, (manifest['spool_id'], table, table,
+                                            batch['batch_id'], batch['sha256'], batch['rows']))
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+
+            summary['batches_loaded'] += 1
+            summary['rows_loaded'] += batch['rows']
+            ROWS_LOADED.labels(table).inc(batch['rows'])
+    finally:
+        conn.close()
+
+    # The progress table is the source of truth; the manifest status is a
+    # convenience for inspecting the spool
+    done = committed_batches(engine, manifest['spool_id'], table, progress_table)
+    for batch in manifest['batches']:
+        batch['status'] = 'committed' if batch['batch_id'] in done else 'spooled'
+    write_manifest(spool_dir, manifest)
+
+    return summary
+
+
+def spool_and_load(path,
+                   spool_dir,
+                   engine,
+                   table='event_performance_staging',
+                   columns=EVENT_PERFORMANCE_COLUMNS,
+                   batch_rows=100_000,
+                   dedup=None):
+    """
+    Spools a CSV file and loads it batch by batch, resuming both steps from
+    where a previous run stopped.  Prints and returns the load summary.
+
+    path (str): location of the CSV file
+
+    spool_dir (str): directory the batches and manifest are written to
+
+    engine (sql alchemy engine object): Used to establish a connection to the db
+
+    table (str): name of the table to COPY into
+
+    columns (list of str): table columns in CSV column order
+
+    batch_rows (int): rows per batch
+
+    dedup (str or EventDeduplicator): drop duplicate rows while spooling,
+    see spool_file
+    """
+
+    manifest = spool_file(path, spool_dir, batch_rows, dedup, columns)
+    summary = load_spool(spool_dir, engine, table, columns)
+
+    print(f"Loaded {summary['rows_loaded']:,} rows in {summary['batches_loaded']} batches "
+          f"into {table}, skipped {summary['batches_skipped']} of "
+          f"{len(manifest['batches'])} batches already committed.")
+
+    report = read_dedup_report(spool_dir)
+    if report is not None:
+        print(f"Dropped {report['exact_duplicates'].sum():,} exact and "
+              f"{report['key_duplicates'].sum():,} key duplicates of {report['rows'].sum():,} "
+              f"rows ({manifest['dedup_policy']} policy).")
+
+    return summary
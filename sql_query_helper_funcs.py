@@ -1,18 +1,144 @@
+import contextlib
+import re
+import threading
+
+
+# PostgreSQL to_date/to_char template patterns and their strptime equivalents
+DATE_FORMAT_CODES = {'YYYY': '%Y', 'YY': '%y', 'MM': '%m', 'DD': '%d',
+                     'HH24': '%H', 'HH12': '%I', 'HH': '%I', 'MI': '%M', 'SS': '%S'}
+
+# Matches :name bind parameters but not PostgreSQL :: casts
+BIND_PARAM_PATTERN = re.compile(r'(?<![:\w]):([A-Za-z_]\w*)')
+
+TO_DATE_PATTERN = re.compile(r"\bto_date\(\s*([^,()]+?)\s*,\s*'([^']*)'\s*\)", re.IGNORECASE)
+
+NUMERIC_CAST_PATTERN = re.compile(r'::\s*NUMERIC\b(?!\s*\()', re.IGNORECASE)
+
+REGEX_MATCH_PATTERN = re.compile(r"([\w.]+)\s*(!?)~(\*?)\s*('(?:[^']|'')*')")
+
+CURRENT_DATE_PATTERN = re.compile(r'\bCURRENT_DATE\b(?!\s*\()', re.IGNORECASE)
+
+# String literals, with '' escapes, and -- comments, which translate_sql
+# leaves as written
+LITERAL_PATTERN = re.compile(r"'(?:[^']|'')*'|--[^\n]*")
+
+# What translate_sql puts in place of a literal while rewriting the rest
+LITERAL_PLACEHOLDER_PATTERN = re.compile(r"'\x00(\d+)\x00'")
+
+# DuckDB names an unaliased column::type result after the whole cast, where
+# PostgreSQL keeps the column's name
+CAST_COLUMN_NAME_PATTERN = re.compile(r'^CAST\("?(\w+)"? AS .*\)$')
+
+# Rows per chunk when a progress callback is passed without a chunksize
+PROGRESS_CHUNKSIZE = 100_000
+
+# SQLSTATE PostgreSQL reports for statements stopped by statement_timeout or
+# a cancel request
+QUERY_CANCELED_SQLSTATE = '57014'
+
+
+class QueryCancelled(RuntimeError):
+    """
+    Raised by the helpers when a query is stopped before it completes,
+    either by a statement timeout (reason 'timeout') or by a CancelToken
+    (reason 'cancelled').  The database has abandoned the statement and
+    rolled back its transaction.
+    """
+
+    def __init__(self, reason):
+        self.reason = reason
+        super().__init__('Query cancelled' if reason == 'cancelled'
+                         else 'Query stopped by its statement timeout')
+
+
+class CancelToken:
+    """
+    Cancels the queries it is passed to from another thread or an asyncio
+    task.  cancel() asks the database to abandon the statement running at
+    the time, and a streaming read stops before its next chunk.  A token
+    stays cancelled, so one token can stop a group of queries, and queries
+    started with a cancelled token fail straight away.
+    """
+
+    def __init__(self):
+        self._event = threading.Event()
+        self._interrupts = []
+        self._lock = threading.Lock()
+
+    @property
+    def cancelled(self):
+        return self._event.is_set()
+
+    def cancel(self):
+        # Interrupts run under the lock, so once watch() has returned its
+        # connection is never interrupted while running someone else's query
+        with self._lock:
+            self._event.set()
+            for interrupt in self._interrupts:
+                interrupt()
+
+    def raise_if_cancelled(self):
+        if self.cancelled:
+            raise QueryCancelled('cancelled')
+
+    @contextlib.contextmanager
+    def watch(self, interrupt):
+        """
+        Context manager calling interrupt if the token is cancelled while
+        its block runs.
+
+        interrupt (callable): stops the statement running on a connection,
+        ie a psycopg2 connection's cancel method
+        """
+
+        with self._lock:
+            self.raise_if_cancelled()
+            self._interrupts.append(interrupt)
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._interrupts.remove(interrupt)
+
+
 def exec_and_commit_query(sql_query,
-                          engine):
+                          engine,
+                          timeout=None,
+                          cancel=None):
     """
     Creates a connection with the database, then converts a string containing a SQL query to a SQLAlchemy text object.  The connection object executes the SQL query and commits the changes to the database.
     
     sql_query (string): a string containing a query in SQL syntax
     
-    engine (sql alchemy engine object): Used to establish a connection to the db
+    engine (sql alchemy engine object or LocalDatabase): Used to establish a
+    connection to the db
+
+    timeout (float): seconds the query may run before the database stops
+    it, overriding the engine's set_statement_timeout for this call
+
+    cancel (CancelToken): token that can stop the query from another thread
+    or asyncio task.  A stopped query raises QueryCancelled and commits
+    nothing.
     """
     
+    from metrics_funcs import QUERY_SECONDS
+
+    backend = backend_name(engine)
+
+    if isinstance(engine, LocalDatabase):
+        with _translate_cancellation(backend, cancel), \
+             QUERY_SECONDS.labels(backend, 'execute').time():
+            engine.execute(sql_query, timeout=timeout, cancel=cancel)
+        print("Query executed and committed.")
+        return
+
     from sqlalchemy import text
     
     conn = engine.connect()
     
-    with conn as con:
+    with _translate_cancellation(backend, cancel), conn as con, \
+         QUERY_SECONDS.labels(backend, 'execute').time(), \
+         _guard_connection(conn, timeout, cancel):
         text_sql_query = text(sql_query)
 
         conn.execute(text_sql_query)
@@ -25,7 +151,15 @@ def sql_query_to_pandas_df(sql_query,
                            engine, 
                            path=None,
                            index_column=None, 
-                           dates_column=None):
+                           dates_column=None,
+                           wait_for_export=False,
+                           params=None,
+                           optimize_dtypes=False,
+                           chunksize=None,
+                           report_memory=False,
+                           timeout=None,
+                           cancel=None,
+                           progress=None):
     """
     Establishes a connection to a SQL database, then sends a SQL query
     to that database, returning the results as a Pandas DataFrame.  Closes
@@ -33,26 +167,576 @@ def sql_query_to_pandas_df(sql_query,
     
     sql_query (string): a string containing a query in SQL syntax
     
-    engine (sql alchemy engine object): Used to establish a connection to the db
+    engine (sql alchemy engine object or LocalDatabase): Used to establish a
+    connection to the db
     
     index_column (str or list of str): Specifies which column(s) should be set 
     as the index in the Pandas DataFrame that gets returned
     
     dates_column (str or list of str): Specifies which column(s) in the Pandas 
     DataFrame should be parsed as dates
+
+    path (str): If given, the DataFrame is also rendered to this file, with
+    the format (.png, .svg or .html) taken from the extension.  Rendering
+    happens on a background worker so the query isn't blocked; call
+    table_export_funcs.wait_for_exports() to make sure the file is written.
+    
+    wait_for_export (bool): Block until the file at path is written
+
+    params (dict): Values for :name bind parameters in sql_query.  They are
+    sent to the database separately instead of being formatted into the SQL
+
+    optimize_dtypes (bool): Store low cardinality text as categoricals, other
+    text as pyarrow strings and downcast integers, see dtype_funcs
+
+    chunksize (int): Read the results this many rows at a time, optimizing
+    each chunk as it arrives when optimize_dtypes is set
+
+    report_memory (bool): Print the memory used by each column as read and
+    as returned
+
+    timeout (float): seconds the query may run before the database stops
+    it, overriding the engine's set_statement_timeout for this call.  A
+    streaming read has the timeout for all of its chunks together.
+
+    cancel (CancelToken): token that can stop the query from another thread
+    or asyncio task.  A stopped query raises QueryCancelled.
+
+    progress (callable): called after each chunk with a dict of the chunks
+    and rows fetched so far, the seconds elapsed and rows_per_second, ie
+    print_progress.  Reads in chunks of PROGRESS_CHUNKSIZE rows when no
+    chunksize is given.
     """
     
+    import time
     import pandas as pd
+    from metrics_funcs import QUERY_SECONDS
     
-    conn = engine.connect()
+    start = time.perf_counter()
+    backend = backend_name(engine)
+
+    if progress is not None and chunksize is None:
+        chunksize = PROGRESS_CHUNKSIZE
+
+    if isinstance(engine, LocalDatabase):
+        conn = contextlib.nullcontext()
+    else:
+        conn = engine.connect()
     
-    with conn as con:
-        df=pd.read_sql_query(sql=sql_query, 
-                             con=conn, 
-                             index_col=index_column,
-                             parse_dates=dates_column)
+    if params is not None and not isinstance(engine, LocalDatabase):
+        from sqlalchemy import text
+        sql_query = text(sql_query)
+    
+    with _translate_cancellation(backend, cancel), conn as con:
+        if isinstance(engine, LocalDatabase):
+            guard = contextlib.nullcontext()
+        else:
+            guard = _guard_connection(conn, timeout, cancel)
+            if chunksize is not None:
+                # A server side cursor, so each chunk is fetched as it is
+                # read instead of the whole result up front
+                conn.execution_options(stream_results=True)
+
+        with guard:
+            if isinstance(engine, LocalDatabase):
+                df = engine.read_frame(sql_query,
+                                       params=params,
+                                       index_column=index_column,
+                                       dates_column=dates_column,
+                                       chunksize=chunksize,
+                                       timeout=timeout,
+                                       cancel=cancel)
+            else:
+                df=pd.read_sql_query(sql=sql_query, 
+                                     con=conn, 
+                                     index_col=index_column,
+                                     parse_dates=dates_column,
+                                     params=params,
+                                     chunksize=chunksize)
+
+            if chunksize is not None and (cancel is not None or progress is not None):
+                df = _watch_chunks(df, cancel, progress)
+
+            if chunksize is not None or optimize_dtypes or report_memory:
+                from dtype_funcs import collect_chunks, memory_report
+                df, raw_profile = collect_chunks(df, optimize=optimize_dtypes)
+                if report_memory:
+                    print(memory_report(raw_profile, df))
+
+    QUERY_SECONDS.labels(backend, 'read').observe(time.perf_counter() - start)
+
     if path:
-        import dataframe_image as dfi
-        dfi.export(df, path)
+        from table_export_funcs import default_exporter
+        future = default_exporter().submit(df, path)
+        if wait_for_export:
+            future.result()
     
-    return df
\ No newline at end of file
+    return df
+
+
+def backend_name(engine):
+    """
+    Returns the name of the database an engine talks to, ie 'postgresql' or
+    'duckdb'.
+
+    engine (sql alchemy engine object or LocalDatabase): Used to establish a
+    connection to the db
+    """
+
+    return 'duckdb' if isinstance(engine, LocalDatabase) else engine.dialect.name
+
+
+async def sql_query_to_pandas_df_async(sql_query, engine, **kwargs):
+    """
+    sql_query_to_pandas_df for asyncio code.  The query runs on the event
+    loop's default executor, and cancelling the awaiting task cancels the
+    query, waiting for the database to abandon it before the task's
+    CancelledError is raised.  Keyword arguments are passed on to
+    sql_query_to_pandas_df.
+    """
+
+    import asyncio
+    import functools
+
+    cancel = kwargs.pop('cancel', None) or CancelToken()
+    loop = asyncio.get_running_loop()
+    future = loop.run_in_executor(None, functools.partial(sql_query_to_pandas_df,
+                                                          sql_query,
+                                                          engine,
+                                                          cancel=cancel,
+                                                          **kwargs))
+
+    try:
+        return await asyncio.shield(future)
+    except asyncio.CancelledError:
+        cancel.cancel()
+        # The worker raises QueryCancelled once the connection is released
+        await asyncio.wait([future])
+        if not future.cancelled():
+            # Retrieved, so asyncio doesn't log it as never retrieved
+            future.exception()
+        raise
+
+
+def set_statement_timeout(engine, seconds):
+    """
+    Sets a statement timeout for every query sent through an engine, so a
+    runaway query is stopped by the database instead of holding its
+    connection and locks.  On PostgreSQL, statement_timeout is set for each
+    new connection of the engine's pool and the pool's current connections
+    are replaced once they are returned.  The timeout and cancel arguments
+    of the helpers override it for one call.
+
+    engine (sql alchemy engine object or LocalDatabase): engine to limit
+
+    seconds (float): longest a statement may run, None or 0 for no limit
+    """
+
+    engine.statement_timeout = seconds or None
+
+    if isinstance(engine, LocalDatabase):
+        return
+
+    from sqlalchemy import event
+
+    previous = getattr(engine, '_statement_timeout_listener', None)
+    if previous is not None:
+        event.remove(engine, 'connect', previous)
+        engine._statement_timeout_listener = None
+
+    def set_on_connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute('SET statement_timeout = %s;', (_milliseconds(seconds),))
+        cursor.close()
+        # Otherwise the pool's rollback on checkin would undo the SET
+        dbapi_connection.commit()
+
+    if seconds:
+        event.listen(engine, 'connect', set_on_connect)
+        engine._statement_timeout_listener = set_on_connect
+    engine.dispose()
+
+
+def print_progress(status):
+    """
+    Progress callback for sql_query_to_pandas_df printing the rows fetched
+    and the fetch rate after each chunk.
+    """
+
+    print(f"Fetched {status['rows']:,} rows in {status['seconds']:.1f} seconds "
+          f"({status['rows_per_second']:,.0f} rows/s).")
+
+
+def _milliseconds(seconds):
+    # statement_timeout takes milliseconds, where 0 disables it
+    return max(round(seconds * 1000), 1) if seconds else 0
+
+
+@contextlib.contextmanager
+def _guard_connection(conn, timeout=None, cancel=None):
+    """
+    Applies a per-call statement timeout to the transaction of a SQLAlchemy
+    connection and lets cancel interrupt the statements run in the block.
+    """
+
+    if timeout is not None:
+        from sqlalchemy import text
+        # Local to the transaction, so the pooled connection keeps its own
+        conn.execute(text("SELECT set_config('statement_timeout', :timeout, true);"),
+                     {'timeout': str(_milliseconds(timeout))})
+
+    if cancel is None:
+        yield
+        return
+
+    with cancel.watch(conn.connection.dbapi_connection.cancel):
+        yield
+
+
+@contextlib.contextmanager
+def _translate_cancellation(backend, cancel=None):
+    """
+    Turns the errors a driver raises for a statement stopped by a timeout or
+    a cancel request into QueryCancelled, counting them in
+    QUERIES_CANCELLED.
+    """
+
+    from metrics_funcs import QUERIES_CANCELLED
+
+    try:
+        yield
+    except QueryCancelled as error:
+        QUERIES_CANCELLED.labels(backend, error.reason).inc()
+        raise
+    except Exception as error:
+        if backend == 'duckdb':
+            import duckdb
+            interrupted = isinstance(error, duckdb.InterruptException)
+            timed_out = not (cancel is not None and cancel.cancelled)
+        else:
+            # pandas wraps driver errors in its own DatabaseError
+            causes = [error]
+            while causes[-1].__cause__ is not None:
+                causes.append(causes[-1].__cause__)
+            interrupted = any(getattr(cause, 'pgcode', None) == QUERY_CANCELED_SQLSTATE
+                              for cause in causes)
+            timed_out = 'statement timeout' in str(error)
+        if not interrupted:
+            raise
+
+        reason = 'timeout' if timed_out else 'cancelled'
+        QUERIES_CANCELLED.labels(backend, reason).inc()
+        raise QueryCancelled(reason) from error
+
+
+def _watch_chunks(chunks, cancel=None, progress=None):
+    """
+    Passes on the chunks of a streaming read, reporting progress after each
+    chunk and stopping before the next one once cancel is cancelled.
+    """
+
+    import time
+
+    start = time.perf_counter()
+    rows = 0
+
+    for number, chunk in enumerate(chunks, start=1):
+        rows += len(chunk)
+        if progress is not None:
+            seconds = time.perf_counter() - start
+            progress({'chunks': number,
+                      'rows': rows,
+                      'seconds': seconds,
+                      'rows_per_second': rows / seconds if seconds > 0 else 0.0})
+        yield chunk
+        if cancel is not None:
+            cancel.raise_if_cancelled()
+
+
+def translate_sql(sql_query):
+    """
+    Rewrites the PostgreSQL-isms used in this project's queries into DuckDB
+    SQL.  Returns the rewritten query.  DATE_TRUNC, PERCENTILE_CONT ...
+    WITHIN GROUP, REGEXP_REPLACE with flags, :: casts and COPY ... FROM
+    'file' DELIMITER ',' CSV HEADER run on DuckDB as written, so only the
+    following are rewritten:
+
+    - to_date(text, 'MM/DD/YY') becomes try_strptime(text, '%m/%d/%y')::DATE.
+      Text that doesn't match the format becomes NULL instead of raising,
+      since DuckDB's ALTER COLUMN ... USING also evaluates rows deleted
+      earlier in the session
+    - bare NUMERIC casts become DOUBLE, as DuckDB's NUMERIC is DECIMAL(18,3)
+      and would truncate proportions
+    - the ~ and ~* regex operators become regexp_matches calls
+    - CURRENT_DATE becomes current_date(), which DuckDB also accepts in
+      CHECK constraints
+    - public. schema prefixes become main.
+    - :name bind parameters become $name
+
+    Text inside string literals and comments is never rewritten.
+
+    sql_query (string): a string containing a query in PostgreSQL syntax
+    """
+
+    literals = []
+
+    def hide(literal):
+        literals.append(literal)
+        return f"'\x00{len(literals) - 1}\x00'"
+
+    def to_date(match):
+        expression, template = match.groups()
+        template = literals[int(template.strip('\x00'))][1:-1]
+        for pattern, code in DATE_FORMAT_CODES.items():
+            template = template.replace(pattern, code)
+        template = hide("'" + template + "'")
+        return f"try_strptime({expression}, {template})::DATE"
+
+    def regex_match(match):
+        operand, negated, insensitive, pattern = match.groups()
+        options = ", 'i'" if insensitive else ''
+        return f"{'NOT ' if negated else ''}regexp_matches({operand}, {pattern}{options})"
+
+    # Literals are swapped for numbered placeholders that no rewrite
+    # matches, then put back
+    sql_query = LITERAL_PATTERN.sub(lambda match: hide(match.group(0)), sql_query)
+
+    sql_query = TO_DATE_PATTERN.sub(to_date, sql_query)
+    sql_query = NUMERIC_CAST_PATTERN.sub('::DOUBLE', sql_query)
+    sql_query = REGEX_MATCH_PATTERN.sub(regex_match, sql_query)
+    sql_query = CURRENT_DATE_PATTERN.sub('current_date()', sql_query)
+    sql_query = re.sub(r'\bpublic\.', 'main.', sql_query, flags=re.IGNORECASE)
+    sql_query = BIND_PARAM_PATTERN.sub(r'$\1', sql_query)
+
+    return LITERAL_PLACEHOLDER_PATTERN.sub(lambda match: literals[int(match.group(1))],
+                                           sql_query)
+
+
+class LocalDatabase:
+    """
+    Embedded DuckDB database that stands in for the PostgreSQL engine, so the
+    helpers, analysis products and report run in-process without a server.
+    Queries are passed through translate_sql, and every call gets its own
+    cursor, so concurrent queries from the analysis DAG's threads are safe.
+    Pass it anywhere an engine is expected.
+
+    path (str): database file, or ':memory:' for a database that lives as
+    long as the object
+
+    statement_timeout (float): seconds a statement may run before it is
+    interrupted, see set_statement_timeout
+    """
+
+    def __init__(self, path=':memory:', statement_timeout=None):
+        import duckdb
+
+        self.path = path
+        self.statement_timeout = statement_timeout
+        self.connection = duckdb.connect(path)
+
+    def __repr__(self):
+        return f'LocalDatabase({self.path!r})'
+
+    def close(self):
+        self.connection.close()
+
+    def _guard(self, cursor, timeout=None, cancel=None):
+        """
+        Returns an ExitStack that interrupts cursor once timeout seconds
+        have passed or cancel is cancelled, and closes cursor when it is
+        closed.  DuckDB has no statement_timeout, so a timer stands in.
+        """
+
+        timeout = self.statement_timeout if timeout is None else timeout
+
+        guard = contextlib.ExitStack()
+        guard.callback(cursor.close)
+
+        try:
+            if cancel is not None:
+                guard.enter_context(cancel.watch(cursor.interrupt))
+            if timeout:
+                timer = threading.Timer(timeout, cursor.interrupt)
+                timer.daemon = True
+                timer.start()
+                guard.callback(timer.cancel)
+        except BaseException:
+            guard.close()
+            raise
+
+        return guard
+
+    def execute(self, sql_query, params=None, timeout=None, cancel=None):
+        """
+        Runs one or more statements.  Changes are committed as each
+        statement completes.  An interrupted statement raises
+        duckdb.InterruptException.
+
+        sql_query (string): a string containing a query in PostgreSQL syntax
+
+        params (dict): values for :name bind parameters, single statements
+        only
+
+        timeout (float): seconds before the statements are interrupted,
+        defaults to statement_timeout
+
+        cancel (CancelToken): token that can interrupt the statements
+        """
+
+        cursor = self.connection.cursor()
+        with self._guard(cursor, timeout, cancel):
+            cursor.execute(translate_sql(sql_query), params)
+
+    def read_frame(self,
+                   sql_query,
+                   params=None,
+                   index_column=None,
+                   dates_column=None,
+                   chunksize=None,
+                   timeout=None,
+                   cancel=None):
+        """
+        Runs a query and returns the results as a Pandas DataFrame, or an
+        iterator of DataFrames of chunksize rows, like pd.read_sql_query.
+        Arguments are as for sql_query_to_pandas_df, except that an
+        interrupted query raises duckdb.InterruptException.
+        """
+
+        cursor = self.connection.cursor()
+
+        with self._guard(cursor, timeout, cancel) as guard:
+            cursor.execute(translate_sql(sql_query), params)
+
+            # DuckDB sums integers to 128 bit integers, which pandas reads as
+            # floats, where PostgreSQL returns bigint
+            columns = column_names(cursor)
+            wide_integers = [name for name, column in zip(columns, cursor.description)
+                             if str(column[1]) == 'HUGEINT']
+
+            if chunksize is None:
+                return _finish_frame(cursor.df(), columns, index_column, dates_column,
+                                     wide_integers)
+
+            # The chunks are fetched as they're read, so the timer and the
+            # cursor are handed to the iterator
+            guard = guard.pop_all()
+
+        def chunks():
+            with guard:
+                for batch in cursor.to_arrow_reader(chunksize):
+                    yield _finish_frame(batch.to_pandas(), columns, index_column, dates_column,
+                                        wide_integers)
+
+        return chunks()
+
+    def load_table(self, table, path, columns=None):
+        """
+        Creates table from a CSV or Parquet file, replacing it if it exists.
+
+        table (str): name of the table
+
+        path (str): location of the file, .parquet for Parquet, CSV otherwise
+
+        columns (list of str): names for the file's columns, in order, when
+        they differ from its header
+        """
+
+        reader = 'read_parquet' if path.endswith('.parquet') else 'read_csv'
+        names = '' if columns is None else f"({', '.join(columns)})"
+
+        self.execute(f"CREATE OR REPLACE TABLE {table} AS "
+                     f"SELECT * FROM {reader}('{path}') AS source{names};")
+
+    def table_fingerprint(self, table):
+        """
+        Returns a fingerprint of a table's contents: its row count and the
+        sum of its row hashes.  DuckDB has no statistics collector to read
+        write counters from, but hashing even the events table takes
+        milliseconds.  Returns None when the table doesn't exist.
+
+        table (str): name of the table
+        """
+
+        with self.connection.cursor() as cursor:
+            exists = cursor.execute("SELECT COUNT(*) FROM duckdb_tables() WHERE table_name = $table;",
+                                    {'table': table}).fetchone()[0]
+            if not exists:
+                return None
+
+            count, total = cursor.execute(f"SELECT COUNT(*), SUM(hash({table})::HUGEINT) "
+                                          f"FROM {table};").fetchone()
+
+        return (count, str(total))
+
+
+def column_names(cursor):
+    """
+    Returns the result column names of a DuckDB cursor, named the way
+    PostgreSQL names them.
+
+    cursor (DuckDB connection): cursor that has executed a query
+    """
+
+    return [CAST_COLUMN_NAME_PATTERN.sub(r'\1', column[0]) for column in cursor.description]
+
+
+def _finish_frame(df, columns, index_column=None, dates_column=None, wide_integers=()):
+    import pandas as pd
+
+    df.columns = columns
+
+    for column in wide_integers:
+        if df[column].notna().all():
+            df[column] = df[column].astype('int64')
+
+    if dates_column is not None:
+        for column in [dates_column] if isinstance(dates_column, str) else dates_column:
+            df[column] = pd.to_datetime(df[column])
+
+    if index_column is not None:
+        df = df.set_index(index_column)
+
+    return df
+
+
+def local_database(path=':memory:', data_dir='data'):
+    """
+    Creates a LocalDatabase holding the clean users and event_performance
+    tables, users from data_dir/users.csv and events from the clean export
+    written at the end of part 1.  Returns the LocalDatabase.
+
+    path (str): database file, or ':memory:'
+
+    data_dir (str): directory holding users.csv and clean/
+    """
+
+    import os
+
+    database = LocalDatabase(path)
+
+    database.execute("""
+DROP TABLE IF EXISTS users;
+
+CREATE TABLE users (
+  userid VARCHAR(36) NOT NULL PRIMARY KEY,
+  subscriber int NOT NULL,
+  category VARCHAR NOT NULL
+  );
+
+DROP TABLE IF EXISTS event_performance;
+
+CREATE TABLE event_performance (
+  userid VARCHAR(36) NOT NULL,
+  event_date DATE NOT NULL,
+  hour int NOT NULL,
+  points int NOT NULL
+  );
+""")
+
+    database.execute(f"COPY users FROM '{os.path.join(data_dir, 'users.csv')}' "
+                     f"DELIMITER ',' CSV HEADER;")
+    database.execute(f"COPY event_performance FROM "
+                     f"'{os.path.join(data_dir, 'clean', 'event_performance_clean.csv')}' "
+                     f"DELIMITER ',' CSV HEADER;")
+
+    return database
@@ -0,0 +1,302 @@
+import os
+import threading
+
+
+CHAR_WIDTH_PX = 7
+# Bold matplotlib text runs wider than the SVG estimate
+PNG_CHAR_WIDTH_PX = 9
+ROW_HEIGHT_PX = 22
+CELL_PADDING_PX = 8
+
+
+def _table_cells(df):
+    """
+    Formats a DataFrame as lists of strings: header row, index labels and
+    body rows, using the display float format currently set in pandas.
+    """
+
+    import pandas as pd
+
+    float_format = pd.get_option('display.float_format') or (lambda x: f'{x:g}')
+
+    def fmt(value):
+        if isinstance(value, float):
+            return float_format(value)
+        return str(value)
+
+    index_name = ', '.join(str(name) for name in df.index.names if name is not None)
+    header = [index_name] + [str(column) for column in df.columns]
+    index = [', '.join(map(str, label)) if isinstance(label, tuple) else str(label)
+             for label in df.index]
+    body = [[fmt(value) for value in row] for row in df.itertuples(index=False)]
+
+    return header, index, body
+
+
+def content_hash(df, fmt):
+    """
+    Returns a hex digest identifying a DataFrame's values, index, columns
+    and dtypes together with the output format, used as the render cache
+    key.
+
+    df (Pandas DataFrame): table to hash
+
+    fmt (str): output format, 'png', 'svg' or 'html'
+    """
+
+    import hashlib
+    import pandas as pd
+
+    digest = hashlib.sha256()
+    digest.update(fmt.encode())
+    digest.update(repr(list(df.columns)).encode())
+    digest.update(repr(list(df.dtypes.astype(str))).encode())
+    digest.update(repr(list(df.index.names)).encode())
+    digest.update(repr(pd.get_option('display.float_format')).encode())
+    digest.update(pd.util.hash_pandas_object(df, index=True).to_numpy().tobytes())
+
+    return digest.hexdigest()
+
+
+def render_html(df):
+    """
+    Renders a DataFrame as an HTML table.
+    """
+
+    return df.to_html(border=0, classes='dataframe')
+
+
+def render_svg(df):
+    """
+    Renders a DataFrame as a standalone SVG table.  Column widths come from
+    the longest string in each column, so rendering is a single pass of
+    string building with no browser or plotting library involved.
+    """
+
+    from xml.sax.saxutils import escape
+
+    header, index, body = _table_cells(df)
+    rows = [header] + [[label] + row for label, row in zip(index, body)]
+
+    widths = [max(len(row[col]) for row in rows) * CHAR_WIDTH_PX + 2 * CELL_PADDING_PX
+              for col in range(len(header))]
+    lefts = [sum(widths[:col]) for col in range(len(widths))]
+    total_width = sum(widths)
+    total_height = len(rows) * ROW_HEIGHT_PX
+
+    parts = [f'<svg xmlns="http://www.w3.org/2000/svg" width="{total_width}" '
+             f'height="{total_height}" font-family="Helvetica, Arial, sans-serif" '
+             f'font-size="12">',
+             f'<rect width="{total_width}" height="{total_height}" fill="white"/>']
+
+    for i, row in enumerate(rows):
+        top = i * ROW_HEIGHT_PX
+        if i > 0 and i % 2 == 1:
+            parts.append(f'<rect y="{top}" width="{total_width}" '
+                         f'height="{ROW_HEIGHT_PX}" fill="#f5f5f5"/>')
+
+        baseline = top + ROW_HEIGHT_PX - 7
+        for col, text in enumerate(row):
+            bold = ' font-weight="bold"' if i == 0 or col == 0 else ''
+            if col == 0:
+                x, anchor = lefts[col] + CELL_PADDING_PX, 'start'
+            else:
+                x, anchor = lefts[col] + widths[col] - CELL_PADDING_PX, 'end'
+            parts.append(f'<text x="{x}" y="{baseline}" text-anchor="{anchor}"{bold}>'
+                         f'{escape(text)}</text>')
+
+    parts.append(f'<line x1="0" y1="{ROW_HEIGHT_PX}" x2="{total_width}" '
+                 f'y2="{ROW_HEIGHT_PX}" stroke="black"/>')
+    parts.append('</svg>')
+
+    return '\n'.join(parts)
+
+
+def render_png(df, path, dpi=100):
+    """
+    Renders a DataFrame to a PNG file with matplotlib's Agg backend, sizing
+    the figure from the table's text so no tight bounding box pass is
+    needed.
+    """
+
+    from matplotlib.figure import Figure
+
+    header, index, body = _table_cells(df)
+    rows = [header] + [[label] + row for label, row in zip(index, body)]
+
+    widths = [max(len(row[col]) for row in rows) * PNG_CHAR_WIDTH_PX + 2 * CELL_PADDING_PX
+              for col in range(len(header))]
+    total_width = sum(widths)
+    total_height = len(rows) * ROW_HEIGHT_PX
+
+    fig = Figure(figsize=(total_width / dpi, total_height / dpi), dpi=dpi)
+    ax = fig.add_axes([0, 0, 1, 1])
+    ax.axis('off')
+
+    table = ax.table(cellText=[[label] + row for label, row in zip(index, body)],
+                     colLabels=header,
+                     colWidths=[width / total_width for width in widths],
+                     bbox=[0, 0, 1, 1])
+    table.auto_set_font_size(False)
+    table.set_fontsize(9)
+
+    for (row, col), cell in table.get_celld().items():
+        cell.set_edgecolor('white' if row > 0 else 'black')
+        if row == 0 or col == 0:
+            cell.set_text_props(fontweight='bold')
+        if row > 0 and row % 2 == 1:
+            cell.set_facecolor('#f5f5f5')
+
+    fig.savefig(path, dpi=dpi, format='png')
+
+
+def export_format(path):
+    """
+    Returns the export format of path, taken from its extension.  Raises a
+    ValueError for anything but .png, .svg and .html.
+
+    path (str): location of the rendered file
+    """
+
+    fmt = os.path.splitext(path)[1].lstrip('.').lower()
+    if fmt not in ('png', 'svg', 'html'):
+        raise ValueError(f"Unsupported export format '{fmt}', use .png, .svg or .html")
+
+    return fmt
+
+
+def export_table(df, path, cache_dir='.export_cache'):
+    """
+    Renders a DataFrame to path, with the format taken from the file
+    extension (.png, .svg or .html).  Renders are cached under cache_dir by
+    content hash, so exporting an unchanged table again is a file copy.
+    Returns the path.
+
+    df (Pandas DataFrame): table to render
+
+    path (str): location of the rendered file
+
+    cache_dir (str): directory of cached renders, or None to disable caching
+    """
+
+    import shutil
+
+    fmt = export_format(path)
+
+    cached_path = None
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        cached_path = os.path.join(cache_dir, f'{content_hash(df, fmt)}.{fmt}')
+        if os.path.exists(cached_path):
+            shutil.copyfile(cached_path, path)
+            return path
+
+    render_path = f'{cached_path or path}.{threading.get_ident()}.tmp'
+
+    if fmt == 'png':
+        render_png(df, render_path)
+    else:
+        text = render_svg(df) if fmt == 'svg' else render_html(df)
+        with open(render_path, 'w') as f:
+            f.write(text)
+
+    if cached_path is None:
+        os.replace(render_path, path)
+    else:
+        os.replace(render_path, cached_path)
+        shutil.copyfile(cached_path, path)
+
+    return path
+
+
+class TableExporter:
+    """
+    Background pool that renders table exports off the calling thread, so
+    queries don't wait on rendering.  Exports are submitted as they come and
+    finished with wait(), or automatically when used as a context manager.
+
+    max_workers (int): number of renders running at once
+
+    cache_dir (str): directory of cached renders, or None to disable caching
+    """
+
+    def __init__(self, max_workers=2, cache_dir='.export_cache'):
+        from concurrent.futures import ThreadPoolExecutor
+
+        self.cache_dir = cache_dir
+        self.pool = ThreadPoolExecutor(max_workers=max_workers,
+                                       thread_name_prefix='table_export')
+        self.futures = []
+        self.lock = threading.Lock()
+
+    def submit(self, df, path):
+        """
+        Queues a DataFrame to be rendered to path.  The DataFrame is copied so
+        later changes by the caller don't leak into the export.  Returns a
+        Future resolving to the path.  An unsupported extension raises here
+        rather than in the worker.
+        """
+
+        export_format(path)
+
+        future = self.pool.submit(export_table, df.copy(), path, self.cache_dir)
+        with self.lock:
+            self.futures.append(future)
+
+        return future
+
+    def submit_many(self, exports):
+        """
+        Queues a batch of (DataFrame, path) exports.  Returns their Futures.
+        """
+
+        return [self.submit(df, path) for df, path in exports]
+
+    def wait(self):
+        """
+        Blocks until every queued export is written.  Returns the paths and
+        raises the first error any export hit.
+        """
+
+        with self.lock:
+            futures, self.futures = self.futures, []
+
+        return [future.result() for future in futures]
+
+    def shutdown(self):
+        self.wait()
+        self.pool.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown()
+
+
+_default_exporter = None
+_default_exporter_lock = threading.Lock()
+
+
+def default_exporter():
+    """
+    Returns the shared TableExporter used by sql_query_to_pandas_df, creating
+    it on first use.
+    """
+
+    global _default_exporter
+
+    with _default_exporter_lock:
+        if _default_exporter is None:
+            _default_exporter = TableExporter()
+
+    return _default_exporter
+
+
+def wait_for_exports():
+    """
+    Blocks until every export queued through sql_query_to_pandas_df has been
+    written.  Returns their paths.
+    """
+
+    return [] if _default_exporter is None else _default_exporter.wait()
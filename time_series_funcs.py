@@ -0,0 +1,190 @@
+def event_day_stats_query(window=7):
+    """
+    Returns a SQL query that computes total points per gaming event along
+    with rolling statistics and extremes in a single pass over
+    event_performance using window functions.  Each row is one gaming event
+    and contains:
+
+    day, total_points, rolling_mean, rolling_std, is_min_day, is_max_day
+
+    window (int): number of gaming events (not calendar days) covered by the
+    rolling mean and standard deviation, including the current event
+    """
+
+    window = int(window)
+    if window < 1:
+        raise ValueError('window must be a positive integer')
+
+    return f"""
+WITH total_points_per_day AS (
+  SELECT event_date AS day
+       , SUM(points) AS total_points
+    FROM event_performance
+GROUP BY event_date
+)
+
+  SELECT day
+       , total_points
+       , AVG(total_points) OVER rolling AS rolling_mean
+       , STDDEV_SAMP(total_points) OVER rolling AS rolling_std
+       , total_points = MIN(total_points) OVER () AS is_min_day
+       , total_points = MAX(total_points) OVER () AS is_max_day
+    FROM total_points_per_day
+  WINDOW rolling AS (ORDER BY day
+                     ROWS BETWEEN {window - 1} PRECEDING AND CURRENT ROW)
+ORDER BY day;
+"""
+
+
+def month_over_month_query():
+    """
+    Returns a SQL query that computes total points per month and the change
+    from the previous month using LAG, in a single pass over
+    event_performance.
+    """
+
+    return """
+  SELECT DATE_TRUNC('month', event_date)::date AS month
+       , SUM(points) AS total_points
+       , SUM(points) - LAG(SUM(points)) OVER (ORDER BY DATE_TRUNC('month', event_date))
+           AS mom_delta
+    FROM event_performance
+GROUP BY DATE_TRUNC('month', event_date)
+ORDER BY 1;
+"""
+
+
+def daily_totals(event_performance):
+    """
+    Aggregates event level rows to total points per gaming event.  Returns a
+    Pandas Series indexed by day (sorted) named total_points.
+
+    event_performance (Pandas DataFrame): event level rows with event_date
+    and points columns.  event_date may be a column or the index.
+    """
+
+    import pandas as pd
+
+    if 'event_date' in event_performance.columns:
+        days = event_performance['event_date']
+    else:
+        days = event_performance.index
+
+    totals = event_performance['points'].groupby(pd.to_datetime(days)).sum()
+    totals.index.name = 'day'
+
+    return totals.sort_index().rename('total_points')
+
+
+def event_day_stats(totals, window=7):
+    """
+    Computes rolling statistics and extreme-day flags over per-event totals
+    with vectorized rolling operations.  Returns a Pandas DataFrame indexed by
+    day with the same columns as event_day_stats_query.
+
+    totals (Pandas Series): total points per gaming event indexed by day, ie
+    the output of daily_totals
+
+    window (int): number of gaming events covered by the rolling mean and
+    standard deviation, including the current event
+    """
+
+    window = int(window)
+    if window < 1:
+        raise ValueError('window must be a positive integer')
+
+    totals = totals.sort_index()
+    rolling = totals.rolling(window, min_periods=1)
+
+    stats = totals.to_frame('total_points')
+    stats['rolling_mean'] = rolling.mean()
+    stats['rolling_std'] = rolling.std()
+    stats['is_min_day'] = totals == totals.min()
+    stats['is_max_day'] = totals == totals.max()
+
+    return stats
+
+
+def update_event_day_stats(stats, new_totals, window=7):
+    """
+    Extends the output of event_day_stats with newly appended gaming events
+    without recomputing from raw events.  Days in new_totals that already
+    exist in stats are added onto the existing totals.  Only the rolling
+    values from the first affected day onward are recomputed, using the
+    window - 1 events before it as context.  Returns a new Pandas DataFrame.
+
+    stats (Pandas DataFrame): previous output of event_day_stats
+
+    new_totals (Pandas Series): total points per gaming event for the new
+    events, indexed by day
+
+    window (int): must match the window stats was built with
+    """
+
+    import pandas as pd
+
+    window = int(window)
+    if window < 1:
+        raise ValueError('window must be a positive integer')
+
+    if len(new_totals) == 0:
+        return stats.copy()
+
+    totals = stats['total_points'].add(new_totals.groupby(level=0).sum(),
+                                       fill_value=0)
+    totals = totals.astype(stats['total_points'].dtype).sort_index()
+    totals.name = 'total_points'
+
+    first_affected = totals.index.get_loc(new_totals.index.min())
+    context_start = max(first_affected - (window - 1), 0)
+
+    tail = totals.iloc[context_start:]
+    rolling = tail.rolling(window, min_periods=1)
+
+    updated = totals.to_frame('total_points')
+    updated['rolling_mean'] = stats['rolling_mean']
+    updated['rolling_std'] = stats['rolling_std']
+
+    recomputed = updated.index[first_affected:]
+    updated.loc[recomputed, 'rolling_mean'] = rolling.mean().loc[recomputed]
+    updated.loc[recomputed, 'rolling_std'] = rolling.std().loc[recomputed]
+
+    updated['is_min_day'] = totals == totals.min()
+    updated['is_max_day'] = totals == totals.max()
+
+    return updated
+
+
+def extreme_days(stats):
+    """
+    Returns the rows of an event day stats DataFrame (from either
+    event_day_stats or event_day_stats_query) flagged as the minimum or
+    maximum total points day, ordered by total_points so the minimum comes
+    first.
+
+    stats (Pandas DataFrame): event day stats indexed by day
+    """
+
+    extremes = stats.loc[stats['is_min_day'] | stats['is_max_day'],
+                         ['total_points']]
+
+    return extremes.sort_values('total_points')
+
+
+def month_over_month(totals):
+    """
+    Rolls per-event totals up to months and computes the change from the
+    previous month.  Returns a Pandas DataFrame indexed by month with
+    total_points and mom_delta columns.
+
+    totals (Pandas Series): total points per gaming event indexed by day
+    """
+
+    monthly = totals.groupby(totals.index.to_period('M')).sum()
+    monthly.index = monthly.index.to_timestamp()
+    monthly.index.name = 'month'
+
+    monthly = monthly.to_frame('total_points')
+    monthly['mom_delta'] = monthly['total_points'].diff()
+
+    return monthly